@@ -0,0 +1,126 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+"""
+Micro-benchmark for the text scrape step of do_capture.
+
+Compares the previous implementation (Cleaner + full reparse + string
+concatenation) with sketchy.controllers.extract over a corpus of html files:
+
+    python benchmarks/extract_text.py /path/to/html/corpus [--repeat 5]
+
+Without a corpus directory a synthetic set of large pages is generated.
+"""
+import os
+import sys
+
+sys.path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + sys.path
+
+import argparse
+import json
+import re
+import shutil
+import tempfile
+import time
+import lxml.html as LH
+import lxml.html.clean as clean
+
+from sketchy.controllers.extract import extract_text
+
+
+def legacy_extract_text(html_path, text_path):
+    """
+    The scrape step as it was implemented in do_capture.
+    """
+    ignore_tags = ('script', 'noscript', 'style')
+    with open(html_path, 'r') as content_file:
+        content = content_file.read()
+    cleaner = clean.Cleaner()
+    content = cleaner.clean_html(content)
+    doc = LH.fromstring(content)
+    output = ""
+    for elt in doc.iterdescendants():
+        if elt.tag in ignore_tags:
+            continue
+        text = elt.text or ''
+        tail = elt.tail or ''
+        wordz = " ".join((text, tail)).strip('\t')
+        if wordz and len(wordz) >= 2 and not re.match("^[ \t\n]*$", wordz):
+            output += wordz.encode('utf-8')
+    with open(text_path, 'wb') as parsed_text:
+        parsed_text.write(output)
+
+
+def synthetic_corpus(directory, pages=5, rows=20000):
+    """
+    Write a few large, script and table heavy pages to directory.
+    """
+    for page in range(pages):
+        with open(os.path.join(directory, 'synthetic_{}.html'.format(page)), 'w') as html_file:
+            html_file.write('<html><head><title>Page {}</title>'.format(page))
+            html_file.write('<script>var data = "' + 'x' * 50000 + '";</script></head><body>')
+            for row in range(rows):
+                html_file.write('<div class="row"><span>Item {0}</span> <a href="/item/{0}">details</a>'
+                                '<!-- row {0} --><p>Lorem ipsum dolor sit amet {0}</p></div>\n'.format(row))
+            html_file.write('</body></html>')
+
+
+def best_of(function, html_path, text_path, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        function(html_path, text_path)
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('corpus', nargs='?', help='directory of .html/.htm files')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per file, the best one is reported')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='sketchy-extract-')
+    try:
+        corpus = args.corpus
+        if not corpus:
+            corpus = os.path.join(workdir, 'corpus')
+            os.makedirs(corpus)
+            synthetic_corpus(corpus)
+
+        results = []
+        for name in sorted(os.listdir(corpus)):
+            if not name.endswith(('.html', '.htm')):
+                continue
+            html_path = os.path.join(corpus, name)
+            text_path = os.path.join(workdir, name + '.txt')
+            legacy = best_of(legacy_extract_text, html_path, text_path, args.repeat)
+            streaming = best_of(extract_text, html_path, text_path, args.repeat)
+            results.append({'file': name,
+                            'bytes': os.path.getsize(html_path),
+                            'legacy_seconds': legacy,
+                            'streaming_seconds': streaming,
+                            'speedup': legacy / streaming if streaming else None})
+
+        total_legacy = sum(result['legacy_seconds'] for result in results)
+        total_streaming = sum(result['streaming_seconds'] for result in results)
+        print json.dumps({'files': results,
+                          'legacy_seconds': total_legacy,
+                          'streaming_seconds': total_streaming,
+                          'speedup': total_legacy / total_streaming if total_streaming else None}, indent=4)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
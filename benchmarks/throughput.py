@@ -0,0 +1,431 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+"""
+End-to-end throughput benchmark of the capture pipeline.
+
+Starts a local fixture site, a minimal S3 stand-in and a callback receiver,
+then POSTs captures of the fixture pages to CaptureViewList.post and waits
+for every callback:
+
+    python benchmarks/throughput.py --captures 200 --concurrency 8 --output results.json
+
+Captures travel the real path (check_url -> celery_capture -> do_capture ->
+s3_save -> finisher) through celery workers started by the benchmark, so
+redis and PhantomJS must be available. Per-stage latencies come from the
+pipeline metrics, end-to-end latency from the callback arrival times.
+Pipeline variants are benchmarked by exporting their usual environment
+variables (fused_pipeline, use_renderer_pool, async_callbacks, ...).
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path = [ROOT] + sys.path
+
+import argparse
+import datetime
+import hashlib
+import itertools
+import json
+import re
+import resource
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import urlparse
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+# Fixture pages, by name
+PAGES = ('tiny', 'huge', 'slow-ajax', 'redirect', 'not-found', 'server-error')
+
+TINY_PAGE = '<html><head><title>Tiny</title></head><body><h1>Tiny page</h1><p>Hello.</p></body></html>'
+
+SLOW_AJAX_PAGE = '''<html><head><title>Slow AJAX</title></head><body><div id="content">Loading</div>
+<script>
+var request = new XMLHttpRequest();
+request.onload = function() {{ document.getElementById('content').innerHTML = request.responseText; }};
+request.open('GET', '/slow?ms={}');
+request.send();
+</script></body></html>'''
+
+
+def huge_page(rows):
+    parts = ['<html><head><title>Huge DOM</title></head><body><table>']
+    for row in range(rows):
+        parts.append('<tr><td>Row {0}</td><td><a href="/item/{0}">item {0}</a></td>'
+                     '<td><span>Lorem ipsum dolor sit amet</span></td></tr>'.format(row))
+    parts.append('</table></body></html>')
+    return ''.join(parts)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, code, body='', headers=None, head=False):
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def log_message(self, *args):
+        pass
+
+
+class FixtureHandler(Handler):
+    """
+    Serves the fixture pages, see PAGES.
+    """
+    huge = ''
+    ajax_delay = 1500
+
+    def do_HEAD(self):
+        self.do_GET(head=True)
+
+    def do_GET(self, head=False):
+        url = urlparse.urlparse(self.path)
+        path = url.path.strip('/').split('/')
+        html = {'Content-Type': 'text/html; charset=utf-8'}
+        if path[0] == 'tiny':
+            self.reply(200, TINY_PAGE, html, head)
+        elif path[0] == 'huge':
+            self.reply(200, self.huge, html, head)
+        elif path[0] == 'slow-ajax':
+            self.reply(200, SLOW_AJAX_PAGE.format(self.ajax_delay), html, head)
+        elif path[0] == 'slow':
+            time.sleep(int(urlparse.parse_qs(url.query).get('ms', ['0'])[0]) / 1000.0)
+            self.reply(200, '<p>Loaded late</p>', {'Content-Type': 'text/plain'}, head)
+        elif path[0] == 'redirect':
+            # /redirect/<n> takes n more redirects to reach the tiny page
+            hops = int(path[1]) if len(path) > 1 else 3
+            location = '/redirect/{}'.format(hops - 1) if hops > 1 else '/tiny'
+            self.reply(302, '', {'Location': location}, head)
+        elif path[0] == 'not-found':
+            self.reply(404, '<html><body>Not found</body></html>', html, head)
+        elif path[0] == 'server-error':
+            self.reply(500, '<html><body>Server error</body></html>', html, head)
+        else:
+            self.reply(404, '', html, head)
+
+
+class S3Handler(Handler):
+    """
+    Just enough of the S3 REST API for boto to upload objects, with path
+    style bucket addressing. Object bodies are counted and dropped.
+    """
+    lock = threading.Lock()
+    objects = 0
+    bytes = 0
+
+    def do_HEAD(self):
+        self.reply(200, head=True)
+
+    def do_GET(self):
+        self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>'
+                        '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                        '<IsTruncated>false</IsTruncated></ListBucketResult>',
+                   {'Content-Type': 'application/xml'})
+
+    def do_PUT(self):
+        body = self.read_body()
+        query = urlparse.parse_qs(urlparse.urlparse(self.path).query)
+        with S3Handler.lock:
+            S3Handler.bytes += len(body)
+            if 'partNumber' not in query:
+                S3Handler.objects += 1
+        self.reply(200, headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+    def do_POST(self):
+        self.read_body()
+        url = urlparse.urlparse(self.path)
+        bucket, key = url.path.lstrip('/').split('/', 1)
+        if url.query == 'uploads':
+            result = ('<InitiateMultipartUploadResult><Bucket>{}</Bucket><Key>{}</Key>'
+                      '<UploadId>{}</UploadId></InitiateMultipartUploadResult>').format(bucket, key, uuid.uuid4().hex)
+        else:
+            with S3Handler.lock:
+                S3Handler.objects += 1
+            result = ('<CompleteMultipartUploadResult><Location>{0}</Location><Bucket>{1}</Bucket>'
+                      '<Key>{2}</Key><ETag>"{3}"</ETag></CompleteMultipartUploadResult>').format(
+                          self.path, bucket, key, uuid.uuid4().hex)
+        self.reply(200, '<?xml version="1.0" encoding="UTF-8"?>' + result, {'Content-Type': 'application/xml'})
+
+    def do_DELETE(self):
+        self.reply(204)
+
+
+class CallbackHandler(Handler):
+    """
+    Records when the callback of each capture arrives.
+    """
+    lock = threading.Lock()
+    received = {}
+
+    def do_POST(self):
+        payload = json.loads(self.read_body())
+        now = time.time()
+        with CallbackHandler.lock:
+            for entry in payload if isinstance(payload, list) else [payload]:
+                CallbackHandler.received.setdefault(entry['id'], (now, entry.get('job_status')))
+        self.reply(200, 'OK')
+
+
+def serve(handler):
+    server = ThreadingServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+
+def percentiles(samples):
+    """
+    Summarize exact samples in seconds.
+    """
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+    return {'count': len(samples), 'mean': float(sum(samples)) / len(samples),
+            'p50': pick(0.50), 'p95': pick(0.95), 'p99': pick(0.99), 'max': samples[-1]}
+
+
+def histogram_percentiles(values, buckets):
+    """
+    Estimate percentiles from a metrics histogram by interpolating inside buckets.
+    """
+    count = values.get('count', 0)
+    if not count:
+        return None
+
+    def estimate(q):
+        rank = q * count
+        cumulative = 0
+        lower = 0.0
+        for bound in buckets:
+            in_bucket = values.get(repr(float(bound)), 0)
+            if in_bucket and cumulative + in_bucket >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / in_bucket
+            cumulative += in_bucket
+            lower = float(bound)
+        # Past the last bucket there is nothing to interpolate with
+        return lower
+
+    return {'count': int(count), 'mean': values.get('sum', 0) / count,
+            'p50': estimate(0.50), 'p95': estimate(0.95), 'p99': estimate(0.99)}
+
+
+def label(labels, name):
+    return dict(re.findall(r'(\w+)="([^"]*)"', labels)).get(name)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--captures', type=int, default=100, help='number of captures to request')
+    parser.add_argument('--concurrency', type=int, default=4, help='celery worker processes')
+    parser.add_argument('--clients', type=int, default=4, help='threads POSTing capture requests')
+    parser.add_argument('--pages', default=','.join(PAGES), help='comma separated fixture pages to cycle through')
+    parser.add_argument('--huge-rows', type=int, default=20000, help='table rows of the huge DOM page')
+    parser.add_argument('--ajax-delay', type=int, default=1500, help='milliseconds the slow AJAX call takes')
+    parser.add_argument('--db', help='database URI, defaults to a temporary sqlite database')
+    parser.add_argument('--external-workers', action='store_true',
+                        help='use already running workers configured like this benchmark')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds to wait for every callback')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    pages = [page for page in args.pages.split(',') if page]
+    for page in pages:
+        if page not in PAGES:
+            parser.error('unknown page {}, choose from {}'.format(page, ', '.join(PAGES)))
+
+    FixtureHandler.huge = huge_page(args.huge_rows)
+    FixtureHandler.ajax_delay = args.ajax_delay
+    fixture_server, fixture_url = serve(FixtureHandler)
+    s3_server, s3_url = serve(S3Handler)
+    callback_server, callback_url = serve(CallbackHandler)
+
+    workdir = tempfile.mkdtemp(prefix='sketchy-throughput-')
+    worker = None
+    try:
+        # The web app and the workers read their configuration from the environment
+        os.environ.update({
+            'sketchy_db': args.db or 'sqlite:///{}'.format(os.path.join(workdir, 'sketchy.db')),
+            'use_s3': 'True',
+            's3_host': '127.0.0.1',
+            's3_port': str(s3_server.server_port),
+            's3_is_secure': 'False',
+            'bucket_prefix': 'sketchy-benchmark',
+            'metrics_enabled': 'True',
+            'capture_cache_ttl': '0',
+            'domain_politeness': 'False',
+            'ip_blacklisting': 'False',
+            'require_auth': 'False'})
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+        from sketchy import app, celery, db
+        from sketchy.controllers import metrics
+        from sketchy.models.capture import Capture
+
+        db.create_all()
+        metrics.reset()
+
+        if not args.external_workers:
+            worker = subprocess.Popen([sys.executable, '-m', 'celery', 'worker', '-A', 'sketchy.celery',
+                                       '-c', str(args.concurrency), '--loglevel=warning'], cwd=ROOT)
+        deadline = time.time() + 60
+        while not celery.control.ping(timeout=1):
+            if time.time() > deadline:
+                raise Exception('No celery worker answered within 60 seconds')
+
+        urls = ['{}/{}?capture={}'.format(fixture_url, page, number)
+                for number, page in itertools.izip(xrange(args.captures), itertools.cycle(pages))]
+        urls.reverse()
+        posted = {}
+        posted_lock = threading.Lock()
+
+        def client():
+            test_client = app.test_client()
+            while True:
+                with posted_lock:
+                    if not urls:
+                        return
+                    url = urls.pop()
+                sent = time.time()
+                response = test_client.post('/api/v1.0/capture', content_type='application/json',
+                                            data=json.dumps({'url': url, 'callback': callback_url, 'force': True}))
+                capture = json.loads(response.data)
+                with posted_lock:
+                    posted[capture['id']] = (sent, url)
+
+        start = time.time()
+        clients = [threading.Thread(target=client) for _ in range(args.clients)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        post_seconds = time.time() - start
+
+        deadline = start + args.timeout
+        while time.time() < deadline:
+            with CallbackHandler.lock:
+                if all(capture_id in CallbackHandler.received for capture_id in posted):
+                    break
+            time.sleep(0.1)
+        with CallbackHandler.lock:
+            received = dict(CallbackHandler.received)
+
+        done = [received[capture_id][0] for capture_id in posted if capture_id in received]
+        wall_seconds = (max(done) if done else time.time()) - start
+
+        # End-to-end latency and outcome of each fixture page
+        by_page = {}
+        for capture_id, (sent, url) in posted.items():
+            page = urlparse.urlparse(url).path.strip('/')
+            summary = by_page.setdefault(page, {'latencies': [], 'job_status': {}})
+            if capture_id in received:
+                arrived, job_status = received[capture_id]
+                summary['latencies'].append(arrived - sent)
+            else:
+                job_status = 'NO_CALLBACK'
+            summary['job_status'][job_status] = summary['job_status'].get(job_status, 0) + 1
+        latencies = list(itertools.chain(*[summary['latencies'] for summary in by_page.values()]))
+        pages_report = dict((page, {'end_to_end': percentiles(summary['latencies']),
+                                    'job_status': summary['job_status']})
+                            for page, summary in by_page.items())
+
+        stages = dict((label(labels, 'stage'), histogram_percentiles(values, metrics.BUCKETS))
+                      for labels, values in metrics.read_histogram('sketchy_stage_seconds').items())
+        queue_wait = dict((label(labels, 'task'), histogram_percentiles(values, metrics.BUCKETS))
+                          for labels, values in metrics.read_histogram('sketchy_queue_wait_seconds').items())
+        stage_outcomes = {}
+        for labels, value in metrics.read_counter('sketchy_stage_total').items():
+            stage_outcomes.setdefault(label(labels, 'stage'), {})[label(labels, 'outcome')] = value
+        task_outcomes = {}
+        for labels, value in metrics.read_counter('sketchy_tasks_total').items():
+            task_outcomes.setdefault(label(labels, 'task'), {})[label(labels, 'outcome')] = value
+        job_status = dict(db.session.query(Capture.job_status, db.func.count(Capture.id))
+                          .filter(Capture.id.in_(posted.keys())).group_by(Capture.job_status).all()) if posted else {}
+
+        # ru_maxrss of the children is only known once the workers have exited
+        if worker is not None:
+            worker.send_signal(signal.SIGTERM)
+            worker.wait()
+            worker = None
+        workers_rss = None if args.external_workers else resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+        results = {
+            'revision': git_revision(),
+            'started_at': datetime.datetime.utcfromtimestamp(start).isoformat() + 'Z',
+            'parameters': dict(vars(args), pages=pages),
+            'pipeline': {'fused_pipeline': app.config['FUSED_PIPELINE'],
+                         'use_renderer_pool': app.config['USE_RENDERER_POOL'],
+                         'async_callbacks': app.config['ASYNC_CALLBACKS'],
+                         'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0]},
+            'captures': len(posted),
+            'completed': len(done),
+            'job_status': job_status,
+            'post_seconds': post_seconds,
+            'wall_seconds': wall_seconds,
+            'captures_per_second': len(done) / wall_seconds if wall_seconds > 0 else None,
+            'end_to_end': percentiles(latencies),
+            'pages': pages_report,
+            'stages': stages,
+            'stage_outcomes': stage_outcomes,
+            'queue_wait': queue_wait,
+            'task_outcomes': task_outcomes,
+            's3': {'objects': S3Handler.objects, 'bytes': S3Handler.bytes},
+            # Linux reports kilobytes, the worker figure is the largest single process
+            'peak_rss_kb': {'benchmark': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            'workers': workers_rss}}
+
+        output = json.dumps(results, indent=4, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                output_file.write(output + '\n')
+        else:
+            print output
+    finally:
+        if worker is not None:
+            worker.kill()
+            worker.wait()
+        for server in (fixture_server, s3_server, callback_server):
+            server.shutdown()
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -30,18 +30,166 @@ BASE_URL = 'http://%s' % os.getenv('host', '127.0.0.1:8000')
 CELERY_BROKER_URL = os.getenv('sketchy_broker_url', 'redis://localhost:6379')
 CELERY_RESULT_BACKEND = os.getenv('sketchy_result_backend', 'redis://localhost:6379')
 
+# Redis used to coordinate workers (domain politeness, etc.)
+SKETCHY_REDIS_URL = os.getenv('sketchy_redis_url', CELERY_BROKER_URL)
+
 # Only accept json content for celery
 
 CELERY_ACCEPT_CONTENT = ['json', 'pickle']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# Celery queue of each kind of task. A worker started without -Q consumes
+# all of them, run a pool per group of queues so cheap checks and eager
+# captures never wait behind bulk renders, e.g.
+#   celery worker -A sketchy.celery -Q sketchy.interactive,sketchy.status,sketchy.callbacks
+#   celery worker -A sketchy.celery -Q sketchy.render,sketchy.upload,celery
+SKETCHY_QUEUES = {
+    # Eager captures a client is waiting on
+    'interactive': os.getenv('interactive_queue', 'sketchy.interactive'),
+    # URL status checks, including the check ahead of a full capture
+    'status': os.getenv('status_queue', 'sketchy.status'),
+    # Full and static captures
+    'render': os.getenv('render_queue', 'sketchy.render'),
+    # S3 uploads when ASYNC_UPLOADS is set
+    'upload': os.getenv('upload_queue', 'sketchy.upload'),
+    # Callback deliveries when ASYNC_CALLBACKS is set
+    'callback': os.getenv('callback_queue', 'sketchy.callbacks')}
+
+# Priority of the tasks of a capture request by the priority it asked for.
+# Captures default to normal, batches to low. Redis serves 0 first.
+TASK_PRIORITIES = {'high': 0, 'normal': 3, 'low': 6}
+# Workers reserve one task at a time so priorities are not bypassed by prefetching
+CELERYD_PREFETCH_MULTIPLIER = 1
+
 # Local Screenshot storage
 LOCAL_STORAGE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'files')
 
+# Artifacts are spread over this many levels of hashed subfolders of
+# LOCAL_STORAGE_FOLDER (0 keeps them all in LOCAL_STORAGE_FOLDER), e.g. 2 for
+# millions of captures. Files of the flat layout are still served, run
+# manage.py migrate_storage after changing it to move existing files.
+STORAGE_SHARD_DEPTH = int(os.getenv('storage_shard_depth', 0))
+
+# Budget of the local artifacts enforced every STORAGE_JANITOR_INTERVAL
+# seconds by the celery workers of each host: least recently used artifacts
+# are deleted past the total size in bytes or once unused for the age in
+# seconds (0 disables a limit). Artifacts younger than the grace period in seconds or whose record is not
+# finished are never deleted.
+STORAGE_MAX_BYTES = int(os.getenv('storage_max_bytes', 0))
+STORAGE_MAX_AGE = int(os.getenv('storage_max_age', 0))
+STORAGE_EVICTION_GRACE = 3600
+STORAGE_JANITOR_INTERVAL = 600
+
+# Check, capture, store and call back in a single celery task instead of a
+# check_url -> celery_capture chain (one broker hop and fewer DB commits)
+FUSED_PIPELINE = os.getenv('fused_pipeline', 'False').lower() == 'true'
+
 # Maximum time to wait for PhantomJS to generate a screenshot
 PHANTOMJS_TIMEOUT = 35
 
+# How PhantomJS decides a page is ready to render, requests may override
+# each of them. fixed renders SETTLE_AJAX_TIMEOUT ms after the last pending
+# request ended, adaptive as soon as no request was pending and the DOM did
+# not change for SETTLE_IDLE_TIME ms. Pages are rendered SETTLE_MAX_TIMEOUT ms
+# after they loaded at the latest, raise it for AJAX heavy pages in adaptive mode.
+SETTLE_MODE = os.getenv('settle_mode', 'fixed')
+SETTLE_AJAX_TIMEOUT = 400
+SETTLE_MAX_TIMEOUT = 800
+SETTLE_IDLE_TIME = 150
+
+# Requests PhantomJS never sends, to save render time and bandwidth. A block
+# list has hosts (blocked with their subdomains), patterns (regular
+# expressions matched against request URLs) and resource types told from the
+# URL extension: font, media, image, stylesheet or script. Requests pick a
+# list with 'block', BLOCK_LIST is used otherwise.
+BLOCK_HOSTS = ['doubleclick.net', 'googlesyndication.com', 'googleadservices.com', 'google-analytics.com',
+               'googletagmanager.com', 'googletagservices.com', 'adnxs.com', 'adsrvr.org', 'amazon-adsystem.com',
+               'criteo.com', 'outbrain.com', 'taboola.com', 'scorecardresearch.com', 'quantserve.com',
+               'hotjar.com', 'mixpanel.com', 'connect.facebook.net']
+BLOCK_LISTS = {
+    'none': {},
+    'ads': {'hosts': BLOCK_HOSTS},
+    'fast': {'hosts': BLOCK_HOSTS, 'types': ['font', 'media'],
+             'patterns': [r'[/.](beacon|pixel|collect|track(ing)?)([/.?]|$)']}}
+BLOCK_LIST = os.getenv('block_list', 'none')
+
+# Learn render timeouts per registered domain from its last
+# RENDER_TIMEOUT_HISTORY renders. Once RENDER_TIMEOUT_MIN_SAMPLES are known a
+# render times out after RENDER_TIMEOUT_FACTOR times their
+# RENDER_TIMEOUT_PERCENTILE instead of PHANTOMJS_TIMEOUT, and each retry after
+# a timeout multiplies it by RENDER_TIMEOUT_BACKOFF, always within
+# RENDER_TIMEOUT_FLOOR and RENDER_TIMEOUT_CEILING seconds.
+ADAPTIVE_TIMEOUTS = os.getenv('adaptive_timeouts', 'False').lower() == 'true'
+RENDER_TIMEOUT_HISTORY = 100
+RENDER_TIMEOUT_MIN_SAMPLES = 10
+RENDER_TIMEOUT_PERCENTILE = 95
+RENDER_TIMEOUT_FACTOR = 2.0
+RENDER_TIMEOUT_BACKOFF = 2.0
+RENDER_TIMEOUT_FLOOR = 5
+RENDER_TIMEOUT_CEILING = 120
+
+# Reuse the artifacts of a completed capture of the same URL for this many
+# seconds instead of capturing again (0 disables the cache)
+CAPTURE_CACHE_TTL = int(os.getenv('capture_cache_ttl', 0))
+
+# Record per-stage timings and task outcomes in redis, exported at /metrics
+# and by the manage.py metrics_exporter command
+METRICS_ENABLED = os.getenv('metrics_enabled', 'False').lower() == 'true'
+
+# Seconds the eager endpoint waits for a worker to finish a capture before
+# answering 202 with the URL of the capture record to poll. Keep it below
+# the gunicorn worker timeout. Workers and the web tier must share
+# LOCAL_STORAGE_FOLDER for eager captures to be served.
+EAGER_WAIT_TIMEOUT = float(os.getenv('eager_wait_timeout', 20))
+
+# Seconds an in-flight eager capture can be joined by identical requests,
+# the render normally clears it sooner when it finishes
+EAGER_COALESCE_TTL = int(os.getenv('eager_coalesce_ttl', max(PHANTOMJS_TIMEOUT, RENDER_TIMEOUT_CEILING) + 30))
+
+# Default and maximum number of records returned by list endpoints
+API_PAGE_LIMIT = 100
+API_MAX_PAGE_LIMIT = 1000
+
+# Maximum number of URLs accepted by a single batch capture request
+BATCH_MAX_URLS = 10000
+
+# Default sketch encoding, requests may override each of them.
+# Formats are png, jpeg and webp, quality applies to jpeg and webp.
+# SKETCH_MAX_HEIGHT crops long pages (0 keeps the full page).
+SKETCH_FORMAT = os.getenv('sketch_format', 'png')
+SKETCH_QUALITY = int(os.getenv('sketch_quality', 85))
+SKETCH_MAX_HEIGHT = int(os.getenv('sketch_max_height', 0))
+
+# Also write a small image of the top of the page, and its size
+SKETCH_THUMBNAIL = os.getenv('sketch_thumbnail', 'False').lower() == 'true'
+THUMBNAIL_SIZE = (320, 200)
+
+# Compress html and text artifacts on disk and in S3: '', 'gzip' or 'zstd'.
+# zstd needs the zstandard package, and S3 serves artifacts with their
+# Content-Encoding whatever the client accepts, so only use it when every
+# consumer of the S3 URLs understands zstd. None picks the codec default level.
+ARTIFACT_COMPRESSION = os.getenv('artifact_compression', '')
+ARTIFACT_COMPRESSION_LEVEL = None
+
+# Hash the top of every sketch and its scrape to tell how a page changed
+# since its previous capture (/capture/<id>/changes and /similar). Captures
+# are always hashed when SKIP_UNCHANGED_CAPTURES is set.
+FINGERPRINT_CAPTURES = os.getenv('fingerprint_captures', 'False').lower() == 'true'
+# A capture whose sketch or scrape hash is more than this many bits away
+# from the previous capture of its URL counts as changed
+CHANGE_SKETCH_DISTANCE = 4
+CHANGE_SCRAPE_DISTANCE = 3
+# Point captures that did not change at the artifacts of the previous
+# capture instead of storing and uploading new copies
+SKIP_UNCHANGED_CAPTURES = os.getenv('skip_unchanged_captures', 'False').lower() == 'true'
+
+# Index scrapes for /api/v1.0/capture/search. Needs SQLite with FTS5 or
+# PostgreSQL, run manage.py create_db after enabling it. Only the first
+# SEARCH_MAX_BYTES of a scrape are indexed (PostgreSQL caps a tsvector at 1MB).
+SEARCH_ENABLED = os.getenv('search_enabled', 'False').lower() == 'true'
+SEARCH_MAX_BYTES = 512 * 1024
+
 # Maximum number of Celery Job retries on failure
 MAX_RETRIES = 0
 
@@ -49,7 +197,25 @@ MAX_RETRIES = 0
 COOLDOWN = 3
 
 # Path to Phantom JS
-PHANTOMJS = '/usr/local/bin/phantomjs'
+PHANTOMJS = os.getenv('phantomjs', '/usr/local/bin/phantomjs')
+
+# Keep long-lived PhantomJS renderers in each worker process instead of
+# starting a new PhantomJS for every capture
+USE_RENDERER_POOL = os.getenv('use_renderer_pool', 'False').lower() == 'true'
+# Number of PhantomJS renderers per worker process
+RENDERER_POOL_SIZE = 1
+# Restart a renderer after this many pages to bound memory growth
+RENDERER_MAX_PAGES = 100
+# Maximum time to wait for a renderer to boot
+RENDERER_STARTUP_TIMEOUT = 10
+
+# Send every render to the shared renderer of this host (see `manage.py
+# renderer`) instead of a PhantomJS per worker, e.g. http://127.0.0.1:8910/
+RENDERER_URL = os.getenv('renderer_url', '')
+# Number of pages the shared renderer renders at once. Pages of the same host
+# never render together, but pages rendering at the same time share third
+# party cookies, set it to 1 to isolate the cookies of every capture.
+RENDERER_CONCURRENCY = int(os.getenv('renderer_concurrency', 4))
 
 # S3 Specific configurations
 # This will store your sketches, scrapes, and html in an S3 bucket
@@ -57,6 +223,35 @@ USE_S3 = os.getenv('use_s3', 'False').lower() == 'true'
 S3_BUCKET_PREFIX = os.getenv('bucket_prefix', 'bucket.test')
 S3_LINK_EXPIRATION = 6000000
 S3_BUCKET_REGION_NAME = os.getenv('bucket_region_name', 'us-east-1')
+# Point boto at an S3 compatible endpoint (e.g. a local stand-in) instead of AWS
+S3_HOST = os.getenv('s3_host')
+S3_PORT = int(os.getenv('s3_port', 443))
+S3_IS_SECURE = os.getenv('s3_is_secure', 'True').lower() == 'true'
+# Number of concurrent uploads per worker process
+S3_UPLOAD_THREADS = 3
+# Files of this size or larger are uploaded in parts
+S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+# Upload from the upload queue instead of the render task. Upload workers
+# must share LOCAL_STORAGE_FOLDER with the render workers.
+ASYNC_UPLOADS = os.getenv('async_uploads', 'False').lower() == 'true'
+
+# Deliver callbacks from their own celery queue instead of the capture task,
+# this needs a worker consuming the callback queue of SKETCHY_QUEUES
+ASYNC_CALLBACKS = os.getenv('async_callbacks', 'False').lower() == 'true'
+# Seconds to wait for a callback receiver
+CALLBACK_TIMEOUT = 10
+# Keep-alive connections per callback host
+CALLBACK_POOL_SIZE = 4
+# Failed callbacks are retried after CALLBACK_BACKOFF * 2 ** attempt seconds
+# (at most CALLBACK_MAX_BACKOFF) before they go to the dead letter table
+CALLBACK_MAX_RETRIES = 5
+CALLBACK_BACKOFF = 2
+CALLBACK_MAX_BACKOFF = 300
+# POST up to this many finished records per callback request as a JSON list,
+# waiting at most CALLBACK_BATCH_WINDOW seconds for a batch to fill (1 disables batching)
+CALLBACK_BATCH_SIZE = 1
+CALLBACK_BATCH_WINDOW = 5
 
 # Token Auth Setup
 REQUIRE_AUTH = os.getenv('require_auth', 'False').lower() == 'true'
@@ -65,13 +260,43 @@ AUTH_TOKEN = os.getenv('auth_token', 'test')
 # Log file configuration (currently only logs errors)
 SKETCHY_LOG_FILE = "sketchy.log"
 
+# Timeouts in seconds for checking the status of a URL
+STATUS_CONNECT_TIMEOUT = 3.05
+STATUS_READ_TIMEOUT = 5
+# Number of hosts, and connections per host, kept alive for status checks
+STATUS_POOL_HOSTS = 50
+STATUS_POOL_SIZE = 4
+# Check the URLs of status only batches in chunks of BULK_STATUS_CHUNK
+# captures, concurrently, instead of with a check_url task per URL
+BULK_STATUS_CHECKS = os.getenv('bulk_status_checks', 'False').lower() == 'true'
+BULK_STATUS_CHUNK = 500
+# Number of URLs checked at once by each worker process, and per host
+BULK_STATUS_CONCURRENCY = 100
+BULK_STATUS_PER_HOST = 4
+
+# Limit how hard workers hit a single registered domain. Tasks for a busy
+# domain are deferred, not failed.
+DOMAIN_POLITENESS = os.getenv('domain_politeness', 'False').lower() == 'true'
+# Maximum number of concurrent checks and captures per domain
+DOMAIN_CONCURRENCY = 2
+# Minimum number of seconds between two requests to a domain
+DOMAIN_MIN_INTERVAL = 1.0
+# Seconds after which a slot of a crashed worker is freed
+DOMAIN_LEASE_TIMEOUT = 120
+# Base delay in seconds before retrying a domain that is at its concurrency cap
+DOMAIN_DEFER_COUNTDOWN = 5
+
 # Perform SSL host validation (set to False if you want to scrape/screenshot sketchy websites)
 SSL_HOST_VALIDATION = False
 
 # Ignore a comma separated list of IP ranges
 # any host that falls within the range will be ignored
 IP_BLACKLISTING = os.getenv('ip_blacklisting', 'False').lower() == 'true'
+# IPv4 and IPv6 ranges are supported, hosts in these ranges are never rendered
 IP_BLACKLISTING_RANGE = os.getenv('ip_blacklisting_range', '10.0.0.1/8,11.0.0.1/8,100.0.0.1/8')
+# Seconds to cache DNS lookups for blacklist checks, and max number of cached hosts
+DNS_CACHE_TTL = 300
+DNS_CACHE_SIZE = 10000
 
 # Enable this option to screenshot webpages that generate 4xx or 5xx HTTP error codes
 CAPTURE_ERRORS = True
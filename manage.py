@@ -47,6 +47,14 @@ def clear():
     import shutil
     shutil.rmtree(app.config['LOCAL_STORAGE_FOLDER']) 
 
+@manager.command
+def migrate_storage():
+    """
+    Move local files to their hashed subfolders for the current STORAGE_SHARD_DEPTH
+    """
+    from sketchy.controllers import storage
+    print 'Moved {} files'.format(storage.migrate_layout())
+
 @manager.command
 def drop_db():
     """
@@ -122,6 +130,38 @@ class Start(Command):
 
             FlaskApplication().run()
 
+@manager.option('-p', '--port', dest='port', type=int, default=9102)
+@manager.option('-t', '--host', dest='host', default='0.0.0.0')
+def metrics_exporter(host, port):
+    """
+    Serve the pipeline metrics for Prometheus next to the celery workers,
+    for hosts that do not run the web app
+    """
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from sketchy.controllers import metrics
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.export()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    HTTPServer((host, port), MetricsHandler).serve_forever()
+
+@manager.option('-p', '--port', dest='port', type=int, default=8910)
+@manager.option('-c', '--concurrency', dest='concurrency', type=int, default=None)
+def renderer(port, concurrency):
+    """
+    Run the PhantomJS renderer shared by the celery workers of this host,
+    point RENDERER_URL at it
+    """
+    from sketchy.controllers import renderer
+
+    renderer.serve(port, concurrency or app.config['RENDERER_CONCURRENCY'], app.config['RENDERER_MAX_PAGES'])
+
 @manager.command
 def list_routes():
     output = []
@@ -41,6 +41,7 @@ setup(
             'redis==2.10.1',
             'lxml==3.3.5',
             'subprocess32==3.2.6',
-            'netaddr==0.7.18'
+            'netaddr==0.7.18',
+            'Pillow==6.2.2'
         ]
 )
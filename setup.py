@@ -42,6 +42,7 @@ setup(
             'MySQL-python==1.2.5',
             'lxml==3.3.5',
             'subprocess32==3.2.6',
-            'netaddr==0.7.18'
+            'netaddr==0.7.18',
+            'Pillow==6.2.2'
         ]
 )
@@ -17,9 +17,10 @@ import os
 
 from functools import wraps
 from celery import Celery
+from kombu import Exchange, Queue
 from flask.ext.restful import Api
 from flask.ext.sqlalchemy import SQLAlchemy
-from flask import Flask, send_from_directory, request, abort
+from flask import Flask, request, abort
 from sqlalchemy.exc import IntegrityError
 from sketchy.loggers import sketchy_logger
 
@@ -33,12 +34,34 @@ sketchy_logger(app)
 # Model Imports
 from sketchy.models.capture import Capture
 from sketchy.models.static import Static
+from sketchy.models.callback import CallbackFailure
+from sketchy.models.fingerprint import HashBand
+
+
+# Kind of work, a key of SKETCHY_QUEUES, done by each task
+TASK_QUEUES = {
+    'eager_capture': 'interactive',
+    'check_url': 'status',
+    'bulk_check_urls': 'status',
+    'celery_capture': 'render',
+    'celery_fused_capture': 'render',
+    'celery_static_capture': 'render',
+    'celery_upload': 'upload',
+    'deliver_callback': 'callback',
+    'flush_callbacks': 'callback'}
 
 
 def make_celery(app):
     """Make a celery object that extends Flask context."""
     celery = Celery(app.import_name, broker=app.config['CELERY_BROKER_URL'])
     celery.conf.update(app.config)
+    # Declare every queue so a worker started without -Q consumes all of them
+    queues = set(app.config['SKETCHY_QUEUES'].values())
+    queues.add(app.config.get('CELERY_DEFAULT_QUEUE', 'celery'))
+    celery.conf.update(
+        CELERY_QUEUES=[Queue(name, Exchange(name), routing_key=name) for name in sorted(queues)],
+        CELERY_ROUTES=dict((task, {'queue': app.config['SKETCHY_QUEUES'][kind]})
+                           for task, kind in TASK_QUEUES.items()))
     TaskBase = celery.Task
 
     class ContextTask(TaskBase):
@@ -54,6 +77,11 @@ def make_celery(app):
         def on_failure(self, exc, task_id, args, kwargs, einfo):
             from sketchy.controllers.tasks import finisher
 
+            # Only capture and static tasks have a record to update
+            if 'capture_id' not in kwargs:
+                app.logger.error(exc)
+                return
+
             # Check if the failures was on a capture or a static capture
             try:
                 if kwargs['model'] == 'capture':
@@ -101,11 +129,16 @@ def app_key_check(view_function):
 flask_api = Api(app, decorators=[app_key_check])
 
 # Setup API calls for sketching urls or html files
-from controllers.controller import CaptureView, CaptureViewList, CaptureViewLast, Eager
+from controllers.controller import CaptureView, CaptureViewList, CaptureViewLast, CaptureBatch, CaptureBatchView, CaptureChanges, CaptureSearch, CaptureSimilar, Eager
 from controllers.static_upload import StaticView, StaticViewList, StaticViewLast
 flask_api.add_resource(CaptureView, '/api/v1.0/capture/<int:id>')
 flask_api.add_resource(CaptureViewList, '/api/v1.0/capture')
 flask_api.add_resource(CaptureViewLast, '/api/v1.0/capture/last')
+flask_api.add_resource(CaptureSearch, '/api/v1.0/capture/search')
+flask_api.add_resource(CaptureChanges, '/api/v1.0/capture/<int:id>/changes')
+flask_api.add_resource(CaptureSimilar, '/api/v1.0/capture/<int:id>/similar', '/api/v1.0/capture/similar')
+flask_api.add_resource(CaptureBatch, '/api/v1.0/capture/batch')
+flask_api.add_resource(CaptureBatchView, '/api/v1.0/capture/batch/<batch_id>')
 flask_api.add_resource(Eager, '/eager')
 flask_api.add_resource(StaticView, '/api/v1.0/static/<int:id>')
 flask_api.add_resource(StaticViewList, '/api/v1.0/static')
@@ -123,8 +156,18 @@ def uploaded_file(filename):
     Route to retrieve a sketch, scrape, or html file when requested.
     If token auth is required, run the app_key_check decorator.
     """
-    return send_from_directory(app.config['LOCAL_STORAGE_FOLDER'],
-                               filename, as_attachment=True)
+    from sketchy.controllers import storage
+    return storage.send_artifact(filename)
+
+
+@app.route('/metrics')
+@app_key_check
+def metrics_export():
+    """
+    Route exporting pipeline timings and task outcomes for Prometheus.
+    """
+    from sketchy.controllers import metrics
+    return metrics.export(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
 
 # Healthcheck
 
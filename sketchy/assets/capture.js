@@ -22,107 +22,10 @@
 // Instead of waiting fixed amount of time before rendering, we give a short
 // time for the page to make additional requests.
 
-var _ = require('./lodash.js');
-var system = require('system');
-var env = system.env;
-var fs = require('fs');
+// The page handling itself lives in page.js, which is shared with the
+// long-lived renderer.js.
 
-
-var defaultOpts = {
-    // How long do we wait for additional requests
-    //after all initial requests have got their response
-    ajaxTimeout: 400,
-
-    // How long do we wait at max
-    maxTimeout: 800
-};
-
-var Page = (function(opts) {
-    opts = _.extend(defaultOpts, opts);
-    var requestCount = 0;
-    var forceRenderTimeout;
-    var ajaxRenderTimeout;
-
-    var page = require('webpage').create();
-    page.viewportSize = {
-        width: opts.width,
-        height: opts.height
-    };
-
-    page.settings.userAgent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1944.0 Safari/537.36';
-    // You can set phantomjs_cookies env variable to send a cookie string
-    var has_cookies = false;
-    var cookie_values;
-    Object.keys(env).forEach(function(key) {
-        if (key === 'phantomjs_cookies'){
-            has_cookies = true;
-            cookie_values = env[key];
-        };
-    });
-
-    if (has_cookies === true) {
-          page.customHeaders = {'Accept-Encoding': ' ', 'Cookie': cookie_values };
-    } else {
-      page.customHeaders = {
-        // Nullify Accept-Encoding header to disable compression (https://github.com/ariya/phantomjs/issues/10930)
-        'Accept-Encoding': ' '
-      };
-    }
-    page.onInitialized = function() {
-        page.customHeaders = {};
-    };
-    // Silence confirmation messages and errors
-    page.onConfirm = page.onPrompt = page.onError = noop;
-
-    page.onResourceRequested = function(request) {
-        requestCount += 1;
-        clearTimeout(ajaxRenderTimeout);
-    };
-
-    page.onResourceError = function(resourceError) {
-        if (!response.stage || response.stage === 'end') {
-            requestCount -= 1;
-            if (requestCount === 0) {
-                ajaxRenderTimeout = setTimeout(renderAndExit, opts.ajaxTimeout);
-            }
-        }
-    };
-
-
-    page.onResourceReceived = function(response) {
-        if (!response.stage || response.stage === 'end') {
-            requestCount -= 1;
-            if (requestCount === 0) {
-                ajaxRenderTimeout = setTimeout(renderAndExit, opts.ajaxTimeout);
-            }
-        }
-    };
-
-    var api = {};
-
-    api.render = function(url, file) {
-        opts.file = file;
-
-        page.open(url, function(status) {
-            if (status !== "success") {
-                console.error('Unable to load url:', url);
-                phantom.exit(1);
-            } else {
-                forceRenderTimeout = setTimeout(renderAndExit, opts.maxTimeout);
-            }
-        });
-    };
-
-    function renderAndExit() {
-        page.render(opts.file + '.png');
-        fs.write(opts.file + '.html', page.content)
-        phantom.exit();
-    }
-
-    function noop() {}
-
-    return api;
-});
+var pages = require('./page.js');
 
 function die(error) {
     console.error(error);
@@ -134,26 +37,44 @@ function main() {
 
     var url = args[1];
     var file = args[2];
-    var width = args[3] || 1280;
-    var height = args[4] || 800;
+    var width = parseInt(args[3] || 1280, 10);
+    var height = parseInt(args[4] || 800, 10);
+    var format = args[5] || 'png';
+    var maxHeight = parseInt(args[6] || 0, 10);
+    var pageOptions = args[7] ? JSON.parse(args[7]) : {};
 
     var isHelp = args[1] === '-h' || args[1] === '--help';
     if (args.length === 1 || isHelp) {
-        var help = 'Usage: phantomjs capture.js <url> <output-file-without-extension> [width] [height]\n';
-        help += 'Example: phantomjs capture.js http://google.com google 1200 800';
+        var help = 'Usage: phantomjs capture.js <url> <output-file-without-extension> [width] [height] [format] [max-height] [page-options]\n';
+        help += 'Example: phantomjs capture.js http://google.com google 1200 800 png 4000 \'{"settle": "adaptive"}\'';
         die(help);
     }
 
     if (!url) die('Url parameter must be specified');
     if (!file) die('File parameter must be specified');
 
-    var opts = {
+    var job = {
+        url: url,
+        sketch: file + '.' + format,
+        html: file + '.html',
         width: width,
-        height: height
+        height: height,
+        maxHeight: maxHeight
     };
+    // Settle and block options are JSON job fields, see page.js
+    for (var name in pageOptions) {
+        job[name] = pageOptions[name];
+    }
 
-    var page = Page(opts);
-    page.render(url, file);
+    pages.render(job, function(error, result) {
+        if (error) {
+            die(error);
+        } else {
+            // The only output of a successful render
+            console.log(JSON.stringify(result));
+            phantom.exit();
+        }
+    });
 }
 
 
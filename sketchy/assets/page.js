@@ -0,0 +1,299 @@
+/*
+ *
+ *  Copyright 2014 Netflix, Inc.
+ *
+ *     Licensed under the Apache License, Version 2.0 (the "License");
+ *     you may not use this file except in compliance with the License.
+ *     You may obtain a copy of the License at
+ *
+ *         http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *     Unless required by applicable law or agreed to in writing, software
+ *     distributed under the License is distributed on an "AS IS" BASIS,
+ *     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ *     See the License for the specific language governing permissions and
+ *     limitations under the License.
+ *
+ */
+// PhantomJS module
+// Renders a single page job. This correctly handles pages which
+// dynamically load content making AJAX requests.
+
+// Instead of waiting fixed amount of time before rendering, we give a short
+// time for the page to make additional requests. In the adaptive settle mode
+// the page is rendered as soon as no request is pending and the DOM has not
+// changed for a short idle window.
+
+// Shared by capture.js and static.js (one page per process) and by
+// renderer.js (long-lived process serving many jobs).
+
+var _ = require('./lodash.js');
+var system = require('system');
+var env = system.env;
+var fs = require('fs');
+
+
+var defaultOpts = {
+    // 'fixed' or 'adaptive'
+    settle: 'fixed',
+
+    // How long do we wait for additional requests
+    //after all initial requests have got their response
+    ajaxTimeout: 400,
+
+    // How long do we wait at max
+    maxTimeout: 800,
+
+    // Adaptive mode renders once the network and the DOM have been idle this long
+    idleTime: 150,
+
+    width: 1280,
+    height: 800,
+
+    // Only render the top maxHeight pixels of the page (0 renders it all)
+    maxHeight: 0,
+
+    // Send the phantomjs_cookies env variable with the first request
+    cookies: true,
+
+    // Abort requests whose URL matches one of these regular expressions,
+    // or whose type (see resourceTypes) is listed
+    blockPatterns: [],
+    blockTypes: [],
+
+    // Give up on the page after this many milliseconds (0 never does, the
+    // caller is then expected to kill the process)
+    timeout: 0
+};
+
+// Resource types told from the extension of a request URL
+var resourceTypes = {
+    font: /\.(woff2?|ttf|otf|eot)([?#]|$)/i,
+    media: /\.(mp4|webm|ogv|ogg|mp3|wav|m4a|m3u8|ts|flv|mov|avi)([?#]|$)/i,
+    image: /\.(png|jpe?g|gif|webp|svg|ico|bmp)([?#]|$)/i,
+    stylesheet: /\.css([?#]|$)/i,
+    script: /\.js([?#]|$)/i
+};
+
+// Render job.url to job.sketch and optionally job.html, then call
+// done(error, result) once the page has been closed. error is null on
+// success and result counts the blocked requests, and tells whether the
+// job timed out.
+exports.render = function(job, done) {
+    // Never extend defaultOpts itself, this module outlives a single job
+    var opts = _.extend({}, defaultOpts, job);
+    var blockPatterns = _.map(opts.blockPatterns, function(pattern) {
+        return new RegExp(pattern, 'i');
+    });
+    var blockedIds = {};
+    var blocked = 0;
+    // Requests for the main document, including the ones it was redirected
+    // or navigated to, are never blocked
+    var mainUrls = {};
+    var mainIds = {1: true};
+    mainUrls[opts.url] = true;
+    var requestCount = 0;
+    var forceRenderTimeout;
+    var ajaxRenderTimeout;
+    var jobTimeout;
+    var timedOut = false;
+    var settleInterval;
+    var lastActivity = Date.now();
+    var adaptive = opts.settle === 'adaptive';
+    var finished = false;
+
+    var page = require('webpage').create();
+    page.viewportSize = {
+        width: opts.width,
+        height: opts.height
+    };
+
+    page.settings.userAgent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1944.0 Safari/537.36';
+    // You can set phantomjs_cookies env variable to send a cookie string
+    var has_cookies = false;
+    var cookie_values;
+    if (opts.cookies) {
+        Object.keys(env).forEach(function(key) {
+            if (key === 'phantomjs_cookies'){
+                has_cookies = true;
+                cookie_values = env[key];
+            };
+        });
+    }
+
+    if (has_cookies === true) {
+          page.customHeaders = {'Accept-Encoding': ' ', 'Cookie': cookie_values };
+    } else {
+      page.customHeaders = {
+        // Nullify Accept-Encoding header to disable compression (https://github.com/ariya/phantomjs/issues/10930)
+        'Accept-Encoding': ' '
+      };
+    }
+    page.onInitialized = function() {
+        page.customHeaders = {};
+    };
+    // Silence confirmation messages and errors
+    page.onConfirm = page.onPrompt = page.onError = noop;
+
+    page.onNavigationRequested = function(url, type, willNavigate, main) {
+        if (main && willNavigate) {
+            mainUrls[url] = true;
+        }
+    };
+
+    page.onResourceRequested = function(request, networkRequest) {
+        if (mainUrls[request.url]) {
+            mainIds[request.id] = true;
+        }
+        // Never block the page itself
+        if (!mainIds[request.id] && isBlocked(request.url)) {
+            blockedIds[request.id] = true;
+            blocked += 1;
+            networkRequest.abort();
+            return;
+        }
+        requestCount += 1;
+        lastActivity = Date.now();
+        clearTimeout(ajaxRenderTimeout);
+    };
+
+    page.onResourceError = function(resourceError) {
+        if (!blockedIds[resourceError.id]) {
+            requestDone();
+        }
+    };
+
+    page.onResourceReceived = function(response) {
+        if (mainIds[response.id] && response.redirectURL) {
+            mainUrls[absoluteUrl(response.redirectURL, response.url)] = true;
+        }
+        if ((!response.stage || response.stage === 'end') && !blockedIds[response.id]) {
+            requestDone();
+        }
+    };
+
+    // Resolve the target of a redirect, which may be relative, against base
+    function absoluteUrl(url, base) {
+        if (/^[a-z][a-z0-9+.\-]*:/i.test(url)) {
+            return url;
+        }
+        var origin = /^([a-z][a-z0-9+.\-]*:)\/\/[^\/?#]*/i.exec(base);
+        if (!origin) {
+            return url;
+        }
+        if (url.indexOf('//') === 0) {
+            return origin[1] + url;
+        }
+        if (url.charAt(0) === '/') {
+            return origin[0] + url;
+        }
+        return base.split(/[?#]/)[0].replace(/[^\/]*$/, '') + url;
+    }
+
+    function isBlocked(url) {
+        return _.some(blockPatterns, function(pattern) {
+            return pattern.test(url);
+        }) || _.some(opts.blockTypes, function(type) {
+            return resourceTypes[type] && resourceTypes[type].test(url.split(/[?#]/)[0]);
+        });
+    }
+
+    if (opts.timeout) {
+        jobTimeout = setTimeout(function() {
+            timedOut = true;
+            finish('Render timed out after ' + opts.timeout + 'ms');
+        }, opts.timeout);
+    }
+
+    page.open(opts.url, function(status) {
+        if (status !== "success") {
+            finish('Unable to load url: ' + opts.url);
+        } else {
+            forceRenderTimeout = setTimeout(renderAndFinish, opts.maxTimeout);
+            if (adaptive) {
+                watchMutations();
+                settleInterval = setInterval(renderIfSettled, Math.max(Math.min(opts.idleTime / 3, 50), 10));
+            }
+        }
+    });
+
+    function requestDone() {
+        requestCount -= 1;
+        lastActivity = Date.now();
+        if (requestCount === 0 && !adaptive) {
+            ajaxRenderTimeout = setTimeout(renderAndFinish, opts.ajaxTimeout);
+        }
+    }
+
+    // Remember when the DOM last changed, pages without MutationObserver
+    // only wait for the network
+    function watchMutations() {
+        page.evaluate(function() {
+            var Observer = window.MutationObserver || window.WebKitMutationObserver;
+            window.__sketchyLastMutation = Date.now();
+            if (Observer) {
+                new Observer(function() {
+                    window.__sketchyLastMutation = Date.now();
+                }).observe(document, {childList: true, subtree: true, attributes: true, characterData: true});
+            }
+        });
+    }
+
+    function renderIfSettled() {
+        if (requestCount > 0) {
+            return;
+        }
+        var lastMutation = page.evaluate(function() {
+            return window.__sketchyLastMutation || 0;
+        });
+        if (Date.now() - Math.max(lastActivity, lastMutation) >= opts.idleTime) {
+            renderAndFinish();
+        }
+    }
+
+    function renderAndFinish() {
+        if (finished) {
+            return;
+        }
+        if (opts.maxHeight) {
+            var pageHeight = page.evaluate(function() {
+                return document.documentElement.scrollHeight;
+            });
+            page.clipRect = {
+                top: 0,
+                left: 0,
+                width: opts.width,
+                height: Math.min(opts.maxHeight, pageHeight || opts.maxHeight)
+            };
+        }
+        // The image format follows the extension of job.sketch
+        page.render(opts.sketch);
+        if (opts.html) {
+            fs.write(opts.html, page.content, 'w');
+        }
+        finish(null);
+    }
+
+    function finish(error) {
+        if (finished) {
+            return;
+        }
+        finished = true;
+        clearTimeout(forceRenderTimeout);
+        clearTimeout(ajaxRenderTimeout);
+        clearTimeout(jobTimeout);
+        clearInterval(settleInterval);
+        // Close outside of the page callbacks that got us here
+        setTimeout(function() {
+            // PhantomJS keeps one cookie jar per process, never leave this
+            // page's cookies to the next job of a long-lived renderer. Third
+            // party cookies are left to the renderer, they may belong to
+            // the other pages it is rendering.
+            page.clearCookies();
+            page.close();
+            done(error, {blocked: blocked, timedOut: timedOut});
+        }, 0);
+    }
+
+    function noop() {}
+};
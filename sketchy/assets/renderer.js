@@ -0,0 +1,155 @@
+/*
+ *
+ *  Copyright 2014 Netflix, Inc.
+ *
+ *     Licensed under the Apache License, Version 2.0 (the "License");
+ *     you may not use this file except in compliance with the License.
+ *     You may obtain a copy of the License at
+ *
+ *         http://www.apache.org/licenses/LICENSE-2.0
+ *
+ *     Unless required by applicable law or agreed to in writing, software
+ *     distributed under the License is distributed on an "AS IS" BASIS,
+ *     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ *     See the License for the specific language governing permissions and
+ *     limitations under the License.
+ *
+ */
+// PhantomJS script
+// Long-lived renderer. Instead of booting PhantomJS for every capture,
+// sketchy keeps this process around and submits render jobs to it over a
+// local HTTP control channel:
+//
+//   GET  /   -> {"status": "ok"} once the renderer is ready
+//   POST /   -> JSON job (see page.js), answered with
+//               {"status": "success", "blocked": n} or
+//               {"status": "fail", "error": "...", "timeout": true|false}
+//               after the page has been rendered
+//
+// Up to <concurrency> pages are rendered at once, each in its own webpage.
+// Jobs wait in a local queue, and two pages of the same host never run
+// together since PhantomJS keeps a single cookie jar per process. Third
+// party cookies, e.g. of trackers, are still shared by the pages rendering
+// at the same time, the jar is only emptied whenever the renderer is idle.
+// A job with a timeout (ms) fails once it has waited and rendered that long.
+// After <max-pages> jobs the renderer refuses new jobs with
+// {"status": "fail", "retry": true} and exits once idle, to be restarted.
+
+var pages = require('./page.js');
+var system = require('system');
+var server = require('webserver').create();
+
+var queue = [];
+var activeHosts = {};
+var active = 0;
+var accepted = 0;
+var concurrency = 1;
+var maxPages = 0;
+
+function respond(response, result) {
+    var body = JSON.stringify(result);
+    response.statusCode = 200;
+    response.headers = {'Content-Type': 'application/json'};
+    response.write(body);
+    response.close();
+}
+
+function hostOf(url) {
+    var match = /^[a-z]+:\/\/([^\/?#]*)/i.exec(url);
+    return match ? match[1].toLowerCase() : url;
+}
+
+// Start queued jobs while there are free pages, skipping jobs whose host
+// already has a page open
+function pump() {
+    var i = 0;
+    while (i < queue.length && active < concurrency) {
+        var entry = queue[i];
+        if (activeHosts[entry.host]) {
+            i += 1;
+            continue;
+        }
+        queue.splice(i, 1);
+        start(entry);
+    }
+    if (maxPages && accepted >= maxPages && active === 0 && queue.length === 0) {
+        phantom.exit(0);
+    }
+}
+
+function start(entry) {
+    var job = entry.job;
+    if (entry.deadline) {
+        var left = entry.deadline - Date.now();
+        if (left <= 0) {
+            respond(entry.response, {status: 'fail', error: 'Render job timed out in the queue', timeout: true});
+            return;
+        }
+        job.timeout = left;
+    }
+    active += 1;
+    activeHosts[entry.host] = true;
+    pages.render(job, function(error, result) {
+        active -= 1;
+        delete activeHosts[entry.host];
+        if (active === 0) {
+            // Pages only clear the cookies of their own URL, never leave
+            // third party cookies to the next jobs
+            phantom.clearCookies();
+        }
+        if (error) {
+            respond(entry.response, {status: 'fail', error: error, timeout: result.timedOut});
+        } else {
+            respond(entry.response, {status: 'success', blocked: result.blocked});
+        }
+        pump();
+    });
+}
+
+function main() {
+    var args = system.args;
+    var port = args[1];
+    concurrency = parseInt(args[2] || 1, 10);
+    maxPages = parseInt(args[3] || 0, 10);
+
+    if (!port) {
+        console.error('Usage: phantomjs renderer.js <port> [concurrency] [max-pages]');
+        phantom.exit(1);
+    }
+
+    var listening = server.listen('127.0.0.1:' + port, function(request, response) {
+        if (request.method !== 'POST') {
+            respond(response, {status: 'ok'});
+            return;
+        }
+
+        var job;
+        try {
+            job = JSON.parse(request.post);
+        } catch (err) {
+            respond(response, {status: 'fail', error: 'Invalid render job'});
+            return;
+        }
+
+        if (maxPages && accepted >= maxPages) {
+            respond(response, {status: 'fail', error: 'Renderer is recycling', retry: true});
+            return;
+        }
+        accepted += 1;
+        queue.push({
+            job: job,
+            host: hostOf(job.url),
+            deadline: job.timeout ? Date.now() + job.timeout : 0,
+            response: response
+        });
+        pump();
+    });
+
+    if (!listening) {
+        console.error('Unable to listen on port ' + port);
+        phantom.exit(1);
+    }
+}
+
+
+main();
@@ -16,83 +16,13 @@
  *
  */
 // PhantomJS script
-// Takes screenshot of a given page. This correctly handles pages which
-// dynamically load content making AJAX requests.
+// Takes screenshot of a given static html file. This correctly handles pages
+// which dynamically load content making AJAX requests.
 
-// Instead of waiting fixed amount of time before rendering, we give a short
-// time for the page to make additional requests.
+// The page handling itself lives in page.js, which is shared with the
+// long-lived renderer.js.
 
-var _ = require('./lodash.js');
-var fs = require('fs');
-
-var defaultOpts = {
-    // How long do we wait for additional requests
-    //after all initial requests have got their response
-    ajaxTimeout: 400,
-
-    // How long do we wait at max
-    maxTimeout: 800
-};
-
-var Page = (function(opts) {
-    opts = _.extend(defaultOpts, opts);
-    var requestCount = 0;
-    var forceRenderTimeout;
-    var ajaxRenderTimeout;
-
-    var page = require('webpage').create();
-    page.viewportSize = {
-        width: opts.width,
-        height: opts.height
-    };
-    page.settings.userAgent = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1944.0 Safari/537.36';
-    page.customHeaders = {
-      // Nullify Accept-Encoding header to disable compression (https://github.com/ariya/phantomjs/issues/10930)
-      'Accept-Encoding': ' ',
-    };
-    page.onInitialized = function() {
-        page.customHeaders = {};
-    };
-    // Silence confirmation messages and errors
-    page.onConfirm = page.onPrompt = page.onError = noop;
-
-    page.onResourceRequested = function(request) {
-        requestCount += 1;
-        clearTimeout(ajaxRenderTimeout);
-    };
-
-    page.onResourceReceived = function(response) {
-        if (!response.stage || response.stage === 'end') {
-            requestCount -= 1;
-            if (requestCount === 0) {
-                ajaxRenderTimeout = setTimeout(renderAndExit, opts.ajaxTimeout);
-            }
-        }
-    };
-
-    var api = {};
-
-    api.render = function(fullname, file) {
-        opts.file = file;
-        page.open(fullname, function(status) {
-            if (status !== "success") {
-                console.error('Unable to load path:', fullname);
-                phantom.exit(1);
-            } else {
-                forceRenderTimeout = setTimeout(renderAndExit, opts.maxTimeout);
-            }
-        });
-    };
-
-    function renderAndExit() {
-        page.render(opts.file);
-        phantom.exit();
-    }
-
-    function noop() {}
-
-    return api;
-});
+var pages = require('./page.js');
 
 function die(error) {
     console.error(error);
@@ -105,10 +35,13 @@ function main() {
     var file_path = args[1] + '/';
     var file_name = args[2];
     var fullname = file_path.concat(file_name)
+    var format = args[3] || 'png';
+    var maxHeight = parseInt(args[4] || 0, 10);
+    var pageOptions = args[5] ? JSON.parse(args[5]) : {};
 
     var isHelp = args[1] === '-h' || args[1] === '--help';
     if (args.length === 1 || isHelp) {
-        var help = 'Usage: phantomjs static.js <filepath> <filename>\n';
+        var help = 'Usage: phantomjs static.js <filepath> <filename> [format] [max-height] [page-options]\n';
         help += 'Example: phantomjs static.js /foo/bar index.html';
         die(help);
     }
@@ -116,14 +49,28 @@ function main() {
     if (!file_path) die('Filepath parameter must be specified');
     if (!file_name) die('Filename parameter must be specified');
 
-    var opts = {
+    var job = {
+        url: fullname,
+        sketch: file_path  + file_name.replace(/\.[^.]*$/, '')  + "." + format,
         width: 1200,
-        height: 800
+        height: 800,
+        maxHeight: maxHeight,
+        cookies: false
     };
-    var file = file_path  + file_name.split('.')[0]  + ".png"
+    // Settle and block options are JSON job fields, see page.js
+    for (var name in pageOptions) {
+        job[name] = pageOptions[name];
+    }
 
-    var page = Page(opts);
-    page.render(fullname, file);
+    pages.render(job, function(error, result) {
+        if (error) {
+            die(error);
+        } else {
+            // The only output of a successful render
+            console.log(JSON.stringify(result));
+            phantom.exit();
+        }
+    });
 }
 
 
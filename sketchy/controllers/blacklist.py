@@ -0,0 +1,88 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import socket
+import threading
+import time
+import urlparse
+
+import netaddr
+from sketchy import app
+
+# IP_BLACKLISTING_RANGE compiled into an IPSet, rebuilt when the setting changes.
+# Membership tests cost at most one lookup per prefix length (32 for IPv4,
+# 128 for IPv6) however many ranges are blacklisted.
+_compiled_ranges = None
+_compiled_set = netaddr.IPSet()
+
+# host -> (expiry, addresses), shared by the threads of a process
+_dns_cache = {}
+_dns_lock = threading.Lock()
+
+
+def blacklisted_ranges():
+    """
+    Return the configured blacklist as an IPSet.
+    """
+    global _compiled_ranges, _compiled_set
+    ranges = app.config['IP_BLACKLISTING_RANGE']
+    if ranges != _compiled_ranges:
+        _compiled_set = netaddr.IPSet(cidr.strip() for cidr in ranges.split(',') if cidr.strip())
+        _compiled_ranges = ranges
+    return _compiled_set
+
+
+def resolve(host):
+    """
+    Return the IPv4 and IPv6 addresses of a host, cached for DNS_CACHE_TTL seconds.
+    """
+    now = time.time()
+    with _dns_lock:
+        cached = _dns_cache.get(host)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    try:
+        addresses = sorted(set(info[4][0].split('%')[0] for info in socket.getaddrinfo(host, None)))
+    except socket.error:
+        addresses = []
+
+    with _dns_lock:
+        if len(_dns_cache) >= app.config['DNS_CACHE_SIZE']:
+            for expired in [key for key, value in _dns_cache.items() if value[0] <= now]:
+                del _dns_cache[expired]
+            if len(_dns_cache) >= app.config['DNS_CACHE_SIZE']:
+                _dns_cache.clear()
+        _dns_cache[host] = (now + app.config['DNS_CACHE_TTL'], addresses)
+    return addresses
+
+
+def blacklisted_ip(url):
+    """
+    Return the first address of the host of url that falls in a blacklisted
+    range, or None if IP blacklisting is disabled or the host is allowed.
+    """
+    if not app.config['IP_BLACKLISTING'] or not url:
+        return None
+    try:
+        host = urlparse.urlsplit(url.strip()).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+
+    ranges = blacklisted_ranges()
+    for address in resolve(host):
+        if netaddr.IPAddress(address) in ranges:
+            return address
+    return None
@@ -0,0 +1,56 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import json
+import re
+
+from sketchy import app
+
+# Resource types page.js tells from the extension of a request URL
+TYPES = ('font', 'media', 'image', 'stylesheet', 'script')
+
+# Block options a request may set, parsed from its JSON body or form
+OPTIONS = ('block',)
+
+
+def add_arguments(parser, location):
+    """
+    Add the block list option to a request parser.
+    """
+    parser.add_argument('block', type=str, choices=sorted(app.config['BLOCK_LISTS']), required=False, location=location)
+
+
+def block_list(the_record):
+    """
+    Return the name of the block list of a record, a request value overrides BLOCK_LIST.
+    """
+    name = app.config['BLOCK_LIST']
+    if getattr(the_record, 'render_options', None):
+        name = json.loads(the_record.render_options).get('block', name)
+    return name
+
+
+def job_options(name):
+    """
+    Return a block list as the fields of a page.js render job.
+
+    Hosts block the host and its subdomains, patterns are regular
+    expressions matched against the full request URL.
+    """
+    rules = app.config['BLOCK_LISTS'].get(name) or {}
+    patterns = list(rules.get('patterns', []))
+    if rules.get('hosts'):
+        patterns.append(r'^[a-z]+://([^/?#@]*@)?([^/?#@]*\.)?({})(:\d+)?([/?#]|$)'.format(
+            '|'.join(re.escape(host) for host in rules['hosts'])))
+    return {'blockPatterns': patterns,
+            'blockTypes': [kind for kind in rules.get('types', []) if kind in TYPES]}
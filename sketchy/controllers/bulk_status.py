@@ -0,0 +1,86 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import itertools
+import os
+import threading
+import urlparse
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from sketchy import app
+from sketchy.controllers import politeness, status
+
+
+def _host(url):
+    try:
+        return (urlparse.urlsplit(url).hostname or url).lower()
+    except ValueError:
+        return url
+
+
+def _interleave(urls):
+    """
+    Order the (id, url) items of a {id: url} dict round robin over their
+    hosts, so the checks of a busy host do not hold every thread at once.
+    """
+    by_host = OrderedDict()
+    for capture_id, url in sorted(urls.items()):
+        by_host.setdefault(_host(url), []).append((capture_id, url))
+    return [item for items in itertools.izip_longest(*by_host.values())
+            for item in items if item is not None]
+
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    """
+    Return the status check threads of the current process.
+
+    The threads keep their status sessions, and so their connections,
+    from one batch to the next.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(app.config['BULK_STATUS_CONCURRENCY'])
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def check_all(urls, cookies=None, leases=None):
+    """
+    Check the status of every URL of a {id: url} dict concurrently.
+
+    At most BULK_STATUS_PER_HOST requests are sent to a host at once, and
+    the politeness leases of a {id: lease} dict are released as soon as the
+    check of their URL is done.
+    Returns a {id: result} dict where result is the status code of the URL,
+    or the exception raised while checking it.
+    """
+    leases = leases or {}
+    limits = dict((_host(url), threading.BoundedSemaphore(app.config['BULK_STATUS_PER_HOST']))
+                  for url in urls.values())
+
+    def check(item):
+        capture_id, url = item
+        with limits[_host(url)]:
+            try:
+                return capture_id, status.get_status_code(url, cookies=cookies)
+            except Exception as err:
+                return capture_id, err
+            finally:
+                politeness.release(leases.get(capture_id))
+
+    return dict(get_pool().imap_unordered(check, _interleave(urls)))
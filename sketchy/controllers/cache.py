@@ -0,0 +1,73 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import datetime
+
+from sketchy import db, app
+from sketchy.controllers import storage
+from sketchy.models.capture import Capture
+
+# capture_status prefixes of the records reusing the artifacts of another capture
+REUSED_PREFIXES = ('CACHED_FROM:', 'UNCHANGED_FROM:')
+
+
+def find_cached_capture(url_hash, render_options=None):
+    """
+    Return the latest completed capture of a URL within CAPTURE_CACHE_TTL seconds
+    that was rendered with the same options.
+
+    Only captures that rendered the page count, records pointing at the
+    artifacts of another capture would otherwise keep the artifacts of the
+    first render fresh forever. Returns None when the cache is disabled or
+    there is no such capture.
+    """
+    ttl = app.config['CAPTURE_CACHE_TTL']
+    if not ttl:
+        return None
+    since = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+    return Capture.query.filter(
+        Capture.url_hash == url_hash,
+        Capture.job_status == 'COMPLETED',
+        Capture.sketch_url != None,
+        Capture.render_options == render_options,
+        db.or_(Capture.capture_status == None, db.not_(db.or_(*[
+            Capture.capture_status.startswith(prefix) for prefix in REUSED_PREFIXES]))),
+        Capture.modified_at >= since).order_by(Capture.id.desc()).first()
+
+
+def reuse_capture(cached_record, capture_record):
+    """
+    Point capture_record at the artifacts of cached_record instead of capturing again.
+    """
+    capture_record.sketch_url = cached_record.sketch_url
+    capture_record.scrape_url = cached_record.scrape_url
+    capture_record.html_url = cached_record.html_url
+    capture_record.thumbnail_url = cached_record.thumbnail_url
+    capture_record.url_response_code = cached_record.url_response_code
+    capture_record.capture_status = 'CACHED_FROM:{}'.format(cached_record.id)
+    capture_record.job_status = 'COMPLETED'
+    db.session.add(capture_record)
+    db.session.commit()
+
+
+def local_artifact(artifact_url):
+    """
+    Return the local file name of an artifact URL served by /files, or None.
+    """
+    prefix = app.config['BASE_URL'] + '/files/'
+    if not artifact_url or not artifact_url.startswith(prefix):
+        return None
+    filename = artifact_url[len(prefix):]
+    if storage.find_artifact(filename) is None:
+        return None
+    return filename
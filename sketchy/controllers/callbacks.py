@@ -0,0 +1,197 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import hashlib
+import json
+import os
+import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sketchy import db, app, celery
+from sketchy.models.capture import Capture
+from sketchy.models.static import Static
+from sketchy.models.callback import CallbackFailure
+from sketchy.controllers import metrics, status
+from sketchy.controllers.redis_client import get_redis
+
+MODELS = {'capture': Capture, 'static': Static}
+
+# Session.info key of the callbacks waiting for the session to commit
+PENDING_KEY = 'sketchy_pending_callbacks'
+
+# Keep-alive sessions per callback host, owned by a single process
+_sessions = {}
+_sessions_pid = None
+
+
+def get_session(callback):
+    """
+    Return the keep-alive session used for callbacks to the host of callback.
+    """
+    global _sessions, _sessions_pid
+    if _sessions_pid != os.getpid():
+        _sessions = {}
+        _sessions_pid = os.getpid()
+    parts = urlparse.urlsplit(callback)
+    host = (parts.scheme, parts.netloc)
+    if host not in _sessions:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=app.config['CALLBACK_POOL_SIZE'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.cookies.set_policy(status.REJECT_COOKIES)
+        _sessions[host] = session
+    return _sessions[host]
+
+
+def post_callback(callback, payload):
+    """
+    POST a JSON payload to a callback URL, raising on 4xx and 5xx responses.
+    """
+    headers = {'Content-type': 'application/json', 'Accept': 'text/plain'}
+    with metrics.timer('callback'):
+        response = get_session(callback).post(callback,
+                                              data=json.dumps(payload),
+                                              headers=headers,
+                                              verify=app.config['SSL_HOST_VALIDATION'],
+                                              timeout=app.config['CALLBACK_TIMEOUT'])
+        response.raise_for_status()
+
+
+def _buffer_key(callback):
+    if isinstance(callback, unicode):
+        callback = callback.encode('utf-8')
+    return 'sketchy:callbacks:{}'.format(hashlib.sha1(callback).hexdigest())
+
+
+def enqueue(the_record, after_commit=False):
+    """
+    Hand the callback of a finished record to the callback workers.
+
+    The payload is taken now, so the record must be in its final state.
+    Pass after_commit=True while the record still has to be committed, the
+    callback is then only sent once the session commits, and dropped if it
+    rolls back, so callback workers never see the record before its state.
+    With CALLBACK_BATCH_SIZE above 1 entries are buffered in redis per
+    callback URL and POSTed together as a list.
+    """
+    entry = {'model': 'static' if isinstance(the_record, Static) else 'capture',
+             'id': the_record.id,
+             'payload': the_record.as_dict()}
+    if after_commit:
+        db.session.info.setdefault(PENDING_KEY, []).append((the_record.callback, entry))
+        return
+    dispatch(the_record.callback, entry)
+
+
+def dispatch(callback, entry):
+    """
+    Send a callback entry to the callback workers.
+    """
+    batch_size = app.config['CALLBACK_BATCH_SIZE']
+    if batch_size <= 1:
+        deliver_callback.apply_async(args=[callback, [entry]])
+        return
+
+    client = get_redis()
+    key = _buffer_key(callback)
+    window = app.config['CALLBACK_BATCH_WINDOW']
+    if client.rpush(key, json.dumps(entry)) >= batch_size:
+        flush_callbacks.apply_async(args=[callback])
+    elif client.set(key + ':scheduled', 1, px=int(window * 1000), nx=True):
+        flush_callbacks.apply_async(args=[callback], countdown=window)
+
+
+@event.listens_for(Session, 'after_commit')
+def dispatch_pending(session):
+    """
+    Send the callbacks enqueued with after_commit once their records are committed.
+    """
+    for callback, entry in session.info.pop(PENDING_KEY, []):
+        dispatch(callback, entry)
+
+
+@event.listens_for(Session, 'after_rollback')
+def drop_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+@celery.task(name='flush_callbacks', ignore_result=True)
+def flush_callbacks(callback):
+    """
+    Deliver up to CALLBACK_BATCH_SIZE buffered entries of a callback URL in one POST.
+    """
+    client = get_redis()
+    key = _buffer_key(callback)
+    batch_size = app.config['CALLBACK_BATCH_SIZE']
+
+    pipe = client.pipeline()
+    pipe.lrange(key, 0, batch_size - 1)
+    pipe.ltrim(key, batch_size, -1)
+    pipe.llen(key)
+    entries, _, remaining = pipe.execute()
+
+    if entries:
+        deliver_callback.apply_async(args=[callback, [json.loads(entry) for entry in entries], True])
+    if remaining:
+        flush_callbacks.apply_async(args=[callback])
+
+
+@celery.task(name='deliver_callback', ignore_result=True, bind=True)
+def deliver_callback(self, callback, entries, batched=False):
+    """
+    POST finished records to their callback URL.
+
+    Failed deliveries are retried with exponential backoff, after
+    CALLBACK_MAX_RETRIES attempts they are written to the CallbackFailure
+    dead letter table and their records are marked as failed.
+    """
+    payload = [entry['payload'] for entry in entries] if batched else entries[0]['payload']
+    try:
+        post_callback(callback, payload)
+    except requests.RequestException as err:
+        app.logger.error(err)
+        retries = self.request.retries
+        if retries < app.config['CALLBACK_MAX_RETRIES']:
+            countdown = min(app.config['CALLBACK_BACKOFF'] * 2 ** retries, app.config['CALLBACK_MAX_BACKOFF'])
+            raise self.retry(exc=err, countdown=countdown, max_retries=app.config['CALLBACK_MAX_RETRIES'])
+
+        for entry in entries:
+            failure = CallbackFailure()
+            failure.model = entry['model']
+            failure.record_id = entry['id']
+            failure.callback = callback
+            failure.payload = json.dumps(entry['payload'])
+            failure.error = str(err)[:512]
+            failure.attempts = retries + 1
+            db.session.add(failure)
+        _update_records(entries, job_status='FAILURE', capture_status=str(err)[:512])
+        db.session.commit()
+        return
+
+    # Update the records and save to database
+    _update_records(entries, job_status='COMPLETED')
+    db.session.commit()
+
+
+def _update_records(entries, **values):
+    """
+    Bulk update the records of a list of callback entries.
+    """
+    for model, model_class in MODELS.items():
+        ids = [entry['id'] for entry in entries if entry['model'] == model]
+        if ids:
+            model_class.query.filter(model_class.id.in_(ids)).update(values, synchronize_session=False)
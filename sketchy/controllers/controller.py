@@ -11,25 +11,94 @@
 #     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
+import json
 import tasks
+import uuid
 
 from sketchy import db, app
 from sketchy.models.capture import Capture
-from sketchy.controllers.validators import check_url, grab_domain
-from flask import send_from_directory
-from flask.ext.restful import Resource, reqparse
-from celery import chain
+from sketchy.controllers import blacklist, blocking, cache, callbacks, fingerprint, images, search, settle, storage
+from sketchy.controllers.paging import list_parser, next_page_link, page_limit, paginate
+from sketchy.controllers.redis_client import get_redis
+from sketchy.controllers.validators import grab_domain, url_hash, url_list
+from flask.ext.restful import Resource, reqparse, types
+from celery import chain, group
+from celery.exceptions import TimeoutError
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 # Request parser for API calls to Payload model
 JSONPARSER = reqparse.RequestParser()
 JSONPARSER.add_argument('url', type=str, required=True, help="URL Cannot Be Blank", location='json')
 JSONPARSER.add_argument('status_only', type=bool, required=False, location='json')
 JSONPARSER.add_argument('callback', type=str, required=False, location='json')
+JSONPARSER.add_argument('force', type=bool, required=False, location='json')
+JSONPARSER.add_argument('priority', type=str, default='normal', choices=sorted(app.config['TASK_PRIORITIES']), location='json')
+images.add_arguments(JSONPARSER, 'json')
+settle.add_arguments(JSONPARSER, 'json')
+blocking.add_arguments(JSONPARSER, 'json')
+
+BATCHPARSER = reqparse.RequestParser()
+BATCHPARSER.add_argument('urls', type=url_list, required=True, help="URLs must be a list of URLs", location='json')
+BATCHPARSER.add_argument('status_only', type=bool, required=False, location='json')
+BATCHPARSER.add_argument('callback', type=str, required=False, location='json')
+BATCHPARSER.add_argument('priority', type=str, default='low', choices=sorted(app.config['TASK_PRIORITIES']), location='json')
+images.add_arguments(BATCHPARSER, 'json')
+settle.add_arguments(BATCHPARSER, 'json')
+blocking.add_arguments(BATCHPARSER, 'json')
+
+CAPTURELISTPARSER = list_parser()
+CAPTURELISTPARSER.add_argument('url', type=str, required=False, location='args')
+CAPTURELISTPARSER.add_argument('domain', type=str, required=False, location='args')
 
 EAGERPARSER = reqparse.RequestParser()
 EAGERPARSER.add_argument('url', type=str, required=True, help="URL cannot be blank", location='args')
 EAGERPARSER.add_argument('type', type=str, required=True, help="Type of capture must be set: html, sketch, or scrape", location='args')
+EAGERPARSER.add_argument('force', type=types.boolean, required=False, location='args')
+
+SEARCHPARSER = reqparse.RequestParser()
+SEARCHPARSER.add_argument('q', type=unicode, required=True, help="Search query cannot be blank", location='args')
+SEARCHPARSER.add_argument('limit', type=types.positive, required=False, location='args')
+SEARCHPARSER.add_argument('offset', type=types.natural, default=0, location='args')
+
+SIMILARPARSER = reqparse.RequestParser()
+SIMILARPARSER.add_argument('type', type=str, default='sketch', choices=fingerprint.KINDS, location='args')
+SIMILARPARSER.add_argument('hash', type=str, required=False, location='args')
+SIMILARPARSER.add_argument('distance', type=fingerprint.max_distance, default=fingerprint.MAX_DISTANCE, location='args')
+SIMILARPARSER.add_argument('limit', type=types.positive, default=20, location='args')
+
+# Capture record attribute holding the URL of each capture type
+ARTIFACT_URLS = {'html': 'html_url', 'sketch': 'sketch_url', 'scrape': 'scrape_url'}
+
+# Redis key of the in-flight eager render of a URL hash
+EAGER_KEY = 'sketchy:eager:{}'
+
+
+def domain_or_none(url):
+    """
+    Return the lowercased domain of a URL, or None if it can't be parsed.
+    """
+    try:
+        return grab_domain(url).lower()
+    except Exception:
+        return None
+
+
+def capture_signature(capture_id, status_only, base_url, priority='normal'):
+    """
+    Return the celery signature that populates a capture record.
+
+    Status only captures just check the URL, all other captures first check if
+    the URL is valid, then sketch, scrape, and store files, either as a chain
+    of tasks or as a single fused task. Every task is sent with the message
+    priority of priority, a key of TASK_PRIORITIES, and routed by make_celery.
+    """
+    options = {'priority': app.config['TASK_PRIORITIES'][priority]}
+    if status_only is True:
+        return tasks.check_url.si(capture_id=capture_id, model='capture').set(**options)
+    if app.config['FUSED_PIPELINE']:
+        return tasks.celery_fused_capture.si(base_url, capture_id=capture_id, model='capture').set(**options)
+    return chain(tasks.check_url.s(capture_id=capture_id, model='capture').set(**options),
+                 tasks.celery_capture.s(base_url, capture_id=capture_id, model='capture').set(**options))
 
 
 class CaptureView(Resource):
@@ -96,13 +165,18 @@ class CaptureViewList(Resource):
     """
     def get(self):
         """
-        Retrieve all sketch records the database
+        Retrieve a page of sketch records from the database
+
+        Supports limit, after_id, job_status, url, domain, created_after and created_before
         """
-        results = []
-        for row in Capture.query.order_by(Capture.id.desc()).all():
-            results.append(row.as_dict())
+        args = CAPTURELISTPARSER.parse_args()
+        query = Capture.query
+        if args['url']:
+            query = query.filter(Capture.url_hash == url_hash(args['url']))
+        if args['domain']:
+            query = query.filter(Capture.domain == args['domain'].lower())
 
-        return results
+        return paginate(query, Capture, args)
 
     def post(self):
         """
@@ -115,8 +189,11 @@ class CaptureViewList(Resource):
         args = JSONPARSER.parse_args()
         capture_record = Capture()
         capture_record.url = args["url"]
+        capture_record.url_hash = url_hash(args["url"])
+        capture_record.domain = domain_or_none(args["url"])
         capture_record.status_only = args["status_only"]
         capture_record.callback = args["callback"]
+        capture_record.render_options = images.request_options(args)
 
         # Add the capture_record and commit to the DB
         try:
@@ -128,25 +205,222 @@ class CaptureViewList(Resource):
         # Refresh capture_record to obtain an ID for record
         db.session.refresh(capture_record)
 
+        # Reuse a recent capture of the same URL unless the requestor forces a new one
+        if not capture_record.status_only and not args["force"]:
+            cached_record = cache.find_cached_capture(capture_record.url_hash, capture_record.render_options)
+            if cached_record is not None:
+                cache.reuse_capture(cached_record, capture_record)
+                # Never wait on the callback receiver, the callback workers retry it
+                if capture_record.callback:
+                    callbacks.enqueue(capture_record)
+                return capture_record.as_dict(), 201
+
         # If status_only flag enabled, just capture status code from URL
-        if capture_record.status_only is True:
-            tasks.check_url.delay(capture_id=capture_record.id)
-        else:
-            # If the application is configured for S3 store contents in a bucket
-            # This will first check if URL is valid, then sketch, scrape, and store files
-            celery_sketch = chain(tasks.check_url.s(capture_id=capture_record.id, model='capture'),
-                                  tasks.celery_capture.s(base_url, capture_id=capture_record.id, model='capture')
-                                  ).apply_async()
+        # otherwise check the URL, then sketch, scrape, and store files
+        capture_signature(capture_record.id, capture_record.status_only, base_url, args['priority']).apply_async()
 
         # Commit all changes to DB and return JSON
         db.session.commit()
         return capture_record.as_dict(), 201
 
 
+class CaptureBatch(Resource):
+    """
+    API Provides bulk submission of Captures.
+
+    All records of a batch are inserted with a single statement and their
+    tasks are dispatched as one celery group.
+
+    Methods:
+    POST
+    """
+    def post(self):
+        """
+        Create a capture record for every URL and call celery tasks for populating record data
+        """
+        base_url = app.config['BASE_URL']
+
+        args = BATCHPARSER.parse_args()
+        urls = args['urls']
+        if not urls:
+            return {'message': 'URLs must be a list of URLs'}, 400
+        if len(urls) > app.config['BATCH_MAX_URLS']:
+            return {'message': 'A batch is limited to {} URLs'.format(app.config['BATCH_MAX_URLS'])}, 413
+
+        batch_id = str(uuid.uuid4())
+        render_options = images.request_options(args)
+        rows = [{'url': url,
+                 'url_hash': url_hash(url),
+                 'domain': domain_or_none(url),
+                 'status_only': args['status_only'],
+                 'callback': args['callback'],
+                 'job_status': 'CREATED',
+                 'render_options': render_options,
+                 'batch_id': batch_id} for url in urls]
+
+        # Insert every record in one statement, then read back their IDs
+        try:
+            db.session.execute(Capture.__table__.insert(), rows)
+            capture_ids = [row.id for row in db.session.query(Capture.id).filter(
+                Capture.batch_id == batch_id).order_by(Capture.id)]
+            db.session.commit()
+        except IntegrityError, exc:
+            db.session.rollback()
+            return {"error": exc.message}, 500
+
+        if args['status_only'] is True and app.config['BULK_STATUS_CHECKS']:
+            # Check a status only batch in chunks rather than with a task per URL
+            chunk = app.config['BULK_STATUS_CHUNK']
+            priority = app.config['TASK_PRIORITIES'][args['priority']]
+            signatures = (tasks.bulk_check_urls.si(capture_ids=capture_ids[start:start + chunk]).set(priority=priority)
+                          for start in range(0, len(capture_ids), chunk))
+        else:
+            signatures = (capture_signature(capture_id, args['status_only'], base_url, args['priority'])
+                          for capture_id in capture_ids)
+        group(signatures).apply_async()
+
+        return {'batch_id': batch_id,
+                'ids': capture_ids,
+                'status_url': base_url + '/api/v1.0/capture/batch/' + batch_id}, 201
+
+
+class CaptureSearch(Resource):
+    """
+    API Provides full-text search over the scrapes of Captures.
+
+    Methods:
+    GET
+
+    Args:
+    q = words that must all appear in the scrape
+    limit = maximum number of captures returned
+    offset = number of better matches to skip
+    """
+    def get(self):
+        """
+        Retrieve a page of matching Captures, best match first
+        """
+        if not search.enabled():
+            return 'Search is not enabled!', 404
+        args = SEARCHPARSER.parse_args()
+        if not search.terms(args['q']):
+            return 'Search query must contain a word', 400
+
+        # Fetch one extra match to know whether there is a next page
+        limit = page_limit(args)
+        matches = search.search(args['q'], limit + 1, args['offset'])
+        headers = {}
+        if len(matches) > limit:
+            matches = matches[:limit]
+            headers['Link'] = next_page_link(offset=args['offset'] + limit, limit=limit)
+
+        if not matches:
+            return [], 200, headers
+        records = dict((record.id, record) for record in
+                       Capture.query.filter(Capture.id.in_([capture_id for capture_id, _ in matches])))
+        return [dict(records[capture_id].as_dict(), score=score)
+                for capture_id, score in matches if capture_id in records], 200, headers
+
+
+class CaptureChanges(Resource):
+    """
+    API Provides whether a Capture changed since the previous capture of its URL.
+
+    Methods:
+    GET
+    """
+    def get(self, id):
+        """
+        Compare the sketch and scrape hashes of a Capture with the previous capture
+        """
+        capture_record = Capture.query.filter(Capture.id == id).first()
+        if capture_record is None:
+            return 'No capture found!', 404
+        if capture_record.sketch_hash is None:
+            return 'Capture has not been fingerprinted', 404
+
+        previous = fingerprint.previous_capture(capture_record)
+        if previous is None:
+            return {'id': capture_record.id, 'previous_id': None, 'changed': None}
+        return fingerprint.compare(capture_record, previous)
+
+
+class CaptureSimilar(Resource):
+    """
+    API Provides the captures whose sketch or scrape is a near duplicate of a
+    Capture, or of a given hash.
+
+    Methods:
+    GET
+
+    Args:
+    type = ['sketch', 'scrape'] hash to compare, sketch by default
+    hash = 16 hex digit hash to look up instead of the hash of a capture
+    distance = maximum number of differing bits
+    limit = maximum number of captures returned
+    """
+    def get(self, id=None):
+        """
+        Retrieve near duplicate Captures, nearest first
+        """
+        args = SIMILARPARSER.parse_args()
+        kind = args['type']
+        if id is not None:
+            capture_record = Capture.query.filter(Capture.id == id).first()
+            if capture_record is None:
+                return 'No capture found!', 404
+            value = getattr(capture_record, kind + '_hash')
+            if value is None:
+                return 'Capture has not been fingerprinted', 404
+        else:
+            value = (args['hash'] or '').lower()
+            try:
+                int(value, 16)
+            except ValueError:
+                value = ''
+            if len(value) != 16:
+                return 'A 16 hex digit hash must be set', 400
+
+        matches = fingerprint.similar_captures(value, kind, args['distance'], args['limit'], exclude_id=id)
+        return {'hash': value,
+                'type': kind,
+                'captures': [dict(capture.as_dict(), distance=bits) for bits, capture in matches]}
+
+
+class CaptureBatchView(Resource):
+    """
+    API Provides aggregate progress of a batch of Captures.
+
+    Methods:
+    GET
+    """
+    def get(self, batch_id):
+        """
+        Retrieve the number of captures in a batch per job status
+        """
+        counts = dict(db.session.query(Capture.job_status, func.count(Capture.id)).filter(
+            Capture.batch_id == batch_id).group_by(Capture.job_status).all())
+        if not counts:
+            return 'No batch found!', 404
+
+        total = sum(counts.values())
+        finished = counts.get('COMPLETED', 0) + counts.get('FAILURE', 0)
+        return {'batch_id': batch_id,
+                'total': total,
+                'job_status': counts,
+                'completed': counts.get('COMPLETED', 0),
+                'failed': counts.get('FAILURE', 0),
+                'finished': finished == total}
+
+
 class Eager(Resource):
     """
     Provides a way to retrieve a sketch, scrape, or html file eagerly (blocking call)
 
+    The capture runs on a celery worker. Identical requests in flight share a
+    single render, and a capture that takes longer than EAGER_WAIT_TIMEOUT
+    is answered with a 202 and the URL of its capture record to poll.
+
     Methods:
     GET
 
@@ -161,51 +435,78 @@ class Eager(Resource):
         args = EAGERPARSER.parse_args()
         base_url = app.config['BASE_URL']
 
-        app.config.update(USE_S3='')
         # Parse out url and capture type
         capture_record = Capture()
         capture_record.url = args["url"]
+        capture_record.url_hash = url_hash(args["url"])
+        capture_record.domain = domain_or_none(args["url"])
         capture_type = args["type"]
 
         if capture_type not in ['html', 'sketch', 'scrape']:
                 return 'Incorrect capture type specified: html, sketch, or scrape', 406
 
-        # Write to DB
-        try:
-            db.session.add(capture_record)
-            db.session.commit()
-        except IntegrityError, exc:
-            return {"error": exc.message}, 500
-
-        # Refresh capture_record to obtain an ID for record
-        db.session.refresh(capture_record)
+        # Serve a recent capture of the same URL if it is still stored locally
+        cached_record = None
+        if not args["force"]:
+            cached_record = cache.find_cached_capture(capture_record.url_hash)
+        if cached_record is not None:
+            cached_file = cache.local_artifact(getattr(cached_record, ARTIFACT_URLS[capture_type]))
+            if cached_file is not None:
+                cache.reuse_capture(cached_record, capture_record)
+                return storage.send_artifact(cached_file)
 
         try:
-            # dict of functions that generate capture names
-            capture_names = {'html': grab_domain(capture_record.url) + '_' + str(capture_record.id) + '.html',
-                             'sketch': grab_domain(capture_record.url) + '_' + str(capture_record.id) + '.png',
-                             'scrape': grab_domain(capture_record.url) + '_' + str(capture_record.id) + '.txt'}
+            grab_domain(capture_record.url)
         except:
             return 'This is not a valid URL', 406
 
-        # Check that url is valid and responsive
-        if not check_url(capture_record):
-            return 'Could not connect to URL', 406
-
-        # file_to_write is a placeholder in eager calls
-        file_to_write = {}
+        # Never render hosts in a blacklisted range
+        if blacklist.blacklisted_ip(capture_record.url):
+            return 'URL resolves to a blacklisted IP address', 403
+
+        # Join a render of the same URL that is already in flight, one render
+        # produces every capture type
+        coalesce_key = EAGER_KEY.format(capture_record.url_hash)
+        client = get_redis()
+        inflight = client.get(coalesce_key)
+        if inflight is None:
+            # Write to DB
+            try:
+                db.session.add(capture_record)
+                db.session.commit()
+            except IntegrityError, exc:
+                return {"error": exc.message}, 500
+
+            # Refresh capture_record to obtain an ID for record
+            db.session.refresh(capture_record)
+
+            render = {'capture_id': capture_record.id, 'task_id': str(uuid.uuid4())}
+            if not client.set(coalesce_key, json.dumps(render), nx=True, ex=app.config['EAGER_COALESCE_TTL']):
+                # Another request won the race, join its render instead
+                inflight = client.get(coalesce_key)
+            if inflight is None:
+                tasks.eager_capture.apply_async(
+                    args=[base_url],
+                    kwargs={'capture_id': capture_record.id, 'model': 'capture', 'coalesce_key': coalesce_key},
+                    task_id=render['task_id'])
+            else:
+                db.session.delete(capture_record)
+                db.session.commit()
+                render = json.loads(inflight)
+        else:
+            render = json.loads(inflight)
 
+        # Wait for a worker to finish the capture, without tying up this
+        # process for longer than EAGER_WAIT_TIMEOUT
         try:
-            # Call eager_capture to create scrape, sketch, and html file (blocking)
-            files_to_write = tasks.do_capture(200, capture_record, base_url)
-
-            if capture_type in capture_names:
-                return send_from_directory(app.config['LOCAL_STORAGE_FOLDER'],
-                                           capture_names[capture_type],
-                                           as_attachment=True)
-            else:
-                return 'Incorrect capture type specified: html, sketch, or scrape', 406
+            files_to_write = tasks.eager_capture.AsyncResult(render['task_id']).get(
+                timeout=app.config['EAGER_WAIT_TIMEOUT'], interval=0.1)
+        except TimeoutError:
+            status_url = '{}/api/v1.0/capture/{}'.format(base_url, render['capture_id'])
+            return {'id': render['capture_id'], 'status_url': status_url}, 202, {'Location': status_url}
         except Exception as err:
-            # Consider updating capture_record status here
+            # The worker already recorded the failure on the capture record
             app.logger.error(err)
             return str(err), 406
+
+        return storage.send_artifact(storage.logical_name(files_to_write[capture_type]))
@@ -0,0 +1,107 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import re
+import lxml.etree as etree
+
+# Tags whose content never ends up in a text scrape. These are the tags
+# lxml's Cleaner kills by default plus the ones the scrape always ignored.
+SKIP_TAGS = frozenset(['script', 'noscript', 'style', 'embed', 'object',
+                       'applet', 'iframe', 'frame', 'frameset'])
+
+WHITESPACE = re.compile(r'^[ \t\n\r]*$')
+
+# Size of the chunks read from the html file and written to the text file
+CHUNK_SIZE = 64 * 1024
+
+
+class TextTarget(object):
+    """
+    lxml parser target that collects the text of a document as it is parsed.
+
+    Every run of text between two tags is written out once, followed by a
+    single space, unless it is blank or inside one of SKIP_TAGS. No element
+    tree is built and the output is written in CHUNK_SIZE pieces.
+    """
+    def __init__(self, text_file):
+        self.text_file = text_file
+        self.skip = 0
+        self.run = []
+        self.buffer = []
+        self.buffered = 0
+        self.written = 0
+
+    def start(self, tag, attrib):
+        self.flush_run()
+        if tag in SKIP_TAGS:
+            self.skip += 1
+
+    def end(self, tag):
+        self.flush_run()
+        if tag in SKIP_TAGS and self.skip:
+            self.skip -= 1
+
+    def data(self, data):
+        if not self.skip:
+            self.run.append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        self.flush_run()
+        self.flush_buffer()
+        return self.written
+
+    def flush_run(self):
+        if not self.run:
+            return
+        words = u''.join(self.run).strip(u'\t')
+        self.run = []
+        if not WHITESPACE.match(words):
+            chunk = (words + u' ').encode('utf-8')
+            self.buffer.append(chunk)
+            self.buffered += len(chunk)
+            if self.buffered >= CHUNK_SIZE:
+                self.flush_buffer()
+
+    def flush_buffer(self):
+        if self.buffer:
+            self.text_file.write(''.join(self.buffer))
+            self.written += self.buffered
+            self.buffer = []
+            self.buffered = 0
+
+
+def extract_text(html_path, text_path, encoding=None):
+    """
+    Write the visible text of an html file to text_path in a single streaming pass.
+
+    encoding overrides the charset declared by the document, e.g. PhantomJS
+    always writes utf-8. Returns the number of bytes written.
+    """
+    with open(text_path, 'wb') as text_file:
+        parser = etree.HTMLParser(target=TextTarget(text_file), encoding=encoding,
+                                  remove_comments=True, remove_pis=True)
+        fed = False
+        with open(html_path, 'rb') as html_file:
+            while True:
+                chunk = html_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                parser.feed(chunk)
+                fed = True
+        # lxml refuses to close a parser that never saw any data
+        if not fed:
+            return 0
+        return parser.close()
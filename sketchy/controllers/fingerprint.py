@@ -0,0 +1,186 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import hashlib
+import re
+from collections import Counter
+
+from flask.ext.restful import types
+from PIL import Image
+
+from sketchy import db, app
+from sketchy.controllers import cache, storage
+from sketchy.models.capture import Capture
+from sketchy.models.fingerprint import HashBand
+
+# Hashes are 64 bit, stored as 16 hex digits and split in BANDS bands
+HASH_BITS = 64
+BANDS = 4
+BAND_DIGITS = HASH_BITS / 4 / BANDS
+# Lookups by band only find hashes that differ in fewer bits than this
+MAX_DISTANCE = BANDS - 1
+
+KINDS = ('sketch', 'scrape')
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+
+def _hex(value):
+    return '%016x' % value
+
+
+def max_distance(value):
+    """
+    Request argument type of a number of bits band lookups can find.
+    """
+    return types.int_range(0, MAX_DISTANCE, value, 'distance')
+
+
+def dhash(image_path):
+    """
+    Return the difference hash of an image.
+
+    The top of the image, cropped to the aspect ratio of THUMBNAIL_SIZE, is
+    shrunk to 9x8 grey pixels and every bit tells whether a pixel is
+    brighter than its right neighbour, so re-encoding, resizing and small
+    rendering differences keep the hash nearly identical, and a sketch
+    hashes like its thumbnail.
+    """
+    image = Image.open(image_path)
+    # Let the jpeg decoder downscale, a no-op for other formats
+    image.draft('L', (9 * 8, 8 * 8))
+    width, height = app.config['THUMBNAIL_SIZE']
+    image = image.crop((0, 0, image.size[0], min(image.size[1], image.size[0] * height // width)))
+    pixels = list(image.convert('L').resize((9, 8), Image.ANTIALIAS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            value = value << 1 | (left > pixels[row * 9 + col + 1])
+    return _hex(value)
+
+
+def simhash(text_path):
+    """
+    Return the SimHash of a text scrape.
+
+    Features are the word pairs of the text weighted by their count, so
+    pages whose text barely changed get hashes a few bits apart.
+    """
+    with storage.open_artifact(text_path) as text_file:
+        words = WORDS.findall(text_file.read().decode('utf-8', 'ignore').lower())
+    features = Counter(zip(words, words[1:]) or words)
+    weights = [0] * HASH_BITS
+    for feature, count in features.iteritems():
+        feature = u' '.join(feature) if isinstance(feature, tuple) else feature
+        digest = int(hashlib.md5(feature.encode('utf-8')).hexdigest()[:16], 16)
+        for bit in range(HASH_BITS):
+            if digest >> bit & 1:
+                weights[bit] += count
+            else:
+                weights[bit] -= count
+    if not features:
+        return _hex(0)
+    return _hex(sum(1 << bit for bit in range(HASH_BITS) if weights[bit] > 0))
+
+
+def distance(first, second):
+    """
+    Return the number of bits two hex hashes differ in.
+    """
+    return bin(int(first, 16) ^ int(second, 16)).count('1')
+
+
+def bands(value):
+    return [value[i * BAND_DIGITS:(i + 1) * BAND_DIGITS] for i in range(BANDS)]
+
+
+def fingerprint(the_record, sketch_path, scrape_path):
+    """
+    Hash the sketch and scrape of a capture and index the hashes by band.
+
+    The hashes are left None when either of them fails.
+    """
+    # A retried capture replaces the hashes and bands of its previous attempt
+    HashBand.query.filter(HashBand.capture_id == the_record.id).delete()
+    the_record.sketch_hash = the_record.scrape_hash = None
+    sketch_hash, scrape_hash = dhash(sketch_path), simhash(scrape_path)
+    the_record.sketch_hash, the_record.scrape_hash = sketch_hash, scrape_hash
+    for kind in KINDS:
+        for band, value in enumerate(bands(getattr(the_record, kind + '_hash'))):
+            db.session.add(HashBand(capture_id=the_record.id, kind=kind, band=band, value=value))
+
+
+def previous_capture(the_record):
+    """
+    Return the latest fingerprinted capture of the same URL before the_record, or None.
+    """
+    return Capture.query.filter(
+        Capture.url_hash == the_record.url_hash,
+        Capture.id < the_record.id,
+        Capture.sketch_hash != None).order_by(Capture.id.desc()).first()
+
+
+def compare(the_record, previous):
+    """
+    Return how much the_record changed since previous.
+
+    A hash counts as changed once it is more than CHANGE_SKETCH_DISTANCE or
+    CHANGE_SCRAPE_DISTANCE bits away from the previous one.
+    """
+    changes = {'id': the_record.id, 'previous_id': previous.id}
+    for kind in KINDS:
+        bits = distance(getattr(the_record, kind + '_hash'), getattr(previous, kind + '_hash'))
+        changes[kind + '_distance'] = bits
+        changes[kind + '_changed'] = bits > app.config['CHANGE_{}_DISTANCE'.format(kind.upper())]
+    changes['changed'] = changes['sketch_changed'] or changes['scrape_changed']
+    return changes
+
+
+def unchanged_previous(the_record):
+    """
+    Return the previous capture of the same URL if the_record did not change
+    since and its artifacts are still available, otherwise None.
+    """
+    previous = previous_capture(the_record)
+    if previous is None or previous.job_status != 'COMPLETED' or compare(the_record, previous)['changed']:
+        return None
+    # Local artifacts may have been evicted, S3 ones are left alone
+    for artifact_url in (previous.sketch_url, previous.scrape_url, previous.html_url):
+        if not artifact_url:
+            return None
+        if artifact_url.startswith(app.config['BASE_URL'] + '/files/') and cache.local_artifact(artifact_url) is None:
+            return None
+    return previous
+
+
+def similar_captures(value, kind, max_distance=MAX_DISTANCE, limit=20, exclude_id=None):
+    """
+    Return (distance, capture) of the captures whose kind hash is at most
+    max_distance bits away from value, nearest first, leaving out the
+    capture exclude_id.
+    """
+    clauses = [db.and_(HashBand.band == band, HashBand.value == band_value)
+               for band, band_value in enumerate(bands(value))]
+    candidates = db.session.query(HashBand.capture_id).filter(
+        HashBand.kind == kind, db.or_(*clauses)).distinct().subquery()
+    query = Capture.query.filter(Capture.id.in_(candidates))
+    if exclude_id is not None:
+        query = query.filter(Capture.id != exclude_id)
+    matches = []
+    for capture in query:
+        bits = distance(value, getattr(capture, kind + '_hash'))
+        if bits <= max_distance:
+            matches.append((bits, capture))
+    matches.sort(key=lambda match: (match[0], -match[1].id))
+    return matches[:limit]
@@ -0,0 +1,129 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import json
+import mimetypes
+import os
+
+from PIL import Image
+from flask.ext.restful import types
+from sketchy import app
+from sketchy.controllers import blocking, settle
+
+# Sketch formats: file extension and Pillow encoder
+FORMATS = {'png': ('png', 'PNG'), 'jpeg': ('jpg', 'JPEG'), 'webp': ('webp', 'WEBP')}
+
+# Lossless format PhantomJS writes when the sketch is encoded afterwards,
+# BMP skips the compression that dominates PhantomJS' own PNG/JPEG output
+RAW_FORMAT = 'bmp'
+
+# Sketch options a request may set, parsed from its JSON body or form
+OPTIONS = ('format', 'quality', 'max_height', 'thumbnail')
+
+# Python 2 does not know about WebP
+mimetypes.add_type('image/webp', '.webp')
+
+
+def quality(value):
+    """
+    Restrict input to an encoder quality between 1 and 100.
+    """
+    return types.int_range(1, 100, value, 'quality')
+
+
+def add_arguments(parser, location):
+    """
+    Add the sketch options to a request parser.
+    """
+    parser.add_argument('format', type=str, choices=sorted(FORMATS), required=False, location=location)
+    parser.add_argument('quality', type=quality, required=False, location=location)
+    parser.add_argument('max_height', type=types.natural, required=False, location=location)
+    if location == 'json':
+        parser.add_argument('thumbnail', type=bool, required=False, location=location)
+    else:
+        parser.add_argument('thumbnail', type=types.boolean, required=False, location=location)
+
+
+def request_options(args):
+    """
+    Return the sketch, settle and block options set by a request as JSON, or None for the defaults.
+    """
+    names = OPTIONS + settle.OPTIONS + blocking.OPTIONS
+    options = dict((name, args[name]) for name in names if args.get(name) is not None)
+    return json.dumps(options, sort_keys=True) if options else None
+
+
+def sketch_options(the_record):
+    """
+    Return the sketch options of a record, request values override the config.
+    """
+    options = {'format': app.config['SKETCH_FORMAT'],
+               'quality': app.config['SKETCH_QUALITY'],
+               'max_height': app.config['SKETCH_MAX_HEIGHT'],
+               'thumbnail': app.config['SKETCH_THUMBNAIL']}
+    if getattr(the_record, 'render_options', None):
+        options.update((name, value) for name, value in json.loads(the_record.render_options).items()
+                       if name in OPTIONS)
+    return options
+
+
+def render_extension(options):
+    """
+    Return the extension PhantomJS should render to for these options.
+    """
+    if options['format'] == 'png' and not options['thumbnail']:
+        return FORMATS['png'][0]
+    return RAW_FORMAT
+
+
+def sketch_extension(options):
+    return FORMATS[options['format']][0]
+
+
+def content_type(file_name):
+    """
+    Return the content type of a capture file, based on its extension.
+    """
+    return mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+
+def encode(raw_path, sketch_path, options, thumbnail_path=None):
+    """
+    Encode the raw PhantomJS render to the sketch format, and write a
+    thumbnail of the top of the page if thumbnail_path is set.
+
+    The raw render is removed once encoded.
+    """
+    image = Image.open(raw_path)
+    image.load()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    if raw_path != sketch_path:
+        save(image, sketch_path, options)
+        os.remove(raw_path)
+
+    if thumbnail_path:
+        width, height = app.config['THUMBNAIL_SIZE']
+        # Crop the top of the page to the thumbnail's aspect ratio, then shrink it
+        top = image.crop((0, 0, image.size[0], min(image.size[1], image.size[0] * height // width)))
+        top.thumbnail((width, height), Image.ANTIALIAS)
+        save(top, thumbnail_path, options)
+
+
+def save(image, path, options):
+    encoder = FORMATS[options['format']][1]
+    if encoder == 'PNG':
+        image.save(path, encoder, optimize=False)
+    else:
+        image.save(path, encoder, quality=options['quality'])
@@ -0,0 +1,175 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import datetime
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import redis
+from celery.exceptions import Retry
+from celery.signals import task_failure, task_retry, task_success
+
+from sketchy import app
+from sketchy.controllers.redis_client import get_redis
+
+# Upper bounds in seconds of the histogram buckets, +Inf is implied
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+HISTOGRAM_KEY = 'sketchy:metrics:histogram:{}'
+COUNTER_KEY = 'sketchy:metrics:counter:{}'
+
+# Help text of every exported metric
+HISTOGRAMS = {
+    'sketchy_stage_seconds': 'Time spent in each stage of the capture pipeline.',
+    'sketchy_queue_wait_seconds': 'Time a record waited for a task to pick it up, including retry countdowns.'}
+COUNTERS = {
+    'sketchy_stage_total': 'Capture pipeline stages run, by outcome.',
+    'sketchy_tasks_total': 'Celery tasks finished, by outcome.'}
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(name, labels[name]) for name in sorted(labels))
+
+
+def _bound(bound):
+    return repr(float(bound))
+
+
+def observe(name, seconds, **labels):
+    """
+    Add an observation to a histogram shared by every web and worker process.
+
+    Metrics are best effort, a redis error is logged and never raised.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+    series = _labels(labels)
+    bucket = next((_bound(bound) for bound in BUCKETS if seconds <= bound), '+Inf')
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        key = HISTOGRAM_KEY.format(name)
+        pipe.hincrby(key, series + '|' + bucket, 1)
+        pipe.hincrby(key, series + '|count', 1)
+        pipe.hincrbyfloat(key, series + '|sum', seconds)
+        pipe.execute()
+    except redis.RedisError as err:
+        app.logger.error(err)
+
+
+def incr(name, **labels):
+    """
+    Increment a counter shared by every web and worker process.
+    """
+    if not app.config['METRICS_ENABLED']:
+        return
+    try:
+        get_redis().hincrby(COUNTER_KEY.format(name), _labels(labels), 1)
+    except redis.RedisError as err:
+        app.logger.error(err)
+
+
+@contextmanager
+def timer(stage):
+    """
+    Time a stage of the capture pipeline and count its outcome.
+    """
+    start = time.time()
+    outcome = 'failure'
+    try:
+        yield
+        outcome = 'success'
+    except Retry:
+        outcome = 'retry'
+        raise
+    finally:
+        observe('sketchy_stage_seconds', time.time() - start, stage=stage)
+        incr('sketchy_stage_total', stage=stage, outcome=outcome)
+
+
+def queue_wait(task, the_record):
+    """
+    Record how long a record waited for task since it was created or last updated.
+    """
+    since = the_record.modified_at or the_record.created_at
+    if since is not None:
+        wait = (datetime.datetime.now() - since).total_seconds()
+        observe('sketchy_queue_wait_seconds', max(wait, 0), task=task)
+
+
+def read_histogram(name):
+    """
+    Return the recorded series of a histogram as a dict of label string to
+    a dict of bucket upper bound (or 'sum' and 'count') to value.
+    """
+    series = defaultdict(dict)
+    for field, value in get_redis().hgetall(HISTOGRAM_KEY.format(name)).items():
+        labels, part = field.rsplit('|', 1)
+        series[labels][part] = float(value)
+    return series
+
+
+def read_counter(name):
+    """
+    Return the recorded values of a counter as a dict of label string to count.
+    """
+    return dict((labels, int(value)) for labels, value in get_redis().hgetall(COUNTER_KEY.format(name)).items())
+
+
+def export():
+    """
+    Return every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for name in sorted(HISTOGRAMS):
+        lines.append('# HELP {} {}'.format(name, HISTOGRAMS[name]))
+        lines.append('# TYPE {} histogram'.format(name))
+        series = read_histogram(name)
+        for labels in sorted(series):
+            values = series[labels]
+            prefix = labels + ',' if labels else ''
+            # Buckets are stored individually and exported cumulatively
+            cumulative = 0
+            for bucket in [_bound(bound) for bound in BUCKETS] + ['+Inf']:
+                cumulative += int(values.get(bucket, 0))
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, bucket, cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(name, labels, values.get('sum', 0)))
+            lines.append('{}_count{{{}}} {}'.format(name, labels, int(values.get('count', 0))))
+    for name in sorted(COUNTERS):
+        lines.append('# HELP {} {}'.format(name, COUNTERS[name]))
+        lines.append('# TYPE {} counter'.format(name))
+        for labels, value in sorted(read_counter(name).items()):
+            lines.append('{}{{{}}} {}'.format(name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    """
+    Remove every recorded metric.
+    """
+    get_redis().delete(*([HISTOGRAM_KEY.format(name) for name in HISTOGRAMS] +
+                         [COUNTER_KEY.format(name) for name in COUNTERS]))
+
+
+def _count_task(outcome):
+    def handler(sender=None, **kwargs):
+        incr('sketchy_tasks_total', task=getattr(sender, 'name', sender), outcome=outcome)
+    return handler
+
+# Keep references, celery only holds weak references to signal receivers
+count_success = _count_task('success')
+count_retry = _count_task('retry')
+count_failure = _count_task('failure')
+task_success.connect(count_success)
+task_retry.connect(count_retry)
+task_failure.connect(count_failure)
@@ -0,0 +1,92 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import datetime
+import urllib
+
+from sketchy import app
+from flask import request
+from flask.ext.restful import reqparse, types
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def timestamp(value):
+    """
+    Parse an ISO 8601 date or datetime from a query string argument.
+    """
+    for date_format in DATETIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('{} is not a valid date or datetime'.format(value))
+
+
+def list_parser():
+    """
+    Return a request parser for list views, each resource may add its own filters.
+    """
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=types.positive, required=False, location='args')
+    parser.add_argument('after_id', type=types.positive, required=False, location='args')
+    parser.add_argument('job_status', type=str, required=False, location='args')
+    parser.add_argument('created_after', type=timestamp, required=False, location='args')
+    parser.add_argument('created_before', type=timestamp, required=False, location='args')
+    return parser
+
+
+def paginate(query, model, args):
+    """
+    Return one page of records, newest first, as a flask-restful response.
+
+    Pages are addressed by the last id seen (keyset pagination), so the cost
+    of a page does not depend on its position in the table. When there are
+    more records, a Link header points at the next page.
+    """
+    limit = page_limit(args)
+
+    if args['after_id']:
+        query = query.filter(model.id < args['after_id'])
+    if args['job_status']:
+        query = query.filter(model.job_status == args['job_status'])
+    if args['created_after']:
+        query = query.filter(model.created_at >= args['created_after'])
+    if args['created_before']:
+        query = query.filter(model.created_at < args['created_before'])
+
+    # Fetch one extra row to know whether there is a next page
+    rows = query.order_by(model.id.desc()).limit(limit + 1).all()
+    headers = {}
+    if len(rows) > limit:
+        rows = rows[:limit]
+        headers['Link'] = next_page_link(after_id=rows[-1].id, limit=limit)
+
+    return [row.as_dict() for row in rows], 200, headers
+
+
+def page_limit(args):
+    """
+    Return the number of records a list view returns for a request.
+    """
+    return min(args['limit'] or app.config['API_PAGE_LIMIT'], app.config['API_MAX_PAGE_LIMIT'])
+
+
+def next_page_link(**next_args):
+    """
+    Return a Link header to the current request with next_args replaced.
+    """
+    query_args = request.args.to_dict()
+    query_args.update(next_args)
+    return '<{}{}?{}>; rel="next"'.format(
+        app.config['BASE_URL'], request.path, urllib.urlencode(query_args))
@@ -0,0 +1,121 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import random
+import time
+import uuid
+
+from celery.exceptions import Retry
+from sketchy import app
+from sketchy.controllers.redis_client import get_redis
+from sketchy.controllers.validators import grab_registered_domain
+
+# Atomically take a slot for a domain if it is below its concurrency cap and
+# its minimum spacing has elapsed. Active slots are leases in a sorted set
+# scored by their expiry, so slots of crashed workers free themselves.
+# Returns {1, 0} on success, {0, wait_ms} when spaced out and {0, -1} when
+# the domain is at its concurrency cap.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local interval = tonumber(ARGV[3])
+local lease = tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return {0, -1}
+end
+local next_at = tonumber(redis.call('GET', KEYS[2]) or '0')
+if next_at > now then
+    return {0, next_at - now}
+end
+redis.call('ZADD', KEYS[1], now + lease, ARGV[5])
+redis.call('PEXPIRE', KEYS[1], lease)
+if interval > 0 then
+    redis.call('SET', KEYS[2], now + interval, 'PX', interval)
+end
+return {1, 0}
+"""
+
+_acquire = None
+
+
+def _keys(domain):
+    return ['sketchy:domain:{}:active'.format(domain), 'sketchy:domain:{}:next'.format(domain)]
+
+
+def domain(url):
+    """
+    Return the registered domain slots of url are taken for, or None if it has none.
+    """
+    try:
+        return grab_registered_domain(url).lower() or None
+    except Exception:
+        return None
+
+
+def take(domain):
+    """
+    Take a slot for a registered domain without waiting.
+
+    Returns (lease, 0) on success, or (None, countdown) with the seconds to
+    wait before trying again when the domain is busy.
+    """
+    global _acquire
+    client = get_redis()
+    if _acquire is None:
+        _acquire = client.register_script(ACQUIRE_SCRIPT)
+    token = str(uuid.uuid4())
+    acquired, wait = _acquire(keys=_keys(domain), args=[
+        int(time.time() * 1000),
+        app.config['DOMAIN_CONCURRENCY'],
+        int(app.config['DOMAIN_MIN_INTERVAL'] * 1000),
+        int(app.config['DOMAIN_LEASE_TIMEOUT'] * 1000),
+        token], client=client)
+    if acquired:
+        return (domain, token), 0
+
+    if wait < 0:
+        return None, app.config['DOMAIN_DEFER_COUNTDOWN'] * random.uniform(1, 2)
+    return None, wait / 1000.0 + random.uniform(0, app.config['DOMAIN_MIN_INTERVAL'])
+
+
+def acquire(task, url):
+    """
+    Take a slot for the registered domain of url before contacting it.
+
+    If the domain is busy the task is sent again with a countdown, without
+    counting as a retry, and Retry is raised to end the current run.
+    Returns a lease to hand to release, or None if politeness is disabled.
+    """
+    if not app.config['DOMAIN_POLITENESS'] or task.request.called_directly:
+        return None
+
+    url_domain = domain(url)
+    if url_domain is None:
+        return None
+    lease, countdown = take(url_domain)
+    if lease is not None:
+        return lease
+
+    task.subtask_from_request(countdown=countdown, retries=task.request.retries).apply_async()
+    raise Retry('{} is busy, deferred'.format(url_domain), when=countdown)
+
+
+def release(lease):
+    """
+    Give back a slot taken by acquire.
+    """
+    if lease is None:
+        return
+    domain, token = lease
+    get_redis().zrem(_keys(domain)[0], token)
@@ -0,0 +1,33 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import os
+import redis
+
+from sketchy import app
+
+_client = None
+_client_pid = None
+
+
+def get_redis():
+    """
+    Return the redis client used to coordinate web and worker processes.
+
+    Connections are not shared across forks, every process gets its own client.
+    """
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = redis.StrictRedis.from_url(app.config['SKETCHY_REDIS_URL'])
+        _client_pid = os.getpid()
+    return _client
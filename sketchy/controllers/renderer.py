@@ -0,0 +1,275 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import atexit
+import json
+import os
+import Queue
+import socket
+import time
+
+import requests
+import subprocess32
+
+from celery.signals import worker_process_shutdown
+from sketchy import app
+
+RENDERER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets', 'renderer.js')
+
+
+def _free_port():
+    """
+    Ask the OS for a free local port for a renderer to listen on.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _service_args(port, concurrency=1, max_pages=0):
+    return [
+        app.config['PHANTOMJS'],
+        '--ssl-protocol=any',
+        '--ignore-ssl-errors=yes',
+        RENDERER_SCRIPT,
+        str(port),
+        str(concurrency),
+        str(max_pages)]
+
+
+class RendererBusy(Exception):
+    """
+    The shared renderer kept refusing a job, the capture should be retried later.
+    """
+
+
+class Renderer(object):
+    """
+    A long-lived PhantomJS process running assets/renderer.js.
+
+    Render jobs are POSTed to the process over a local HTTP control channel,
+    so the browser boot and WebKit init are only paid once per process
+    instead of once per capture.
+    """
+    def __init__(self):
+        self.process = None
+        self.devnull = None
+        self.pages = 0
+        self.session = requests.Session()
+        # Never send local control traffic through a configured proxy
+        self.session.trust_env = False
+        self.start()
+
+    def start(self):
+        """
+        Boot PhantomJS and wait until the control channel answers.
+        """
+        self.port = _free_port()
+        self.endpoint = 'http://127.0.0.1:{}/'.format(self.port)
+        self.devnull = open(os.devnull, 'w')
+        self.process = subprocess32.Popen(_service_args(self.port), stdout=self.devnull, stderr=self.devnull, close_fds=True)
+
+        deadline = time.time() + app.config['RENDERER_STARTUP_TIMEOUT']
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                self.stop()
+                raise Exception('PhantomJS renderer exited during startup')
+            try:
+                self.session.get(self.endpoint, timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.05)
+
+        self.stop()
+        raise Exception('PhantomJS renderer did not start within {} seconds'.format(
+            app.config['RENDERER_STARTUP_TIMEOUT']))
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def render(self, job, timeout):
+        """
+        Render a job and return its result, raising TimeoutExpired if it
+        takes longer than timeout.
+
+        A renderer that timed out or crashed is stopped, the pool replaces it.
+        """
+        self.pages += 1
+        try:
+            response = self.session.post(self.endpoint, data=json.dumps(job), timeout=timeout,
+                                         headers={'Content-Type': 'application/json', 'Connection': 'close'})
+        except requests.Timeout:
+            # There is no way to cancel a page that hangs, so recycle the process
+            self.stop()
+            app.logger.error('PhantomJS Capture timeout at {} seconds'.format(timeout))
+            raise subprocess32.TimeoutExpired('phantomjs capture', timeout)
+        except requests.ConnectionError:
+            self.stop()
+            raise
+
+        result = response.json()
+        if result.get('status') != 'success':
+            raise Exception(result.get('error') or 'PhantomJS render failed')
+        return result
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        if self.devnull is not None:
+            self.devnull.close()
+            self.devnull = None
+
+
+class RendererPool(object):
+    """
+    Fixed size pool of Renderers owned by a single worker process.
+
+    Renderers are started lazily and recycled after max_pages renders or
+    as soon as they crash or time out.
+    """
+    def __init__(self, size, max_pages):
+        self.max_pages = max_pages
+        self.idle = Queue.LifoQueue()
+        for _ in range(size):
+            self.idle.put(None)
+
+    def render(self, job, timeout):
+        renderer = self.idle.get()
+        try:
+            if renderer is None or not renderer.alive() or renderer.pages >= self.max_pages:
+                if renderer is not None:
+                    renderer.stop()
+                renderer = None
+                renderer = Renderer()
+            return renderer.render(job, timeout)
+        finally:
+            self.idle.put(renderer)
+
+    def shutdown(self):
+        for renderer in list(self.idle.queue):
+            if renderer is not None:
+                renderer.stop()
+
+
+class SharedRenderer(object):
+    """
+    Client of the renderer started by `manage.py renderer`, shared by every
+    worker process of a host.
+
+    A single PhantomJS renders up to RENDERER_CONCURRENCY pages at once, each
+    in its own webpage, so a worker no longer ties up a whole browser while a
+    page waits on the network. The renderer enforces the render timeout
+    itself since one hung page must not take the others down.
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.session = requests.Session()
+        # Never send local control traffic through a configured proxy
+        self.session.trust_env = False
+
+    def render(self, job, timeout):
+        """
+        Render a job and return its result, raising TimeoutExpired if it
+        takes longer than timeout.
+
+        While the renderer recycles itself it refuses jobs or is briefly
+        down, the job is then retried for up to RENDERER_STARTUP_TIMEOUT
+        before RendererBusy is raised.
+        """
+        job = dict(job, timeout=int(timeout * 1000))
+        deadline = time.time() + app.config['RENDERER_STARTUP_TIMEOUT']
+        while True:
+            try:
+                # Leave the renderer time to report its own timeout
+                response = self.session.post(self.endpoint, data=json.dumps(job), timeout=timeout + 5,
+                                             headers={'Content-Type': 'application/json', 'Connection': 'close'})
+                result = response.json()
+            except requests.Timeout:
+                result = {'status': 'fail', 'timeout': True}
+            except requests.ConnectionError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+                continue
+            if result.get('retry'):
+                if time.time() > deadline:
+                    raise RendererBusy(result.get('error') or 'PhantomJS renderer is busy')
+                time.sleep(0.2)
+                continue
+            break
+
+        if result.get('timeout'):
+            app.logger.error('PhantomJS Capture timeout at {} seconds'.format(timeout))
+            raise subprocess32.TimeoutExpired('phantomjs capture', timeout)
+        if result.get('status') != 'success':
+            raise Exception(result.get('error') or 'PhantomJS render failed')
+        return result
+
+    def shutdown(self):
+        self.session.close()
+
+
+def serve(port, concurrency, max_pages):
+    """
+    Run the shared renderer in the foreground on port, restarting PhantomJS
+    whenever it exits. It exits on its own after max_pages jobs to bound
+    memory growth.
+    """
+    while True:
+        process = subprocess32.Popen(_service_args(port, concurrency, max_pages), close_fds=True)
+        try:
+            code = process.wait()
+        except KeyboardInterrupt:
+            process.kill()
+            process.wait()
+            return
+        if code != 0:
+            app.logger.error('PhantomJS renderer exited with {}, restarting'.format(code))
+            time.sleep(1)
+
+
+_pool = None
+_pool_pid = None
+
+
+def get_pool():
+    """
+    Return the renderer pool of the current process, or the client of the
+    shared renderer when RENDERER_URL is set.
+
+    Celery forks its workers after import, so a pool is only ever reused by
+    the process that created it.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        if app.config['RENDERER_URL']:
+            _pool = SharedRenderer(app.config['RENDERER_URL'])
+        else:
+            _pool = RendererPool(app.config['RENDERER_POOL_SIZE'], app.config['RENDERER_MAX_PAGES'])
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def shutdown_pool(**kwargs):
+    """
+    Stop the PhantomJS processes owned by the current process.
+    """
+    if _pool is not None and _pool_pid == os.getpid():
+        _pool.shutdown()
+
+atexit.register(shutdown_pool)
+worker_process_shutdown.connect(shutdown_pool)
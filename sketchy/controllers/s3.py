@@ -0,0 +1,122 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import math
+import os
+import threading
+
+import boto
+import boto.s3
+from boto.s3.connection import OrdinaryCallingFormat
+from boto.s3.key import Key
+from multiprocessing.pool import ThreadPool
+from sketchy import app
+from sketchy.controllers import storage
+
+# S3 connections and bucket handles are kept per thread of each process
+_local = threading.local()
+_pool = None
+_pool_pid = None
+
+
+def get_bucket():
+    """
+    Return a (connection, bucket) pair that is reused by the current thread.
+
+    Set S3_HOST to use a local S3 stand-in instead of AWS.
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        if app.config.get('S3_HOST'):
+            connection = boto.connect_s3(
+                host=app.config['S3_HOST'],
+                port=app.config.get('S3_PORT'),
+                is_secure=app.config.get('S3_IS_SECURE', True),
+                calling_format=OrdinaryCallingFormat())
+        else:
+            connection = boto.s3.connect_to_region(
+                region_name=app.config.get('S3_BUCKET_REGION_NAME'),
+                calling_format=OrdinaryCallingFormat())
+        _local.connection = connection
+        _local.bucket = connection.get_bucket(app.config.get('S3_BUCKET_PREFIX'))
+        _local.pid = os.getpid()
+    return _local.connection, _local.bucket
+
+
+def get_pool():
+    """
+    Return the upload thread pool of the current process.
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = ThreadPool(app.config['S3_UPLOAD_THREADS'])
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def multipart_upload(bucket, path, file_path, size, headers):
+    """
+    Upload a large file to S3 in S3_MULTIPART_CHUNKSIZE parts.
+    """
+    chunk_size = app.config['S3_MULTIPART_CHUNKSIZE']
+    upload = bucket.initiate_multipart_upload(path, headers=headers)
+    try:
+        with open(file_path, 'rb') as upload_file:
+            for part in range(int(math.ceil(size / float(chunk_size)))):
+                upload.upload_part_from_file(upload_file, part + 1,
+                                             size=min(chunk_size, size - part * chunk_size))
+        upload.complete_upload()
+    except Exception:
+        upload.cancel_upload()
+        raise
+
+
+def upload(capture_type, file_name, content_type):
+    """
+    Write a local capture file to S3 and return a URL for downloading it.
+
+    Compressed files are stored under their plain name with a Content-Encoding.
+    """
+    connection, bucket = get_bucket()
+    path = "sketchy/{}/{}".format(capture_type, storage.logical_name(file_name))
+    file_path = storage.artifact_path(file_name)
+    headers = {'Content-Type': content_type}
+    if storage.content_encoding(file_name):
+        headers['Content-Encoding'] = storage.content_encoding(file_name)
+
+    size = os.path.getsize(file_path)
+    if size >= app.config['S3_MULTIPART_THRESHOLD']:
+        multipart_upload(bucket, path, file_path, size, headers)
+    else:
+        key = Key(bucket)
+        key.key = path
+        key.set_contents_from_filename(file_path, headers=headers)
+
+    return connection.generate_url(
+        app.config.get('S3_LINK_EXPIRATION'),
+        'GET',
+        bucket=app.config.get('S3_BUCKET_PREFIX'),
+        key=path,
+        response_headers={
+            'response-content-type': content_type,
+            'response-content-disposition': 'attachment; filename=' + storage.logical_name(file_name)
+        })
+
+
+def upload_all(files_to_write, content_types):
+    """
+    Upload every capture file concurrently, returns a dict of capture_type to URL.
+    """
+    pool = get_pool()
+    results = dict((capture_type, pool.apply_async(upload, (capture_type, file_name, content_types[capture_type])))
+                   for capture_type, file_name in files_to_write.items())
+    return dict((capture_type, result.get()) for capture_type, result in results.items())
@@ -0,0 +1,111 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import re
+
+from sqlalchemy import event, text
+
+from sketchy import db, app
+
+WORDS = re.compile(r'\w+', re.UNICODE)
+
+# The CaptureText table holds the indexed text of each capture, keyed by
+# capture id. PostgreSQL only keeps the tsvector.
+CREATE = {
+    'sqlite': ['CREATE VIRTUAL TABLE "CaptureText" USING fts5(text)'],
+    'postgresql': [
+        'CREATE TABLE "CaptureText" (capture_id INTEGER PRIMARY KEY, document TSVECTOR NOT NULL)',
+        'CREATE INDEX "ix_CaptureText_document" ON "CaptureText" USING GIN (document)']}
+
+DELETE = {
+    'sqlite': 'DELETE FROM "CaptureText" WHERE rowid = :capture_id',
+    'postgresql': 'DELETE FROM "CaptureText" WHERE capture_id = :capture_id'}
+
+INSERT = {
+    'sqlite': 'INSERT INTO "CaptureText" (rowid, text) VALUES (:capture_id, :text)',
+    'postgresql': 'INSERT INTO "CaptureText" (capture_id, document) VALUES (:capture_id, to_tsvector(\'simple\', :text))'}
+
+# Best match first. bm25() is lower for better matches.
+QUERY = {
+    'sqlite': 'SELECT rowid, -bm25("CaptureText") AS score FROM "CaptureText" '
+              'WHERE "CaptureText" MATCH :query ORDER BY score DESC, rowid DESC LIMIT :limit OFFSET :offset',
+    'postgresql': 'SELECT capture_id, ts_rank_cd(document, query) AS score '
+                  'FROM "CaptureText", to_tsquery(\'simple\', :query) query '
+                  'WHERE document @@ query ORDER BY score DESC, capture_id DESC LIMIT :limit OFFSET :offset'}
+
+
+def dialect(bind=None):
+    """
+    Return the name of the database dialect if it can be searched, otherwise None.
+    """
+    name = (bind or db.engine).dialect.name
+    return name if name in CREATE else None
+
+
+def create_index(target, connection, **kwargs):
+    """
+    Create the search table along with the models when search is enabled.
+    """
+    if app.config['SEARCH_ENABLED'] and dialect(connection) and \
+            not connection.dialect.has_table(connection, 'CaptureText'):
+        for statement in CREATE[dialect(connection)]:
+            connection.execute(statement)
+
+
+def drop_index(target, connection, **kwargs):
+    if dialect(connection):
+        connection.execute('DROP TABLE IF EXISTS "CaptureText"')
+
+event.listen(db.metadata, 'after_create', create_index)
+event.listen(db.metadata, 'before_drop', drop_index)
+
+
+def enabled():
+    return bool(app.config['SEARCH_ENABLED'] and dialect())
+
+
+def index(the_record, text_path):
+    """
+    Index the first SEARCH_MAX_BYTES of a scrape in the session of the_record.
+
+    A retried capture replaces its previous text.
+    """
+    if not enabled():
+        return
+    with open(text_path, 'rb') as text_file:
+        words = text_file.read(app.config['SEARCH_MAX_BYTES']).decode('utf-8', 'ignore')
+    params = {'capture_id': the_record.id, 'text': words}
+    db.session.execute(text(DELETE[dialect()]), params)
+    db.session.execute(text(INSERT[dialect()]), params)
+
+
+def terms(query):
+    """
+    Return the words of a search query, operators and quotes are not supported.
+    """
+    return WORDS.findall(query.lower())
+
+
+def search(query, limit, offset=0):
+    """
+    Return (capture id, score) of the captures whose scrape holds every word
+    of query, best match first.
+    """
+    words = terms(query)
+    if dialect() == 'sqlite':
+        match = u' '.join(u'"{}"'.format(word) for word in words)
+    else:
+        match = u' & '.join(words)
+    rows = db.session.execute(text(QUERY[dialect()]),
+                              {'query': match, 'limit': limit, 'offset': offset})
+    return [(capture_id, float(score)) for capture_id, score in rows]
@@ -0,0 +1,67 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import json
+
+from flask.ext.restful import types
+from sketchy import app
+
+# fixed waits ajax_timeout after the last request, adaptive renders as soon
+# as the network and the DOM have been idle for idle_time
+MODES = ('fixed', 'adaptive')
+
+# Settle options a request may set, parsed from its JSON body or form
+OPTIONS = ('settle', 'ajax_timeout', 'max_timeout', 'idle_time')
+
+# Longest wait in milliseconds a request may ask for, well below PHANTOMJS_TIMEOUT
+MAX_WAIT = 30000
+
+
+def milliseconds(value, name='argument'):
+    """
+    Restrict input to a wait between 0 and MAX_WAIT milliseconds.
+    """
+    return types.int_range(0, MAX_WAIT, value, name)
+
+
+def add_arguments(parser, location):
+    """
+    Add the settle options to a request parser.
+    """
+    parser.add_argument('settle', type=str, choices=MODES, required=False, location=location)
+    for name in OPTIONS[1:]:
+        parser.add_argument(name, type=milliseconds, required=False, location=location)
+
+
+def settle_options(the_record):
+    """
+    Return the settle options of a record, request values override the config.
+    """
+    options = {'settle': app.config['SETTLE_MODE'],
+               'ajax_timeout': app.config['SETTLE_AJAX_TIMEOUT'],
+               'max_timeout': app.config['SETTLE_MAX_TIMEOUT'],
+               'idle_time': app.config['SETTLE_IDLE_TIME']}
+    if getattr(the_record, 'render_options', None):
+        options.update((name, value) for name, value in json.loads(the_record.render_options).items()
+                       if name in OPTIONS)
+    return options
+
+
+def job_options(options):
+    """
+    Return settle options as the fields of a page.js render job.
+    """
+    return {'settle': options['settle'],
+            'ajaxTimeout': options['ajax_timeout'],
+            'maxTimeout': options['max_timeout'],
+            'idleTime': options['idle_time']}
@@ -19,12 +19,17 @@ import os
 
 from sketchy import db, app
 from sketchy.models.static import Static
+from sketchy.controllers import blocking, images, settle, storage
+from sketchy.controllers.paging import list_parser, paginate
 from flask import jsonify
 from flask.ext.restful import Resource, reqparse
 from sqlalchemy.exc import IntegrityError
 from werkzeug import secure_filename
 from werkzeug.datastructures import FileStorage
 
+# Request parser for listing static captures
+STATICLISTPARSER = list_parser()
+
 
 class StaticView(Resource):
     """
@@ -90,13 +95,12 @@ class StaticViewList(Resource):
 
     def get(self):
         """
-        Retrieve all static records the database
-        """
-        results = []
-        for row in Static.query.order_by(Static.id.desc()).all():
-            results.append(row.as_dict())
+        Retrieve a page of static records from the database
 
-        return results
+        Supports limit, after_id, job_status, created_after and created_before
+        """
+        args = STATICLISTPARSER.parse_args()
+        return paginate(Static.query, Static, args)
 
     def post(self):
         """
@@ -110,6 +114,9 @@ class StaticViewList(Resource):
                         required=True,
                         location='files')
         parser.add_argument('callback', type=str, location='form')
+        images.add_arguments(parser, 'form')
+        settle.add_arguments(parser, 'form')
+        blocking.add_arguments(parser, 'form')
         args = parser.parse_args()
         file_object = args['file']
         # User can provide optional callback field for static record
@@ -124,6 +131,7 @@ class StaticViewList(Resource):
         # Instantiate a new static model record
         static_record = Static()
         static_record.filename = str(the_filename)
+        static_record.render_options = images.request_options(args)
 
         if callback:
             static_record.callback = str(callback)
@@ -139,7 +147,7 @@ class StaticViewList(Resource):
 
         # Write uploaded HTML file to local storage disk
         try:
-            new_html_file = open(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], the_filename), 'w+')
+            new_html_file = open(storage.artifact_path(the_filename, create=True), 'w+')
             file_object.save(new_html_file)
             new_html_file.close()
         except Exception as err:
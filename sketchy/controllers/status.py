@@ -0,0 +1,70 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import cookielib
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from sketchy import app
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:28.0) Gecko/20100101 Firefox/28.0"
+
+# Servers that mishandle HEAD requests tend to answer with one of these
+HEAD_FALLBACK_CODES = (400, 403, 405, 501)
+
+# Long-lived sessions never keep the cookies sites set, they would pile up
+# and be sent back on later requests to the same hosts
+REJECT_COOKIES = cookielib.DefaultCookiePolicy(allowed_domains=[])
+
+# Status check sessions are kept per thread of each process
+_local = threading.local()
+
+
+def get_session():
+    """
+    Return a keep-alive session, pooling connections per host, for status checks.
+    """
+    if getattr(_local, 'pid', None) != os.getpid():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=app.config['STATUS_POOL_HOSTS'],
+                              pool_maxsize=app.config['STATUS_POOL_SIZE'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['User-Agent'] = USER_AGENT
+        session.cookies.set_policy(REJECT_COOKIES)
+        _local.session = session
+        _local.pid = os.getpid()
+    return _local.session
+
+
+def get_status_code(url, allow_redirects=False, cookies=None):
+    """
+    Return the status code of a URL without downloading its body.
+
+    Issues a HEAD request and falls back to a streamed GET, closed as soon as
+    the headers arrived, when the server does not handle HEAD.
+    """
+    session = get_session()
+    options = {'allow_redirects': allow_redirects,
+               'cookies': cookies,
+               'verify': app.config['SSL_HOST_VALIDATION'],
+               'timeout': (app.config['STATUS_CONNECT_TIMEOUT'], app.config['STATUS_READ_TIMEOUT'])}
+
+    response = session.head(url, **options)
+    response.close()
+    if response.status_code in HEAD_FALLBACK_CODES:
+        response = session.get(url, stream=True, **options)
+        response.close()
+    return response.status_code
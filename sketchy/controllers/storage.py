@@ -0,0 +1,344 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import errno
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+
+from celery.signals import worker_ready
+from flask import Response, abort, request, safe_join, send_file
+from sketchy import app, db
+from sketchy.models.capture import Capture
+from sketchy.models.static import Static
+from sketchy.controllers.redis_client import get_redis
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Content-Encoding of compressed artifacts, by file extension
+ENCODINGS = {'.gz': 'gzip', '.zst': 'zstd'}
+EXTENSIONS = dict((encoding, extension) for extension, encoding in ENCODINGS.items())
+
+# Size of the chunks copied between files and to clients
+CHUNK_SIZE = 64 * 1024
+
+# Suffix of thumbnail names, thumbnails are stored with their capture
+THUMBNAIL_SUFFIX = '_thumb'
+
+# Capture id in artifact names, e.g. example.com_42.png or example.com_42_thumb.jpg
+CAPTURE_ID = re.compile(r'_(\d+)$')
+
+# Records still being worked on, their artifacts are never evicted
+FINISHED_STATUSES = ('COMPLETED', 'FAILURE')
+
+# Artifacts live on the disk of each worker host, so each host runs its own janitor
+JANITOR_LOCK = 'sketchy:storage:janitor:{}'
+
+
+def artifact_stem(file_name):
+    """
+    Return the name shared by every artifact of a capture, e.g. example.com_42
+    for example.com_42.png, example.com_42.txt.gz and example.com_42_thumb.jpg.
+    """
+    stem = os.path.splitext(logical_name(file_name))[0]
+    if stem.endswith(THUMBNAIL_SUFFIX):
+        stem = stem[:-len(THUMBNAIL_SUFFIX)]
+    return stem
+
+
+def artifact_dir(stem, create=False):
+    """
+    Return the folder of LOCAL_STORAGE_FOLDER holding the artifacts of a capture.
+
+    Captures are spread over STORAGE_SHARD_DEPTH levels of two hex digit
+    folders by the hash of their stem, so no folder grows too large.
+    """
+    if isinstance(stem, unicode):
+        stem = stem.encode('utf-8')
+    digest = hashlib.sha1(stem).hexdigest()
+    shards = [digest[level * 2:level * 2 + 2] for level in range(app.config['STORAGE_SHARD_DEPTH'])]
+    folder = os.path.join(app.config['LOCAL_STORAGE_FOLDER'], *shards)
+    if create and not os.path.isdir(folder):
+        try:
+            os.makedirs(folder)
+        except OSError as err:
+            # Another worker created it first
+            if err.errno != errno.EEXIST:
+                raise
+    return folder
+
+
+def artifact_path(file_name, create=False):
+    """
+    Return the local path of an artifact, rejecting names that would escape its folder.
+    """
+    return safe_join(artifact_dir(artifact_stem(file_name), create=create), file_name)
+
+
+def content_encoding(file_name):
+    """
+    Return the Content-Encoding of a stored file name, or None if it is not compressed.
+    """
+    return ENCODINGS.get(os.path.splitext(file_name)[1])
+
+
+def logical_name(file_name):
+    """
+    Return the name a stored file is served under, without its compression extension.
+    """
+    if content_encoding(file_name):
+        return os.path.splitext(file_name)[0]
+    return file_name
+
+
+def compress(file_name):
+    """
+    Compress a stored artifact with ARTIFACT_COMPRESSION.
+
+    The uncompressed file is replaced, returns the name of the stored file.
+    """
+    encoding = app.config['ARTIFACT_COMPRESSION']
+    if not encoding:
+        return file_name
+    if encoding not in EXTENSIONS:
+        raise Exception('Unknown ARTIFACT_COMPRESSION {}, use gzip or zstd'.format(encoding))
+    if encoding == 'zstd' and zstandard is None:
+        raise Exception('ARTIFACT_COMPRESSION is zstd but the zstandard package is not installed')
+
+    level = app.config['ARTIFACT_COMPRESSION_LEVEL']
+    stored_name = file_name + EXTENSIONS[encoding]
+    path = artifact_path(file_name)
+    with open(path, 'rb') as source:
+        with open(artifact_path(stored_name), 'wb') as target:
+            if encoding == 'gzip':
+                # A fixed mtime keeps the output identical for identical input
+                compressed = gzip.GzipFile(file_name, 'wb', level or 6, target, mtime=0)
+                shutil.copyfileobj(source, compressed, CHUNK_SIZE)
+                compressed.close()
+            else:
+                zstandard.ZstdCompressor(level=level or 3).copy_stream(source, target)
+    os.remove(path)
+    return stored_name
+
+
+def open_artifact(path):
+    """
+    Open a stored file for reading its uncompressed content.
+    """
+    encoding = content_encoding(path)
+    if encoding == 'gzip':
+        return gzip.open(path, 'rb')
+    if encoding == 'zstd':
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return open(path, 'rb')
+
+
+def stored_path(stored_name):
+    """
+    Return the local path of a stored file, or None if there is none.
+
+    Files of the flat layout, stored directly in LOCAL_STORAGE_FOLDER, are
+    found until manage.py migrate_storage moved them to their shard folder.
+    """
+    for path in (artifact_path(stored_name), safe_join(app.config['LOCAL_STORAGE_FOLDER'], stored_name)):
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def find_artifact(file_name):
+    """
+    Return the stored name of a file served as file_name, or None if there is none.
+    """
+    for stored_name in [file_name] + [file_name + extension for extension in sorted(ENCODINGS)]:
+        if stored_path(stored_name) is not None:
+            return stored_name
+    return None
+
+
+def send_artifact(file_name):
+    """
+    Send a capture file as an attachment, compressed files are sent as is to
+    clients that accept their encoding and decompressed for the others.
+    """
+    stored_name = find_artifact(file_name)
+    if stored_name is None:
+        abort(404)
+    path = stored_path(stored_name)
+    mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+
+    encoding = content_encoding(stored_name)
+    if encoding is None:
+        return send_file(path, mimetype=mimetype, as_attachment=True, attachment_filename=file_name)
+    if request.accept_encodings[encoding]:
+        response = send_file(path, mimetype=mimetype, as_attachment=True, attachment_filename=file_name)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        def generate():
+            artifact = open_artifact(path)
+            try:
+                while True:
+                    chunk = artifact.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                artifact.close()
+        response = Response(generate(), mimetype=mimetype)
+        response.headers['Content-Disposition'] = 'attachment; filename=' + file_name
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def _unfinished_records():
+    """
+    Return the ids of the capture records and the artifact stems of the
+    static records that are not finished.
+    """
+    capture_ids = set(capture_id for capture_id, in db.session.query(Capture.id).filter(
+        ~Capture.job_status.in_(FINISHED_STATUSES)))
+    # Static artifacts are named after the uploaded file, without its extension
+    static_stems = set(os.path.splitext(filename)[0] for filename, in db.session.query(Static.filename).filter(
+        ~Static.job_status.in_(FINISHED_STATUSES)))
+    return capture_ids, static_stems
+
+
+def _is_unfinished(name, capture_ids, static_stems):
+    stem = artifact_stem(name)
+    match = CAPTURE_ID.search(stem)
+    if match:
+        return int(match.group(1)) in capture_ids
+    return stem in static_stems
+
+
+def evict(max_bytes, max_age, grace):
+    """
+    Delete the least recently used local artifacts until they fit in max_bytes
+    and none was last used more than max_age seconds ago (0 disables a limit).
+
+    Artifacts modified in the last grace seconds or whose record is not
+    finished, e.g. not yet uploaded to S3, are kept. Returns the number of
+    files and bytes deleted.
+    """
+    now = time.time()
+    artifacts = []
+    total = 0
+    for folder, _, names in os.walk(app.config['LOCAL_STORAGE_FOLDER']):
+        for name in names:
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            total += stat.st_size
+            if now - stat.st_mtime > grace:
+                # Access times are coarse on relatime mounts, but still order artifacts
+                artifacts.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path, name))
+
+    artifacts.sort()
+    deleted = freed = 0
+    # Records are looked up once per sweep
+    capture_ids, static_stems = _unfinished_records()
+    for last_used, size, path, name in artifacts:
+        over_budget = max_bytes and total > max_bytes
+        too_old = max_age and now - last_used > max_age
+        if not (over_budget or too_old):
+            # Artifacts are sorted by last use, nothing after this one is due
+            break
+        if _is_unfinished(name, capture_ids, static_stems):
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        freed += size
+        deleted += 1
+    return deleted, freed
+
+
+def storage_janitor():
+    """
+    Keep the LOCAL_STORAGE_FOLDER of this host within its size and age budget.
+
+    Returns False if another janitor of this host holds the lock.
+    """
+    # A single janitor per host at a time, the lock expires if it dies
+    client = get_redis()
+    lock = JANITOR_LOCK.format(socket.gethostname())
+    if not client.set(lock, os.getpid(), nx=True, ex=app.config['STORAGE_JANITOR_INTERVAL']):
+        return False
+    try:
+        deleted, freed = evict(app.config['STORAGE_MAX_BYTES'], app.config['STORAGE_MAX_AGE'],
+                               app.config['STORAGE_EVICTION_GRACE'])
+        if deleted:
+            app.logger.info('Storage janitor deleted {} files ({} bytes)'.format(deleted, freed))
+    finally:
+        client.delete(lock)
+    return True
+
+
+def _janitor_loop():
+    while True:
+        time.sleep(app.config['STORAGE_JANITOR_INTERVAL'])
+        try:
+            with app.app_context():
+                storage_janitor()
+        except Exception as err:
+            app.logger.error(err)
+        finally:
+            db.session.remove()
+
+
+def start_janitor(**kwargs):
+    """
+    Run storage_janitor every STORAGE_JANITOR_INTERVAL seconds in each celery
+    worker, the lock leaves a single sweep per host.
+    """
+    if not (app.config['STORAGE_MAX_BYTES'] or app.config['STORAGE_MAX_AGE']):
+        return
+    janitor = threading.Thread(target=_janitor_loop, name='storage-janitor')
+    janitor.daemon = True
+    janitor.start()
+
+worker_ready.connect(start_janitor)
+
+
+def migrate_layout():
+    """
+    Move the artifacts of LOCAL_STORAGE_FOLDER to their shard folder for the
+    current STORAGE_SHARD_DEPTH, from the flat layout or any other depth.
+
+    Emptied shard folders are removed. Returns the number of files moved.
+    """
+    moved = 0
+    root = app.config['LOCAL_STORAGE_FOLDER']
+    for folder, _, names in os.walk(root, topdown=False):
+        for name in names:
+            path = os.path.join(folder, name)
+            target = artifact_path(name, create=True)
+            if target != path:
+                os.rename(path, target)
+                moved += 1
+        if folder != root and not os.listdir(folder):
+            os.rmdir(folder)
+    return moved
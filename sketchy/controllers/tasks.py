@@ -11,44 +11,79 @@
 #     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
-import boto
-import lxml.html as LH
-import lxml.html.clean as clean
-import os
-import re
 import json
-import requests
+import os
+import time
 from requests.exceptions import ConnectionError
+from celery.exceptions import Retry
 
-from requests import post
-from boto.s3.key import Key
-from boto.s3.connection import OrdinaryCallingFormat
 from subprocess32 import PIPE
 from collections import defaultdict
 from sketchy import db, app, celery
 from sketchy.models.capture import Capture
 from sketchy.models.static import Static
 from sketchy.controllers.validators import grab_domain
+from sketchy.controllers.validators import check_url as url_is_responsive
+from sketchy.controllers.redis_client import get_redis
+from sketchy.controllers import blacklist
+from sketchy.controllers import blocking
+from sketchy.controllers import bulk_status
+from sketchy.controllers import callbacks
+from sketchy.controllers import extract
+from sketchy.controllers import fingerprint
+from sketchy.controllers import images
+from sketchy.controllers import metrics
+from sketchy.controllers import politeness
+from sketchy.controllers import renderer
+from sketchy.controllers import s3
+from sketchy.controllers import search
+from sketchy.controllers import settle
+from sketchy.controllers import status
+from sketchy.controllers import storage
+from sketchy.controllers import timeouts
 import subprocess32
-import socket
-import netaddr
 
 
-@celery.task(name='check_url', bind=True)
-def check_url(self, capture_id=0, retries=0, model='capture'):
+def skip_blacklisted(capture_record):
     """
-    Check if a URL exists without downloading the whole file.
-    We only check the URL header.
+    Complete a capture without rendering if its host resolves to a blacklisted IP.
+
+    Returns True when the capture was skipped.
     """
-    # check for env variable for session cookies
+    ip_addr = blacklist.blacklisted_ip(capture_record.url)
+    if not ip_addr:
+        return False
+    capture_record.capture_status = "IP BLACKLISTED:{}".format(ip_addr)
+    if capture_record.callback:
+        finisher(capture_record, commit=False)
+    else:
+        capture_record.job_status = 'COMPLETED'
+    return True
 
+def phantomjs_cookies():
+    """
+    Return the cookies set in the phantomjs_cookies env variable as a dict.
+    """
     cookies = {}
     try:
         cookies = dict(item.split("=") for item in os.getenv('phantomjs_cookies').split(" "))
     except:
         pass
+    return cookies
+
+@celery.task(name='check_url', bind=True)
+def check_url(self, capture_id=0, retries=0, model='capture'):
+    """
+    Check if a URL exists without downloading the whole file.
+    We only check the URL header.
+    """
+    # check for env variable for session cookies
+    cookies = phantomjs_cookies()
 
     capture_record = Capture.query.filter(Capture.id == capture_id).first()
+    # Defer the check while the domain is busy
+    lease = politeness.acquire(self, capture_record.url)
+    metrics.queue_wait(self.name, capture_record)
     capture_record.job_status = 'STARTED'
     # Write the number of retries to the capture record
     db.session.add(capture_record)
@@ -57,17 +92,17 @@ def check_url(self, capture_id=0, retries=0, model='capture'):
 
     # Only retrieve the headers of the request, and return response code
     try:
-        response = ""
-        verify_ssl = app.config['SSL_HOST_VALIDATION']
-        response = requests.get(capture_record.url, verify=verify_ssl, allow_redirects=False, timeout=5, headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:28.0) Gecko/20100101 Firefox/28.0"}, cookies=cookies)
-        capture_record.url_response_code = response.status_code
+        status_code = 0
+        with metrics.timer('check_url'):
+            status_code = status.get_status_code(capture_record.url, cookies=cookies)
+        capture_record.url_response_code = status_code
         if capture_record.status_only:
             capture_record.job_status = 'COMPLETED'
-            capture_record.capture_status = '%s HTTP STATUS CODE' % (response.status_code)
+            capture_record.capture_status = '%s HTTP STATUS CODE' % (status_code)
             if capture_record.callback:
                 finisher(capture_record)
         else:
-            capture_record.capture_status = '%s HTTP STATUS CODE' % (response.status_code)
+            capture_record.capture_status = '%s HTTP STATUS CODE' % (status_code)
     # If URL doesn't return a valid status code or times out, raise an exception
     except Exception as err:
         capture_record.job_status = 'RETRY'
@@ -78,145 +113,334 @@ def check_url(self, capture_id=0, retries=0, model='capture'):
 
     # If the code was not a good code, record the status as a 404 and raise an exception
     finally:
+        politeness.release(lease)
         db.session.commit()
-    return str(response.status_code)
+    return str(status_code)
+
+def error_message(err):
+    """
+    Return the message of an exception, str() fails on non-ascii unicode messages.
+    """
+    try:
+        return unicode(err)
+    except UnicodeError:
+        return repr(err)
+
+
+@celery.task(name='bulk_check_urls', ignore_result=True, bind=True)
+def bulk_check_urls(self, capture_ids, retries=0):
+    """
+    Check the URLs of many status only captures at once.
+
+    The URLs are checked concurrently by bulk_status and the records are
+    written back with one UPDATE per outcome instead of a task and a commit
+    per URL. URLs that could not be checked are retried together.
+    With DOMAIN_POLITENESS each check takes a slot of its domain like
+    check_url does, and the URLs of busy domains are left to a later run.
+    """
+    capture_records = Capture.query.filter(Capture.id.in_(capture_ids)).all()
+    if not capture_records:
+        return
+    metrics.queue_wait(self.name, capture_records[0])
+    urls = dict((capture_record.id, capture_record.url) for capture_record in capture_records)
+
+    leases = {}
+    if app.config['DOMAIN_POLITENESS'] and not self.request.called_directly:
+        deferred = []
+        countdown = 0
+        busy = set()
+        for capture_id, url in bulk_status._interleave(urls):
+            domain = politeness.domain(url)
+            if domain is None:
+                continue
+            if domain not in busy:
+                lease, wait = politeness.take(domain)
+                if lease is not None:
+                    leases[capture_id] = lease
+                    continue
+                busy.add(domain)
+                countdown = max(countdown, wait)
+            deferred.append(capture_id)
+            del urls[capture_id]
+        if deferred:
+            # Sent again without counting as a retry
+            self.subtask_from_request(kwargs={'capture_ids': deferred, 'retries': retries},
+                                      countdown=countdown).apply_async()
+        if not urls:
+            return
+
+    callback_ids = [capture_record.id for capture_record in capture_records
+                    if capture_record.callback and capture_record.id in urls]
+    Capture.query.filter(Capture.id.in_(urls.keys())).update(
+        {'job_status': 'STARTED', 'retry': retries}, synchronize_session=False)
+    db.session.commit()
+
+    with metrics.timer('bulk_check_urls'):
+        results = bulk_status.check_all(urls, cookies=phantomjs_cookies(), leases=leases)
+
+    # Records with the same outcome are updated together
+    final = retries >= app.config['MAX_RETRIES']
+    outcomes = defaultdict(list)
+    failed = []
+    for capture_id, result in results.items():
+        if isinstance(result, Exception):
+            failed.append(capture_id)
+            outcome = (0, error_message(result)[:512], 'FAILURE' if final else 'RETRY')
+        else:
+            outcome = (result, '%s HTTP STATUS CODE' % (result), 'COMPLETED')
+        outcomes[outcome].append(capture_id)
+    for (status_code, capture_status, job_status), ids in outcomes.items():
+        Capture.query.filter(Capture.id.in_(ids)).update(
+            {'url_response_code': status_code, 'capture_status': capture_status, 'job_status': job_status},
+            synchronize_session=False)
+    db.session.commit()
+
+    # Post the callbacks of the records that are done, a failed callback
+    # only fails its own record
+    finished_ids = set(callback_ids) if final else set(callback_ids) - set(failed)
+    if finished_ids:
+        for capture_record in Capture.query.filter(Capture.id.in_(finished_ids)):
+            try:
+                finisher(capture_record, commit=False)
+            except Exception as err:
+                app.logger.error(err)
+                capture_record.job_status = 'FAILURE'
+                capture_record.capture_status = error_message(err)[:512]
+        db.session.commit()
+
+    if failed and not final:
+        raise self.retry(kwargs={'capture_ids': failed, 'retries': retries + 1},
+                         countdown=app.config['COOLDOWN'], max_retries=app.config['MAX_RETRIES'])
 
-def do_capture(status_code, the_record, base_url, model='capture', phantomjs_timeout=app.config['PHANTOMJS_TIMEOUT']):
+def do_capture(status_code, the_record, base_url, model='capture', phantomjs_timeout=None, commit=True, use_s3=None, skip_unchanged=None):
     """
     Create a screenshot, text scrape, from a provided html file.
 
     This depends on phantomjs and an associated javascript file to perform the captures.
     In the event an error occurs, an exception is raised and handled by the celery task
     or the controller that called this method.
+    Pass commit=False to leave committing the record to the caller, and
+    use_s3=False to complete a capture that will not be uploaded whatever USE_S3 says.
+    A capture that did not change since the previous capture of its URL reuses
+    its artifacts and has no files to write when skip_unchanged (default
+    SKIP_UNCHANGED_CAPTURES) is set. phantomjs_timeout defaults to the timeout
+    learned for the domain of the capture.
     """
+    if use_s3 is None:
+        use_s3 = app.config['USE_S3']
+    if skip_unchanged is None:
+        skip_unchanged = app.config['SKIP_UNCHANGED_CAPTURES']
+    if phantomjs_timeout is None:
+        phantomjs_timeout = timeouts.initial_timeout(the_record.url) if model == 'capture' else app.config['PHANTOMJS_TIMEOUT']
     # Make sure the the_record
     db.session.add(the_record)
+    # PhantomJS renders to a lossless raw image when the sketch is encoded afterwards
+    options = images.sketch_options(the_record)
+    render_extension = images.render_extension(options)
+    sketch_extension = images.sketch_extension(options)
+    # How PhantomJS decides the page is ready to render, and what it never loads
+    page_options = settle.job_options(settle.settle_options(the_record))
+    page_options.update(blocking.job_options(blocking.block_list(the_record)))
     # If the capture is for static content, use a different PhantomJS config file
+    # Every artifact of a capture is written to the storage folder of its name
     if model == 'static':
-        capture_name = the_record.filename
+        html_name = the_record.filename
+        capture_name = os.path.splitext(html_name)[0]
+        folder = storage.artifact_dir(capture_name)
         service_args = [
             app.config['PHANTOMJS'],
             '--ssl-protocol=any',
             '--ignore-ssl-errors=yes',
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + '/assets/static.js',
-            app.config['LOCAL_STORAGE_FOLDER'],
-            capture_name]
-        content_to_parse = os.path.join(app.config['LOCAL_STORAGE_FOLDER'], capture_name)
+            folder,
+            html_name,
+            render_extension,
+            str(options['max_height']),
+            json.dumps(page_options)]
+        content_to_parse = os.path.join(folder, html_name)
+        render_job = {
+            'url': content_to_parse,
+            'sketch': os.path.join(folder, capture_name + '.' + render_extension),
+            'width': 1200,
+            'height': 800,
+            'maxHeight': options['max_height'],
+            'cookies': False}
+        render_job.update(page_options)
     else:
         capture_name = grab_domain(the_record.url) + '_' + str(the_record.id)
+        html_name = capture_name + '.html'
+        folder = storage.artifact_dir(capture_name, create=True)
         service_args = [
             app.config['PHANTOMJS'],
             '--ssl-protocol=any',
             '--ignore-ssl-errors=yes',
             os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + '/assets/capture.js',
             the_record.url,
-        os.path.join(app.config['LOCAL_STORAGE_FOLDER'], capture_name)]
-
-        content_to_parse = os.path.join(app.config['LOCAL_STORAGE_FOLDER'], capture_name + '.html')
-    # Using subprocess32 backport, call phantom and if process hangs kill it
-    pid = subprocess32.Popen(service_args, stdout=PIPE, stderr=PIPE)
+        os.path.join(folder, capture_name),
+            '1280',
+            '800',
+            render_extension,
+            str(options['max_height']),
+            json.dumps(page_options)]
+
+        content_to_parse = os.path.join(folder, html_name)
+        render_job = {
+            'url': the_record.url,
+            'sketch': os.path.join(folder, capture_name + '.' + render_extension),
+            'maxHeight': options['max_height'],
+            'html': content_to_parse}
+        render_job.update(page_options)
+
+    # Learn how long pages of this domain take to render, timeouts included
+    started = time.time()
     try:
-        stdout, stderr = pid.communicate(timeout=phantomjs_timeout)
+        with metrics.timer('render'):
+            if app.config['USE_RENDERER_POOL'] or app.config['RENDERER_URL']:
+                # Hand the job to a long-lived PhantomJS
+                result = renderer.get_pool().render(render_job, phantomjs_timeout)
+            else:
+                # Using subprocess32 backport, call phantom and if process hangs kill it
+                pid = subprocess32.Popen(service_args, stdout=PIPE, stderr=PIPE)
+                try:
+                    stdout, stderr = pid.communicate(timeout=phantomjs_timeout)
+                except subprocess32.TimeoutExpired:
+                    pid.kill()
+                    stdout, stderr = pid.communicate()
+                    app.logger.error('PhantomJS Capture timeout at {} seconds'.format(phantomjs_timeout))
+                    raise subprocess32.TimeoutExpired('phantomjs capture',phantomjs_timeout)
+
+                # If the subprocess has an error, raise an exception,
+                # otherwise it printed the result of the render as JSON
+                if stderr:
+                    raise Exception("{}{}".format(stdout, stderr))
+                try:
+                    result = json.loads(stdout)
+                except ValueError:
+                    raise Exception(stdout)
     except subprocess32.TimeoutExpired:
-        pid.kill()
-        stdout, stderr = pid.communicate()
-        app.logger.error('PhantomJS Capture timeout at {} seconds'.format(phantomjs_timeout))
-        raise subprocess32.TimeoutExpired('phantomjs capture',phantomjs_timeout)
-
-    # If the subprocess has an error, raise an exception
-    if stderr or stdout:
-        raise Exception("{}{}".format(stdout, stderr))
-
-    # Strip tags and parse out all text
-    ignore_tags = ('script', 'noscript', 'style')
-    with open(content_to_parse, 'r') as content_file:
-        content = content_file.read()
-    cleaner = clean.Cleaner()
-    content = cleaner.clean_html(content)
-    doc = LH.fromstring(content)
-    output = ""
-    for elt in doc.iterdescendants():
-        if elt.tag in ignore_tags:
-            continue
-        text = elt.text or ''
-        tail = elt.tail or ''
-        wordz = " ".join((text, tail)).strip('\t')
-        if wordz and len(wordz) >= 2 and not re.match("^[ \t\n]*$", wordz):
-            output += wordz.encode('utf-8')
-
-    # Since the filename format is different for static captures, update the filename
-    # This will ensure the URLs are pointing to the correct resources
-    if model == 'static':
-        capture_name = capture_name.split('.')[0]
-
-    # Wite our html text that was parsed into our capture folder
-    parsed_text = open(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], capture_name + '.txt'), 'wb')
-    parsed_text.write(output)
+        if model == 'capture':
+            timeouts.record(the_record.url, phantomjs_timeout)
+        raise
+    if model == 'capture':
+        timeouts.record(the_record.url, time.time() - started)
+        the_record.blocked_requests = result.get('blocked')
+
+    # Encode the sketch and its thumbnail now that PhantomJS is done with the page
+    sketch_name = capture_name + '.' + sketch_extension
+    thumbnail_name = capture_name + storage.THUMBNAIL_SUFFIX + '.' + sketch_extension if options['thumbnail'] else None
+    if render_extension != sketch_extension or thumbnail_name:
+        with metrics.timer('encode'):
+            images.encode(os.path.join(folder, capture_name + '.' + render_extension),
+                          os.path.join(folder, sketch_name),
+                          options,
+                          thumbnail_path=os.path.join(folder, thumbnail_name) if thumbnail_name else None)
+
+    # Strip tags and stream all text into our capture folder
+    # PhantomJS always writes utf-8, uploaded static files declare their own charset
+    with metrics.timer('extract'):
+        extract.extract_text(content_to_parse,
+                             os.path.join(folder, capture_name + '.txt'),
+                             encoding=None if model == 'static' else 'utf-8')
+
+    # Hash the sketch and scrape to tell how the page changed since its last
+    # capture, and index the scrape for search. The thumbnail is hashed when
+    # there is one, decoding the sketch of a very long page can fail and
+    # only costs the capture its hashes.
+    previous = None
+    if model == 'capture':
+        if app.config['FINGERPRINT_CAPTURES'] or skip_unchanged:
+            with metrics.timer('fingerprint'):
+                try:
+                    fingerprint.fingerprint(the_record,
+                                            os.path.join(folder, thumbnail_name or sketch_name),
+                                            os.path.join(folder, capture_name + '.txt'))
+                except Exception as err:
+                    app.logger.error(err)
+        if skip_unchanged and the_record.sketch_hash is not None:
+            previous = fingerprint.unchanged_previous(the_record)
+        with metrics.timer('index'):
+            search.index(the_record, os.path.join(folder, capture_name + '.txt'))
 
     # Update the sketch record with the local URLs for the sketch, scrape, and html captures
-    the_record.sketch_url = base_url + '/files/' + capture_name + '.png'
+    the_record.sketch_url = base_url + '/files/' + sketch_name
     the_record.scrape_url = base_url + '/files/' + capture_name + '.txt'
-    the_record.html_url = base_url + '/files/' + capture_name + '.html'
+    the_record.html_url = base_url + '/files/' + html_name
+    if thumbnail_name:
+        the_record.thumbnail_url = base_url + '/files/' + thumbnail_name
 
     # Create a dict that contains what files may need to be written to S3
     files_to_write = defaultdict(list)
-    files_to_write['sketch'] = capture_name + '.png'
+    files_to_write['sketch'] = sketch_name
+    if thumbnail_name:
+        files_to_write['thumbnail'] = thumbnail_name
     files_to_write['scrape'] = capture_name + '.txt'
-    files_to_write['html'] = capture_name + '.html'
+    files_to_write['html'] = html_name
+
+    # Nothing new to store, point the record at the artifacts of the previous capture
+    if previous is not None:
+        for file_name in files_to_write.values():
+            os.remove(os.path.join(folder, file_name))
+        the_record.sketch_url = previous.sketch_url
+        the_record.scrape_url = previous.scrape_url
+        the_record.html_url = previous.html_url
+        the_record.thumbnail_url = previous.thumbnail_url
+        the_record.capture_status = 'UNCHANGED_FROM:{}'.format(previous.id)
+        if not use_s3 or not the_record.callback:
+            the_record.job_status = 'COMPLETED'
+        if commit:
+            db.session.commit()
+        return defaultdict(list)
+
+    # Text artifacts are stored compressed, their URLs keep the plain names
+    with metrics.timer('compress'):
+        for capture_type in ('scrape', 'html'):
+            files_to_write[capture_type] = storage.compress(files_to_write[capture_type])
 
     # If we are not writing to S3, update the capture_status that we are completed.
-    if not app.config['USE_S3']:
+    if not use_s3:
         the_record.job_status = "COMPLETED"
         the_record.capture_status = "LOCAL_CAPTURES_CREATED"
     else:
         the_record.capture_status = "LOCAL_CAPTURES_CREATED"
-    db.session.commit()
+    if commit:
+        db.session.commit()
     return files_to_write
 
 
-def s3_save(files_to_write, the_record):
+def s3_save(files_to_write, the_record, commit=True):
     """
     Write a sketch, scrape, and html file to S3
     """
     db.session.add(the_record)
+    # Unchanged captures reuse the uploads of a previous capture
+    if not files_to_write:
+        if not the_record.callback:
+            the_record.job_status = 'COMPLETED'
+        if commit:
+            db.session.commit()
+        return
+
     # These are the content-types for the files S3 will be serving up
-    response_types = {'sketch': 'image/png', 'scrape': 'text/plain', 'html': 'text/html'}
-
-    # Iterate through each file we need to write to s3
-    for capture_type, file_name in files_to_write.items():
-        # Connect to S3, generate Key, set path based on capture_type, write file to S3
-        conn = boto.s3.connect_to_region(
-            region_name = app.config.get('S3_BUCKET_REGION_NAME'),
-            calling_format = boto.s3.connection.OrdinaryCallingFormat()
-        )
-        key = Key(conn.get_bucket(app.config.get('S3_BUCKET_PREFIX')))
-        path = "sketchy/{}/{}".format(capture_type, file_name)
-        key.key = path
-        key.set_contents_from_filename(app.config['LOCAL_STORAGE_FOLDER'] + '/' + file_name)
-
-        # Generate a URL for downloading the files
-        url = conn.generate_url(
-            app.config.get('S3_LINK_EXPIRATION'),
-            'GET',
-            bucket=app.config.get('S3_BUCKET_PREFIX'),
-            key=key.key,
-            response_headers={
-                'response-content-type': response_types[capture_type],
-                'response-content-disposition': 'attachment; filename=' + file_name
-            })
-
-        # Generate appropriate url based on capture_type
-        if capture_type == 'sketch':
-            the_record.sketch_url = str(url)
-        if capture_type == 'scrape':
-            the_record.scrape_url = str(url)
-        if capture_type == 'html':
-            the_record.html_url = str(url)
+    response_types = dict((capture_type, images.content_type(storage.logical_name(file_name)))
+                          for capture_type, file_name in files_to_write.items())
+
+    # Upload all files at once over this worker's pooled S3 connections
+    with metrics.timer('s3_save'):
+        urls = s3.upload_all(files_to_write, response_types)
+
+    # Generate appropriate url based on capture_type
+    if 'sketch' in urls:
+        the_record.sketch_url = str(urls['sketch'])
+    if 'scrape' in urls:
+        the_record.scrape_url = str(urls['scrape'])
+    if 'html' in urls:
+        the_record.html_url = str(urls['html'])
+    if 'thumbnail' in urls:
+        the_record.thumbnail_url = str(urls['thumbnail'])
 
     # Remove local files if we are saving to S3
-    os.remove(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], files_to_write['sketch']))
-    os.remove(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], files_to_write['scrape']))
-    os.remove(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], files_to_write['html']))
+    for file_name in files_to_write.values():
+        os.remove(storage.artifact_path(file_name))
 
     # If we don't have a finisher task is complete
     if the_record.callback:
@@ -224,40 +448,60 @@ def s3_save(files_to_write, the_record):
     else:
         the_record.capture_status = 'S3_ITEMS_SAVED'
         the_record.job_status = 'COMPLETED'
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
 
-def finisher(the_record):
+def finisher(the_record, commit=True):
     """
     POST finished chain to a callback URL provided
+
+    With ASYNC_CALLBACKS the POST is left to the callback workers and the
+    record is completed once it is delivered. With commit=False it is only
+    handed to them once the caller commits the record.
     """
     db.session.add(the_record)
-    verify_ssl = app.config['SSL_HOST_VALIDATION']
-    # Set the correct headers for the postback
-    headers = {'Content-type': 'application/json', 'Accept': 'text/plain', 'Connection': 'close'}
-    #proxy = {"http": "127.0.0.1:8080"}
 
-    try:
+    with metrics.timer('finisher'):
         # Blacklist IP addresses
-        ip_addr = socket.gethostbyname(grab_domain(the_record.url))
+        ip_addr = blacklist.blacklisted_ip(getattr(the_record, 'url', None))
+        if ip_addr and not (the_record.capture_status or '').startswith('IP BLACKLISTED'):
+            the_record.capture_status = "IP BLACKLISTED:{} - ".format(ip_addr) + (the_record.capture_status or '')
 
-        if app.config['IP_BLACKLISTING']:
-            if netaddr.all_matching_cidrs(ip_addr, app.config['IP_BLACKLISTING_RANGE'].split(',')):
-                the_record.capture_status = "IP BLACKLISTED:{} - ".format(ip_addr) + the_record.capture_status
-    except:
-        pass
+        if app.config['ASYNC_CALLBACKS']:
+            if commit:
+                db.session.commit()
+            callbacks.enqueue(the_record, after_commit=not commit)
+            return
 
-    req = post(the_record.callback, verify=verify_ssl, data=json.dumps(the_record.as_dict()), headers=headers)
+        # If a 4xx or 5xx status is received, an exception is raised
+        callbacks.post_callback(the_record.callback, the_record.as_dict())
 
-    # If a 4xx or 5xx status is received, raise an exception
-    req.raise_for_status()
+        # Update capture_record and save to database
+        the_record.job_status = 'COMPLETED'
+        # Removed to propagate blacklist message
+        #the_record.capture_status = 'CALLBACK_SUCCEEDED'
+        db.session.add(the_record)
+        if commit:
+            db.session.commit()
 
-    # Update capture_record and save to database
-    the_record.job_status = 'COMPLETED'
-    # Removed to propagate blacklist message
-    #the_record.capture_status = 'CALLBACK_SUCCEEDED'
-    db.session.add(the_record)
-    db.session.commit()
+
+def store(files_to_write, the_record, model, commit=True):
+    """
+    Write the files of a capture to S3 if configured, then post its callback.
+
+    With ASYNC_UPLOADS both are left to celery_upload on the upload queue.
+    """
+    if app.config['USE_S3'] and app.config['ASYNC_UPLOADS'] and files_to_write:
+        # The upload task must see the local URLs, whatever commit says
+        db.session.add(the_record)
+        db.session.commit()
+        celery_upload.delay(files_to_write, capture_id=the_record.id, model=model)
+        return
+    if app.config['USE_S3']:
+        s3_save(files_to_write, the_record, commit=commit)
+    if the_record.callback:
+        finisher(the_record, commit=commit)
 
 @celery.task(name='celery_static_capture', ignore_result=True, bind=True)
 def celery_static_capture(self, base_url, capture_id=0, retries=0, model="static"):
@@ -266,6 +510,7 @@ def celery_static_capture(self, base_url, capture_id=0, retries=0, model="static
     Task also writes files to S3 or posts a callback depending on configuration file.
     """
     static_record = Static.query.filter(Static.id == capture_id).first()
+    metrics.queue_wait(self.name, static_record)
 
     # Write the number of retries to the capture record
     db.session.add(static_record)
@@ -277,14 +522,7 @@ def celery_static_capture(self, base_url, capture_id=0, retries=0, model="static
         # call the main capture function to retrieve sketches and scrapes
         files_to_write = do_capture(0, static_record, base_url, model='static')
         # Call the s3 save function if s3 is configured, and perform callback if configured.
-        if app.config['USE_S3']:
-            if static_record.callback:
-                s3_save(files_to_write, static_record)
-                finisher(static_record)
-            else:
-                s3_save(files_to_write, static_record)
-        elif static_record.callback:
-                finisher(static_record)
+        store(files_to_write, static_record, 'static')
     # Only execute retries on ConnectionError exceptions, otherwise fail immediately
     except ConnectionError as err:
         app.logger.error(err)
@@ -308,7 +546,7 @@ def celery_static_capture(self, base_url, capture_id=0, retries=0, model="static
         db.session.commit()
 
 @celery.task(name='celery_capture', ignore_result=True, bind=True)
-def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="capture", phantomjs_timeout=app.config['PHANTOMJS_TIMEOUT']):
+def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="capture", phantomjs_timeout=None):
     """
     Celery task used to create sketch, scrape, html.
     Task also writes files to S3 or posts a callback depending on configuration file.
@@ -327,6 +565,9 @@ def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="
             else:
                 capture_record.job_status = 'COMPLETED'
             return True
+        # Never render hosts in a blacklisted range
+        if skip_blacklisted(capture_record):
+            return True
     # Only execute retries on ConnectionError exceptions, otherwise fail immediately
     except ConnectionError as err:
         app.logger.error(err)
@@ -345,19 +586,15 @@ def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="
         capture_record.capture_status = str(err)
     finally:
         db.session.commit()
+    # Defer the capture while the domain is busy
+    lease = politeness.acquire(self, capture_record.url)
+    metrics.queue_wait(self.name, capture_record)
     # First perform the captures, then either write to S3, perform a callback, or neither
     try:
         # call the main capture function to retrieve sketches, scrapes, and html
         files_to_write = do_capture(status_code, capture_record, base_url, model='capture', phantomjs_timeout=phantomjs_timeout)
         # Call the s3 save function if s3 is configured, and perform callback if configured.
-        if app.config['USE_S3']:
-            if capture_record.callback:
-                s3_save(files_to_write, capture_record)
-                finisher(capture_record)
-            else:
-                s3_save(files_to_write, capture_record)
-        elif capture_record.callback:
-                finisher(capture_record)
+        store(files_to_write, capture_record, 'capture')
     # If the screenshot generation timed out, try to render again
     except subprocess32.TimeoutExpired as err:
         app.logger.error(err)
@@ -365,7 +602,7 @@ def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="
         capture_record.capture_status = str(err)
         capture_record.retry = retries + 1
         raise celery_capture.retry(args=[status_code, base_url],
-            kwargs={'capture_id' :capture_id, 'retries': capture_record.retry, 'model': 'capture', 'phantomjs_timeout': (capture_record.retry * 5) + phantomjs_timeout}, exc=err,
+            kwargs={'capture_id' :capture_id, 'retries': capture_record.retry, 'model': 'capture', 'phantomjs_timeout': timeouts.escalate(err.timeout, capture_record.retry)}, exc=err,
             countdown=app.config['COOLDOWN'],
             max_retries=app.config['MAX_RETRIES'])
     # Retry on connection error exceptions
@@ -378,6 +615,108 @@ def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="
             kwargs={'capture_id' :capture_id, 'retries': capture_record.retry, 'model': 'capture'}, exc=err,
             countdown=app.config['COOLDOWN'],
             max_retries=app.config['MAX_RETRIES'])
+    # The shared renderer is pushing back, try again later without counting a render retry
+    except renderer.RendererBusy as err:
+        app.logger.error(err)
+        capture_record.job_status = 'RETRY'
+        capture_record.capture_status = str(err)
+        raise self.retry(args=[status_code, base_url],
+            kwargs={'capture_id': capture_id, 'retries': retries, 'model': 'capture', 'phantomjs_timeout': phantomjs_timeout}, exc=err,
+            countdown=app.config['COOLDOWN'],
+            max_retries=app.config['MAX_RETRIES'])
+    # For all other exceptions, fail immediately
+    except Exception as err:
+        app.logger.error(err)
+        if str(err):
+            capture_record.capture_status = str(err)
+        capture_record.job_status = 'FAILURE'
+        raise Exception
+    finally:
+        politeness.release(lease)
+        db.session.commit()
+
+@celery.task(name='celery_fused_capture', ignore_result=True, bind=True)
+def celery_fused_capture(self, base_url, capture_id=0, retries=0, model="capture", phantomjs_timeout=None):
+    """
+    Celery task that checks, captures, stores and calls back in one go.
+
+    Replaces the check_url -> celery_capture chain when FUSED_PIPELINE is set:
+    the record is loaded once and only committed when the task starts and
+    when it ends.
+    """
+    capture_record = Capture.query.filter(Capture.id == capture_id).first()
+    # Defer the capture while the domain is busy
+    lease = politeness.acquire(self, capture_record.url)
+    metrics.queue_wait(self.name, capture_record)
+    capture_record.job_status = 'STARTED'
+    capture_record.retry = retries
+    db.session.add(capture_record)
+    db.session.commit()
+
+    try:
+        # Check the URL first, any error is worth a retry
+        try:
+            with metrics.timer('check_url'):
+                status_code = status.get_status_code(capture_record.url, cookies=phantomjs_cookies())
+            capture_record.url_response_code = status_code
+            capture_record.capture_status = '%s HTTP STATUS CODE' % (status_code)
+        except Exception as err:
+            app.logger.error(err)
+            capture_record.job_status = 'RETRY'
+            capture_record.capture_status = str(err)
+            capture_record.url_response_code = 0
+            capture_record.retry = retries + 1
+            raise celery_fused_capture.retry(args=[base_url],
+                kwargs={'capture_id': capture_id, 'retries': capture_record.retry, 'model': 'capture', 'phantomjs_timeout': phantomjs_timeout}, exc=err,
+                countdown=app.config['COOLDOWN'],
+                max_retries=app.config['MAX_RETRIES'])
+
+        # Perform a callback or complete the task depending on error code and config
+        if status_code > 400 and app.config['CAPTURE_ERRORS'] == False:
+            if capture_record.callback:
+                finisher(capture_record, commit=False)
+            else:
+                capture_record.job_status = 'COMPLETED'
+            return True
+        # Never render hosts in a blacklisted range
+        if skip_blacklisted(capture_record):
+            return True
+
+        # Capture, then either write to S3, perform a callback, or neither
+        files_to_write = do_capture(status_code, capture_record, base_url, model='capture', phantomjs_timeout=phantomjs_timeout, commit=False)
+        store(files_to_write, capture_record, 'capture', commit=False)
+    # If the screenshot generation timed out, try to render again
+    except subprocess32.TimeoutExpired as err:
+        app.logger.error(err)
+        capture_record.job_status = 'RETRY'
+        capture_record.capture_status = str(err)
+        capture_record.retry = retries + 1
+        raise celery_fused_capture.retry(args=[base_url],
+            kwargs={'capture_id': capture_id, 'retries': capture_record.retry, 'model': 'capture', 'phantomjs_timeout': timeouts.escalate(err.timeout, capture_record.retry)}, exc=err,
+            countdown=app.config['COOLDOWN'],
+            max_retries=app.config['MAX_RETRIES'])
+    # Retry on connection error exceptions
+    except ConnectionError as err:
+        app.logger.error(err)
+        capture_record.job_status = 'RETRY'
+        capture_record.capture_status = str(err)
+        capture_record.retry = retries + 1
+        raise celery_fused_capture.retry(args=[base_url],
+            kwargs={'capture_id': capture_id, 'retries': capture_record.retry, 'model': 'capture', 'phantomjs_timeout': phantomjs_timeout}, exc=err,
+            countdown=app.config['COOLDOWN'],
+            max_retries=app.config['MAX_RETRIES'])
+    # The shared renderer is pushing back, try again later without counting a render retry
+    except renderer.RendererBusy as err:
+        app.logger.error(err)
+        capture_record.job_status = 'RETRY'
+        capture_record.capture_status = str(err)
+        raise self.retry(args=[base_url],
+            kwargs={'capture_id': capture_id, 'retries': retries, 'model': 'capture', 'phantomjs_timeout': phantomjs_timeout}, exc=err,
+            countdown=app.config['COOLDOWN'],
+            max_retries=app.config['MAX_RETRIES'])
+    # Retries raised above must reach celery untouched
+    except Retry:
+        raise
     # For all other exceptions, fail immediately
     except Exception as err:
         app.logger.error(err)
@@ -385,5 +724,53 @@ def celery_capture(self, status_code, base_url, capture_id=0, retries=0, model="
             capture_record.capture_status = str(err)
         capture_record.job_status = 'FAILURE'
         raise Exception
+    finally:
+        politeness.release(lease)
+        db.session.commit()
+
+@celery.task(name='celery_upload', ignore_result=True, bind=True)
+def celery_upload(self, files_to_write, capture_id=0, retries=0, model='capture'):
+    """
+    Celery task that writes the files of a capture to S3 and posts its callback.
+
+    Upload errors are retried, the record fails once MAX_RETRIES is exhausted.
+    """
+    model_class = Static if model == 'static' else Capture
+    the_record = model_class.query.filter(model_class.id == capture_id).first()
+    metrics.queue_wait(self.name, the_record)
+    try:
+        s3_save(files_to_write, the_record)
+    except Exception as err:
+        app.logger.error(err)
+        raise celery_upload.retry(args=[files_to_write],
+            kwargs={'capture_id': capture_id, 'retries': retries + 1, 'model': model}, exc=err,
+            countdown=app.config['COOLDOWN'],
+            max_retries=app.config['MAX_RETRIES'])
+    if the_record.callback:
+        finisher(the_record)
+
+@celery.task(name='eager_capture', bind=True)
+def eager_capture(self, base_url, capture_id=0, model="capture", coalesce_key=None):
+    """
+    Celery task behind the eager endpoint, checks and captures a URL locally.
+
+    Returns the local file names by capture type for the web process to
+    serve. Eager captures are never uploaded to S3. coalesce_key is the redis
+    key other eager requests used to join this render, it is cleared once
+    the capture is done.
+    """
+    capture_record = Capture.query.filter(Capture.id == capture_id).first()
+    metrics.queue_wait(self.name, capture_record)
+    capture_record.job_status = 'STARTED'
+    db.session.add(capture_record)
+    db.session.commit()
+
+    try:
+        # Check that url is valid and responsive
+        if not url_is_responsive(capture_record):
+            raise Exception('Could not connect to URL')
+        return do_capture(200, capture_record, base_url, use_s3=False, skip_unchanged=False)
     finally:
         db.session.commit()
+        if coalesce_key:
+            get_redis().delete(coalesce_key)
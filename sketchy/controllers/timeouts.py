@@ -0,0 +1,95 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import math
+
+import redis
+
+from sketchy import app
+from sketchy.controllers.redis_client import get_redis
+from sketchy.controllers.validators import grab_registered_domain
+
+# Recent render durations of a registered domain, newest first
+RENDERS_KEY = 'sketchy:domain:{}:renders'
+# Forget the renders of a domain that has not been captured for a week
+RENDERS_TTL = 7 * 24 * 3600
+
+
+def _domain(url):
+    try:
+        return grab_registered_domain(url).lower()
+    except Exception:
+        return None
+
+
+def _clamp(seconds):
+    return min(max(seconds, app.config['RENDER_TIMEOUT_FLOOR']), app.config['RENDER_TIMEOUT_CEILING'])
+
+
+def record(url, seconds):
+    """
+    Remember how long a render of url took, a timed out render counts as its timeout.
+
+    A redis error is logged and never raised.
+    """
+    domain = _domain(url)
+    if not app.config['ADAPTIVE_TIMEOUTS'] or domain is None:
+        return
+    key = RENDERS_KEY.format(domain)
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.lpush(key, round(seconds, 3))
+        pipe.ltrim(key, 0, app.config['RENDER_TIMEOUT_HISTORY'] - 1)
+        pipe.expire(key, RENDERS_TTL)
+        pipe.execute()
+    except redis.RedisError as err:
+        app.logger.error(err)
+
+
+def percentile(samples, percent):
+    """
+    Return the nearest rank percentile of a list of numbers.
+    """
+    ordered = sorted(samples)
+    rank = int(math.ceil(percent / 100.0 * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def initial_timeout(url):
+    """
+    Return the timeout of the first render of url.
+
+    Once RENDER_TIMEOUT_MIN_SAMPLES renders of its registered domain are
+    known this is RENDER_TIMEOUT_FACTOR times their RENDER_TIMEOUT_PERCENTILE,
+    otherwise PHANTOMJS_TIMEOUT.
+    """
+    domain = _domain(url)
+    if not app.config['ADAPTIVE_TIMEOUTS'] or domain is None:
+        return app.config['PHANTOMJS_TIMEOUT']
+    try:
+        samples = [float(sample) for sample in get_redis().lrange(RENDERS_KEY.format(domain), 0, -1)]
+    except redis.RedisError as err:
+        app.logger.error(err)
+        return app.config['PHANTOMJS_TIMEOUT']
+    if len(samples) < app.config['RENDER_TIMEOUT_MIN_SAMPLES']:
+        return app.config['PHANTOMJS_TIMEOUT']
+    return _clamp(percentile(samples, app.config['RENDER_TIMEOUT_PERCENTILE']) * app.config['RENDER_TIMEOUT_FACTOR'])
+
+
+def escalate(timeout, retry):
+    """
+    Return the timeout of the render retried after a render timed out after timeout seconds.
+    """
+    if not app.config['ADAPTIVE_TIMEOUTS']:
+        return timeout + retry * 5
+    return _clamp(timeout * app.config['RENDER_TIMEOUT_BACKOFF'])
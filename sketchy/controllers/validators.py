@@ -11,19 +11,22 @@
 #     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
+import hashlib
 import requests
+import urlparse
 from sketchy import db, app
+from sketchy.controllers import status
 from tldextract import extract
 
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
 def get_server_status_code(url):
     """
     Return the server's status code.
     """
     # Only retrieve the headers of the request, and return response code
     try:
-        verify_ssl = app.config['SSL_HOST_VALIDATION']
-        response = requests.get(url, headers={"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.9; rv:28.0) Gecko/20100101 Firefox/28.0"}, verify=verify_ssl)
-        return response.status_code
+        return status.get_status_code(url, allow_redirects=True)
     except requests.ConnectionError:
         return None
     except StandardError:
@@ -42,6 +45,56 @@ def grab_domain(url):
     #concatenate subdomain, domain and tld
     return '.'.join((url[0], url[1], url[2])) if url[0] else '.'.join((url[1], url[2]))
 
+def grab_registered_domain(url):
+    """
+    Returns the registered domain of a URL, without its subdomain
+    """
+    try:
+        url = extract(url)
+    except Exception:
+        raise Exception("This URL doesn't work: \"{0}\"".format(url))
+    return '.'.join((url[1], url[2])) if url[2] else url[1]
+
+def normalize_url(url):
+    """
+    Returns a canonical form of a URL so equivalent URLs compare equal.
+
+    The scheme and host are lowercased, default ports and fragments are
+    dropped and an empty path becomes '/'.
+    """
+    parts = urlparse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ''
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = '{}:{}'.format(netloc, parts.port)
+    if parts.username:
+        credentials = parts.username
+        if parts.password:
+            credentials += ':' + parts.password
+        netloc = '{}@{}'.format(credentials, netloc)
+    return urlparse.urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+def url_hash(url):
+    """
+    Returns a fixed length key for the normalized form of a URL
+    """
+    try:
+        normalized = normalize_url(url)
+    except ValueError:
+        normalized = url.strip()
+    if isinstance(normalized, unicode):
+        normalized = normalized.encode('utf-8')
+    return hashlib.sha1(normalized).hexdigest()
+
+def url_list(value):
+    """
+    Request argument type of a JSON list of URLs, type=list would turn a
+    string into the list of its characters.
+    """
+    if not isinstance(value, list) or not all(isinstance(url, basestring) and url for url in value):
+        raise ValueError('URLs must be a list of URLs')
+    return value
+
 def check_url(capture_record):
     """
     Check if a URL exists without downloading the whole file.
@@ -0,0 +1,53 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+import datetime
+
+from sketchy import db
+
+def _get_date():
+    """Returns the current date when called"""
+    return datetime.datetime.now()
+
+class CallbackFailure(db.Model):
+    """
+    Dead letter record of a callback that could not be delivered
+
+    """
+    __tablename__ = 'CallbackFailure'
+
+    id = db.Column(db.Integer, primary_key=True)
+    model = db.Column(db.String(16), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False, index=True)
+    callback = db.Column(db.String(512), nullable=False)
+    payload = db.Column(db.Text)
+    error = db.Column(db.String(512))
+    attempts = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=_get_date, unique=False)
+
+    def as_dict(self):
+        """Return CallbackFailure model as a JSON object"""
+        failure_dict = {}
+
+        failure_dict['id'] = self.id
+        failure_dict['model'] = self.model
+        failure_dict['record_id'] = self.record_id
+        failure_dict['callback'] = self.callback
+        failure_dict['error'] = self.error
+        failure_dict['attempts'] = self.attempts
+        failure_dict['created_at'] = str(self.created_at)
+        return failure_dict
+
+    def __repr__(self):
+        """Return the callback of the object"""
+        return '<Callback %r' % self.callback
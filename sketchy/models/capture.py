@@ -12,6 +12,7 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 import datetime
+import json
 
 from sketchy import db
 
@@ -28,9 +29,11 @@ class Capture(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     url = db.Column(db.String(512), unique=False, nullable=False)
-    job_status = db.Column(db.String(512), unique=False)
+    url_hash = db.Column(db.String(40), index=True)
+    domain = db.Column(db.String(255), index=True)
+    job_status = db.Column(db.String(64), unique=False, index=True)
     capture_status = db.Column(db.String(512), unique=False)
-    created_at = db.Column(db.DateTime, default=_get_date, unique=False)
+    created_at = db.Column(db.DateTime, default=_get_date, unique=False, index=True)
     modified_at = db.Column(db.DateTime, onupdate=_get_date, unique=False)
     sketch_url = db.Column(db.String(1500), unique=False)
     scrape_url = db.Column(db.String(1500), unique=False)
@@ -39,6 +42,15 @@ class Capture(db.Model):
     callback = db.Column(db.String(512))
     retry = db.Column(db.Integer)
     url_response_code = db.Column(db.Integer, unique=False)
+    batch_id = db.Column(db.String(36), index=True)
+    thumbnail_url = db.Column(db.String(1500), unique=False)
+    # JSON of the render options set by the request
+    render_options = db.Column(db.Text)
+    # 64 bit hex perceptual hash of the sketch and SimHash of the scrape
+    sketch_hash = db.Column(db.String(16), index=True)
+    scrape_hash = db.Column(db.String(16), index=True)
+    # Number of requests the page made that the block list aborted
+    blocked_requests = db.Column(db.Integer)
 
     def __init__(self):
         self.job_status = 'CREATED'
@@ -61,7 +73,19 @@ class Capture(db.Model):
         sketch_dict['sketch_url'] = self.sketch_url
         sketch_dict['scrape_url'] = self.scrape_url
         sketch_dict['html_url'] = self.html_url
+        if self.thumbnail_url is not None:
+            sketch_dict['thumbnail_url'] = self.thumbnail_url
+        if self.render_options is not None:
+            sketch_dict['render_options'] = json.loads(self.render_options)
+        if self.sketch_hash is not None:
+            sketch_dict['sketch_hash'] = self.sketch_hash
+        if self.scrape_hash is not None:
+            sketch_dict['scrape_hash'] = self.scrape_hash
+        if self.blocked_requests is not None:
+            sketch_dict['blocked_requests'] = self.blocked_requests
         sketch_dict['url_response_code'] = self.url_response_code
+        if self.batch_id is not None:
+            sketch_dict['batch_id'] = self.batch_id
         return sketch_dict
 
     def __repr__(self):
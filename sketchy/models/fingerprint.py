@@ -0,0 +1,36 @@
+#     Copyright 2014 Netflix, Inc.
+#
+#     Licensed under the Apache License, Version 2.0 (the "License");
+#     you may not use this file except in compliance with the License.
+#     You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#     Unless required by applicable law or agreed to in writing, software
+#     distributed under the License is distributed on an "AS IS" BASIS,
+#     WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#     See the License for the specific language governing permissions and
+#     limitations under the License.
+from sketchy import db
+
+class HashBand(db.Model):
+    """
+    One band of the sketch or scrape hash of a capture
+
+    Every 64 bit hash is stored as BANDS 16 bit bands, two hashes within
+    BANDS - 1 bits of each other always share at least one band. Looking up
+    the bands of a hash finds its near duplicates without a table scan.
+
+    """
+    __tablename__ = 'HashBand'
+    __table_args__ = (db.Index('ix_HashBand_lookup', 'kind', 'band', 'value'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    capture_id = db.Column(db.Integer, nullable=False, index=True)
+    kind = db.Column(db.String(8), nullable=False)
+    band = db.Column(db.Integer, nullable=False)
+    value = db.Column(db.String(4), nullable=False)
+
+    def __repr__(self):
+        """Return the band of the object"""
+        return '<HashBand %r %r' % (self.kind, self.value)
@@ -12,6 +12,7 @@
 #     See the License for the specific language governing permissions and
 #     limitations under the License.
 import datetime
+import json
 
 from sketchy import db
 
@@ -28,15 +29,18 @@ class Static(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(512), unique=False, nullable=False)
-    job_status = db.Column(db.String(512), unique=False)
+    job_status = db.Column(db.String(64), unique=False, index=True)
     capture_status = db.Column(db.String(512), unique=False)
-    created_at = db.Column(db.DateTime, default=_get_date, unique=False)
+    created_at = db.Column(db.DateTime, default=_get_date, unique=False, index=True)
     modified_at = db.Column(db.DateTime, onupdate=_get_date, unique=False)
     sketch_url = db.Column(db.String(1500), unique=False)
     scrape_url = db.Column(db.String(1500), unique=False)
     html_url = db.Column(db.String(1500), unique=False)
     callback = db.Column(db.String(512))
     retry = db.Column(db.Integer)
+    thumbnail_url = db.Column(db.String(1500), unique=False)
+    # JSON of the render options set by the request
+    render_options = db.Column(db.Text)
 
     def __init__(self):
         self.job_status = 'CREATED'
@@ -57,6 +61,10 @@ class Static(db.Model):
         sketch_dict['sketch_url'] = self.sketch_url
         sketch_dict['scrape_url'] = self.scrape_url
         sketch_dict['html_url'] = self.html_url
+        if self.thumbnail_url is not None:
+            sketch_dict['thumbnail_url'] = self.thumbnail_url
+        if self.render_options is not None:
+            sketch_dict['render_options'] = json.loads(self.render_options)
         return sketch_dict
 
     def __repr__(self):
@@ -19,7 +19,7 @@ sys.path = [os.path.abspath(os.path.dirname(__file__))] + sys.path
 import json
 import unittest
 from sketchy import app, db
-from sketchy.controllers import tasks
+from sketchy.controllers import storage, tasks
 
 class Sketch(unittest.TestCase):
     app.config.from_object('config-test')
@@ -33,6 +33,30 @@ class Sketch(unittest.TestCase):
         db.drop_all()
 
 
+    def serve(self, handler):
+        """Serve handler on a local port until the end of the test, returns the base URL"""
+        import threading
+        from BaseHTTPServer import HTTPServer
+
+        server = HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.shutdown)
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def fake_executable(self, *lines):
+        """Write a python script standing in for an executable until the end of the test, returns its path"""
+        import stat
+        import tempfile
+
+        script = tempfile.NamedTemporaryFile(suffix='.py', delete=False)
+        self.addCleanup(os.remove, script.name)
+        script.write('\n'.join(('#!' + sys.executable,) + lines + ('',)))
+        script.close()
+        os.chmod(script.name, os.stat(script.name).st_mode | stat.S_IEXEC)
+        return script.name
+
     def check_content_type(self, headers):
         self.assertEquals(headers['Content-Type'], 'application/json')
 
@@ -111,9 +135,9 @@ class SketchApiTestCase(Sketch):
         self.assertEquals(files_to_write['scrape'], 'xkcd.com_1.txt')
 
         try:
-            os.remove(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], 'xkcd.com_1.html'))
-            os.remove(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], 'xkcd.com_1.png'))
-            os.remove(os.path.join(app.config['LOCAL_STORAGE_FOLDER'], 'xkcd.com_1.txt'))
+            os.remove(storage.artifact_path('xkcd.com_1.html'))
+            os.remove(storage.artifact_path('xkcd.com_1.png'))
+            os.remove(storage.artifact_path('xkcd.com_1.txt'))
         except:
             pass
 
@@ -152,3 +176,1076 @@ class SketchApiTestCase(Sketch):
             rst = tasks.check_url.delay(capture_id=capture_record.id).get()
         except Exception as err:
             self.assertEquals(str(err.message), 'None: Max retries exceeded with url: / (Caused by redirect)')
+
+    def test_batch_without_urls(self):
+        code, data = self.post('/api/v1.0/capture/batch', {'urls': []})
+
+        self.assertEquals(code, 400)
+        # A string is not a list of its characters
+        for urls in ('http://ab.com', ['http://ab.com', ''], ['http://ab.com', 42], {'url': 'http://ab.com'}):
+            code, data = self.post('/api/v1.0/capture/batch', {'urls': urls})
+            self.assertEquals(code, 400)
+
+    def test_batch_progress(self):
+        from sketchy.models.capture import Capture
+        for job_status in ('COMPLETED', 'FAILURE', 'STARTED'):
+            capture_record = Capture()
+            capture_record.url = 'http://xkcd.com'
+            capture_record.job_status = job_status
+            capture_record.batch_id = 'test-batch'
+            db.session.add(capture_record)
+        db.session.commit()
+
+        code, data = self.get('/api/v1.0/capture/batch/test-batch')
+        self.assertEquals(code, 200)
+        self.assertEquals(data['total'], 3)
+        self.assertEquals(data['completed'], 1)
+        self.assertEquals(data['failed'], 1)
+        self.assertFalse(data['finished'])
+
+    def test_extract_text(self):
+        from sketchy.controllers.extract import extract_text
+        html_path = os.path.join(app.config['LOCAL_STORAGE_FOLDER'], 'extract_test.html')
+        text_path = os.path.join(app.config['LOCAL_STORAGE_FOLDER'], 'extract_test.txt')
+        with open(html_path, 'w') as html_file:
+            html_file.write('<html><head><script>var x = 1;</script><style>p {}</style></head>'
+                            '<body><!-- hidden --><h1>Title</h1><p>Some text</p></body></html>')
+        try:
+            extract_text(html_path, text_path, encoding='utf-8')
+            with open(text_path) as text_file:
+                self.assertEquals(text_file.read(), 'Title Some text ')
+        finally:
+            os.remove(html_path)
+            os.remove(text_path)
+
+    def test_normalize_url(self):
+        from sketchy.controllers.validators import normalize_url, url_hash
+        self.assertEquals(normalize_url('HTTP://XKCD.com:80#top'), 'http://xkcd.com/')
+        self.assertEquals(normalize_url('https://xkcd.com:8443/a?b=c'), 'https://xkcd.com:8443/a?b=c')
+        self.assertEquals(url_hash('http://xkcd.com'), url_hash('http://XKCD.com/'))
+
+    def test_capture_cache(self):
+        import datetime
+        from sketchy.controllers import cache, callbacks
+        from sketchy.models.capture import Capture
+        from sketchy.controllers.validators import url_hash
+        capture_record = Capture()
+        capture_record.url = 'http://xkcd.com'
+        capture_record.url_hash = url_hash('http://xkcd.com')
+        capture_record.job_status = 'COMPLETED'
+        capture_record.sketch_url = 'http://127.0.0.1:8000/files/xkcd.com_1.png'
+        db.session.add(capture_record)
+        db.session.commit()
+        # modified_at is only set on update
+        capture_record.capture_status = 'LOCAL_CAPTURES_CREATED'
+        db.session.commit()
+
+        sent = []
+
+        class DeliverCallback(object):
+            def apply_async(self, args):
+                sent.append(args)
+
+        self.addCleanup(setattr, callbacks, 'deliver_callback', callbacks.deliver_callback)
+        callbacks.deliver_callback = DeliverCallback()
+
+        app.config.update(CAPTURE_CACHE_TTL=60)
+        try:
+            code, data = self.post('/api/v1.0/capture', {'url': 'http://XKCD.com/'})
+            # Cache hits are never served again, they would keep the first render fresh forever
+            code, again = self.post('/api/v1.0/capture', {'url': 'http://xkcd.com', 'callback': 'http://127.0.0.1/callback'})
+            Capture.query.filter(Capture.id == 1).update(
+                {'modified_at': datetime.datetime.now() - datetime.timedelta(seconds=120)})
+            db.session.commit()
+            self.assertIsNone(cache.find_cached_capture(url_hash('http://xkcd.com')))
+        finally:
+            app.config.update(CAPTURE_CACHE_TTL=0)
+
+        self.assertEquals(code, 201)
+        self.assertEquals(data['job_status'], 'COMPLETED')
+        self.assertEquals(data['sketch_url'], 'http://127.0.0.1:8000/files/xkcd.com_1.png')
+        self.assertEquals(data['capture_status'], 'CACHED_FROM:1')
+        self.assertEquals(again['capture_status'], 'CACHED_FROM:1')
+        # The callback of a cache hit goes to the callback workers
+        self.assertEquals([(callback, entries[0]['id']) for callback, entries in sent],
+                          [('http://127.0.0.1/callback', again['id'])])
+
+    def test_capture_list_pagination(self):
+        from sketchy.models.capture import Capture
+        for url in ('http://xkcd.com', 'http://google.com', 'http://xkcd.com/1'):
+            capture_record = Capture()
+            capture_record.url = url
+            capture_record.domain = url.split('/')[2]
+            db.session.add(capture_record)
+        db.session.commit()
+
+        rv = self.test_app.get('/api/v1.0/capture?limit=2', content_type='application/json')
+        data = json.loads(rv.data)
+        self.assertEquals([row['id'] for row in data], [3, 2])
+        self.assertIn('after_id=2', rv.headers['Link'])
+
+        code, data = self.get('/api/v1.0/capture?limit=2&after_id=2')
+        self.assertEquals([row['id'] for row in data], [1])
+
+        code, data = self.get('/api/v1.0/capture?domain=xkcd.com')
+        self.assertEquals([row['id'] for row in data], [3, 1])
+
+    def test_status_code_head_fallback(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from sketchy.controllers.status import get_status_code
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_response(405 if self.path == '/nohead' else 204)
+                self.end_headers()
+
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write('body')
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serve(Handler)
+        self.assertEquals(get_status_code(base + '/'), 204)
+        self.assertEquals(get_status_code(base + '/nohead'), 200)
+
+    def test_sessions_drop_cookies(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from sketchy.controllers import callbacks, status
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                received.append(self.headers.get('Cookie'))
+                self.send_response(200)
+                self.send_header('Set-Cookie', 'tracker=1; Path=/')
+                self.end_headers()
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.do_HEAD()
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serve(Handler)
+        for cookies in (None, None, {'phantom': '1'}):
+            status.get_status_code(base + '/', cookies=cookies)
+        callbacks.post_callback(base + '/callback', {})
+        callbacks.post_callback(base + '/callback', {})
+        # Cookies of a request are still sent, those the checked site set are never kept
+        self.assertEquals(received, [None, None, 'phantom=1', None, None])
+        self.assertEquals(len(status.get_session().cookies), 0)
+        self.assertEquals(len(callbacks.get_session(base + '/callback').cookies), 0)
+
+    def test_deliver_callback(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from sketchy.models.capture import Capture
+        from sketchy.models.callback import CallbackFailure
+        from sketchy.controllers.callbacks import deliver_callback
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(500 if self.path == '/broken' else 200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serve(Handler)
+        capture_record = Capture()
+        capture_record.url = 'http://xkcd.com'
+        capture_record.callback = base + '/'
+        db.session.add(capture_record)
+        db.session.commit()
+
+        # Tasks remove the session when they return
+        capture_id = capture_record.id
+        entries = [{'model': 'capture', 'id': capture_id, 'payload': capture_record.as_dict()}]
+        deliver_callback(base + '/', entries)
+        self.assertEquals(received[0]['id'], capture_id)
+        self.assertEquals(Capture.query.get(capture_id).job_status, 'COMPLETED')
+
+        app.config.update(CALLBACK_MAX_RETRIES=0)
+        try:
+            deliver_callback(base + '/broken', entries)
+        finally:
+            app.config.update(CALLBACK_MAX_RETRIES=5)
+        self.assertEquals(Capture.query.get(capture_id).job_status, 'FAILURE')
+        self.assertEquals(CallbackFailure.query.filter(CallbackFailure.record_id == capture_id).count(), 1)
+
+    def test_blacklisted_ip(self):
+        from sketchy.controllers.blacklist import blacklisted_ip
+        app.config.update(IP_BLACKLISTING=True, IP_BLACKLISTING_RANGE='127.0.0.0/8, ::1/128')
+        try:
+            self.assertEquals(blacklisted_ip('http://127.0.0.1:8000/path'), '127.0.0.1')
+            self.assertEquals(blacklisted_ip('http://[::1]/'), '::1')
+            app.config.update(IP_BLACKLISTING_RANGE='10.0.0.0/8')
+            self.assertEquals(blacklisted_ip('http://127.0.0.1/'), None)
+        finally:
+            app.config.update(IP_BLACKLISTING=False)
+
+    def test_encode_sketch(self):
+        import shutil
+        import tempfile
+        from PIL import Image
+        from sketchy.controllers import images
+        from sketchy.models.capture import Capture
+
+        capture_record = Capture()
+        self.assertEquals(images.render_extension(images.sketch_options(capture_record)), 'png')
+        capture_record.render_options = images.request_options({'format': 'jpeg', 'quality': 50, 'thumbnail': True})
+        options = images.sketch_options(capture_record)
+        self.assertEquals(options['format'], 'jpeg')
+        self.assertEquals(options['max_height'], 0)
+        self.assertEquals(images.render_extension(options), 'bmp')
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        raw_path = os.path.join(folder, 'page.bmp')
+        Image.new('RGB', (1280, 3000), (255, 0, 0)).save(raw_path)
+        images.encode(raw_path, os.path.join(folder, 'page.jpg'), options,
+                      thumbnail_path=os.path.join(folder, 'page_thumb.jpg'))
+        self.assertFalse(os.path.exists(raw_path))
+        self.assertEquals(Image.open(os.path.join(folder, 'page.jpg')).size, (1280, 3000))
+        self.assertEquals(Image.open(os.path.join(folder, 'page_thumb.jpg')).size, app.config['THUMBNAIL_SIZE'])
+        self.assertEquals(images.content_type('page.webp'), 'image/webp')
+
+    def test_compressed_artifact(self):
+        import gzip
+        import StringIO
+        from sketchy.controllers import storage
+
+        with open(storage.artifact_path('compressed_test.txt', create=True), 'w') as text_file:
+            text_file.write('sketchy ' * 1000)
+        app.config.update(ARTIFACT_COMPRESSION='gzip')
+        try:
+            stored_name = storage.compress('compressed_test.txt')
+        finally:
+            app.config.update(ARTIFACT_COMPRESSION='')
+        self.addCleanup(os.remove, storage.artifact_path(stored_name))
+        self.assertEquals(stored_name, 'compressed_test.txt.gz')
+        self.assertEquals(storage.logical_name(stored_name), 'compressed_test.txt')
+        self.assertFalse(os.path.exists(storage.artifact_path('compressed_test.txt')))
+
+        rv = self.test_app.get('/files/compressed_test.txt', headers=[('Accept-Encoding', 'gzip, deflate')])
+        self.assertEquals(rv.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(rv.headers['Content-Type'].startswith('text/plain'))
+        self.assertEquals(gzip.GzipFile(fileobj=StringIO.StringIO(rv.data)).read(), 'sketchy ' * 1000)
+
+        rv = self.test_app.get('/files/compressed_test.txt')
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertEquals(rv.data, 'sketchy ' * 1000)
+        self.assertEquals(self.test_app.get('/files/missing.txt').status_code, 404)
+
+    def test_storage_eviction(self):
+        import shutil
+        import tempfile
+        import time
+        from sketchy.models.capture import Capture
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        original = app.config['LOCAL_STORAGE_FOLDER']
+        app.config.update(LOCAL_STORAGE_FOLDER=folder)
+        self.addCleanup(app.config.update, LOCAL_STORAGE_FOLDER=original)
+
+        self.addCleanup(app.config.update, STORAGE_SHARD_DEPTH=app.config['STORAGE_SHARD_DEPTH'])
+        app.config.update(STORAGE_SHARD_DEPTH=2)
+
+        # The flat layout is served until it migrates to shard folders shared by a capture's artifacts
+        with open(os.path.join(folder, 'example.com_1.png'), 'w') as flat_file:
+            flat_file.write('x' * 100)
+        self.assertEquals(storage.find_artifact('example.com_1.png'), 'example.com_1.png')
+        self.assertEquals(storage.migrate_layout(), 1)
+        self.assertTrue(os.path.isfile(storage.artifact_path('example.com_1.png')))
+        # and so does a change of depth, leaving no empty folders behind
+        app.config.update(STORAGE_SHARD_DEPTH=1)
+        self.assertEquals(storage.migrate_layout(), 1)
+        self.assertTrue(os.path.isfile(storage.artifact_path('example.com_1.png')))
+        self.assertEquals(sorted(os.listdir(folder)), [os.path.basename(storage.artifact_dir('example.com_1'))])
+        self.assertEquals(os.path.dirname(storage.artifact_path('example.com_1.png')),
+                          os.path.dirname(storage.artifact_path('example.com_1_thumb.jpg')))
+        self.assertEquals(os.path.dirname(storage.artifact_path('example.com_1.png')),
+                          os.path.dirname(storage.artifact_path('example.com_1.txt.gz')))
+
+        finished = Capture()
+        finished.url = 'http://example.com'
+        finished.job_status = 'COMPLETED'
+        running = Capture()
+        running.url = 'http://example.com'
+        db.session.add_all([finished, running])
+        db.session.commit()
+
+        now = time.time()
+        for name, age in (('example.com_1.png', 300), ('example.com_{}.txt'.format(running.id), 400),
+                          ('example.com_{}.html'.format(finished.id), 200), ('example.com_3.png', 10)):
+            path = storage.artifact_path(name, create=True)
+            with open(path, 'w') as artifact:
+                artifact.write('x' * 100)
+            os.utime(path, (now - age, now - age))
+
+        # Over budget, the oldest finished artifacts outside the grace period go first
+        self.assertEquals(storage.evict(250, 0, 60), (2, 200))
+        self.assertFalse(os.path.exists(storage.artifact_path('example.com_1.png')))
+        self.assertTrue(os.path.exists(storage.artifact_path('example.com_{}.txt'.format(running.id))))
+        self.assertTrue(os.path.exists(storage.artifact_path('example.com_3.png')))
+        self.assertEquals(storage.evict(0, 100, 60), (0, 0))
+
+    def test_storage_janitor_per_host(self):
+        import shutil
+        import socket
+        import tempfile
+        from sketchy.controllers.redis_client import get_redis
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.addCleanup(app.config.update, **dict((name, app.config[name]) for name in (
+            'LOCAL_STORAGE_FOLDER', 'STORAGE_MAX_BYTES')))
+        app.config.update(LOCAL_STORAGE_FOLDER=folder, STORAGE_MAX_BYTES=1)
+        lock = storage.JANITOR_LOCK.format(socket.gethostname())
+        other_lock = storage.JANITOR_LOCK.format('other-' + socket.gethostname())
+        self.addCleanup(get_redis().delete, lock, other_lock)
+
+        # The janitor of another host never holds back the janitor of this one
+        get_redis().set(other_lock, 1)
+        self.assertTrue(storage.storage_janitor())
+        self.assertEquals(get_redis().get(lock), None)
+        get_redis().set(lock, 1)
+        self.assertFalse(storage.storage_janitor())
+
+    def test_change_detection(self):
+        import shutil
+        import tempfile
+        from PIL import Image, ImageDraw
+        from sketchy.controllers import fingerprint
+        from sketchy.controllers.validators import url_hash
+        from sketchy.models.capture import Capture
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        text = ' '.join('word{}'.format(i) for i in range(300))
+        pages = (('before', text, 40), ('after', text + ' one more', 42), ('redesign', 'nothing alike', 600))
+        ids = []
+        for name, words, box in pages:
+            image = Image.new('RGB', (1280, 800), (255, 255, 255))
+            ImageDraw.Draw(image).rectangle((100, 100, 100 + box, 400), fill=(0, 0, 0))
+            image.save(os.path.join(folder, name + '.png'))
+            with open(os.path.join(folder, name + '.txt'), 'w') as text_file:
+                text_file.write(words)
+            capture_record = Capture()
+            capture_record.url = 'http://example.com'
+            capture_record.url_hash = url_hash(capture_record.url)
+            capture_record.job_status = 'COMPLETED'
+            db.session.add(capture_record)
+            db.session.commit()
+            fingerprint.fingerprint(capture_record, os.path.join(folder, name + '.png'),
+                                    os.path.join(folder, name + '.txt'))
+            db.session.commit()
+            ids.append(capture_record.id)
+
+        response = self.test_app.get('/api/v1.0/capture/{}/changes'.format(ids[0]))
+        self.assertIsNone(json.loads(response.data)['previous_id'])
+        changes = json.loads(self.test_app.get('/api/v1.0/capture/{}/changes'.format(ids[1])).data)
+        self.assertEquals(changes['previous_id'], ids[0])
+        self.assertFalse(changes['changed'])
+        changes = json.loads(self.test_app.get('/api/v1.0/capture/{}/changes'.format(ids[2])).data)
+        self.assertTrue(changes['sketch_changed'])
+        self.assertTrue(changes['scrape_changed'])
+
+        response = self.test_app.get('/api/v1.0/capture/{}/similar?type=scrape'.format(ids[0]))
+        self.assertEquals([capture['id'] for capture in json.loads(response.data)['captures']], [ids[1]])
+        # The capture itself never takes a place in the limit
+        response = self.test_app.get('/api/v1.0/capture/{}/similar?type=scrape&limit=1'.format(ids[0]))
+        self.assertEquals([capture['id'] for capture in json.loads(response.data)['captures']], [ids[1]])
+        sketch_hash = Capture.query.filter(Capture.id == ids[2]).first().sketch_hash
+        response = self.test_app.get('/api/v1.0/capture/similar?hash={}&distance=0'.format(sketch_hash))
+        self.assertEquals([capture['id'] for capture in json.loads(response.data)['captures']], [ids[2]])
+        self.assertEquals(self.test_app.get('/api/v1.0/capture/similar?hash=xyz').status_code, 400)
+
+        # Only the top of a long page is hashed
+        image = Image.open(os.path.join(folder, 'before.png'))
+        long_page = Image.new('RGB', (1280, 20000), (0, 0, 0))
+        long_page.paste(image, (0, 0))
+        long_page.save(os.path.join(folder, 'long.png'))
+        self.assertEquals(fingerprint.dhash(os.path.join(folder, 'long.png')),
+                          fingerprint.dhash(os.path.join(folder, 'before.png')))
+
+    def test_fingerprint_failure(self):
+        import shutil
+        import tempfile
+        from sketchy.models.capture import Capture
+
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.addCleanup(app.config.update, **dict((name, app.config[name]) for name in (
+            'LOCAL_STORAGE_FOLDER', 'PHANTOMJS', 'FINGERPRINT_CAPTURES')))
+        # A capture.js stand-in whose sketch cannot be decoded
+        fake_phantomjs = self.fake_executable(
+            'import json, sys',
+            'open(sys.argv[5] + "." + sys.argv[8], "w").write("not an image")',
+            'open(sys.argv[5] + ".html", "w").write("<html><body><p>Hello</p></body></html>")',
+            'print json.dumps({"status": "success", "blocked": 0})')
+        app.config.update(LOCAL_STORAGE_FOLDER=folder, PHANTOMJS=fake_phantomjs, FINGERPRINT_CAPTURES=True)
+
+        capture_record = Capture()
+        capture_record.url = 'http://example.com/'
+        db.session.add(capture_record)
+        db.session.commit()
+        tasks.do_capture(200, capture_record, app.config['BASE_URL'], use_s3=False)
+        capture_record = Capture.query.get(capture_record.id)
+        self.assertEquals(capture_record.job_status, 'COMPLETED')
+        self.assertIsNone(capture_record.sketch_hash)
+        self.assertIsNone(capture_record.scrape_hash)
+
+    def test_search_scrapes(self):
+        import tempfile
+        from sketchy.controllers import search
+        from sketchy.models.capture import Capture
+
+        self.assertEquals(self.test_app.get('/api/v1.0/capture/search?q=netflix').status_code, 404)
+        app.config.update(SEARCH_ENABLED=True)
+        self.addCleanup(app.config.update, SEARCH_ENABLED=False)
+        db.drop_all()
+        db.create_all()
+
+        ids = []
+        for words in ('Netflix streaming', 'netflix netflix netflix streaming', 'nothing to see'):
+            capture_record = Capture()
+            capture_record.url = 'http://example.com'
+            db.session.add(capture_record)
+            db.session.commit()
+            with tempfile.NamedTemporaryFile() as text_file:
+                text_file.write(words)
+                text_file.flush()
+                search.index(capture_record, text_file.name)
+            db.session.commit()
+            ids.append(capture_record.id)
+
+        response = self.test_app.get('/api/v1.0/capture/search?q=NETFLIX&limit=1')
+        self.assertEquals([capture['id'] for capture in json.loads(response.data)], [ids[1]])
+        self.assertIn('offset=1', response.headers['Link'])
+        response = self.test_app.get('/api/v1.0/capture/search?q=netflix&limit=1&offset=1')
+        self.assertEquals([capture['id'] for capture in json.loads(response.data)], [ids[0]])
+        self.assertNotIn('Link', response.headers)
+        response = self.test_app.get('/api/v1.0/capture/search?q="Streaming*"')
+        self.assertEquals(len(json.loads(response.data)), 2)
+        self.assertEquals(self.test_app.get('/api/v1.0/capture/search?q=%2A').status_code, 400)
+
+    def test_task_routing(self):
+        from sketchy import celery
+        from sketchy.controllers.controller import capture_signature
+
+        queues = app.config['SKETCHY_QUEUES']
+        for task, kind in (('check_url', 'status'), ('celery_capture', 'render'), ('eager_capture', 'interactive'),
+                           ('celery_upload', 'upload'), ('deliver_callback', 'callback')):
+            self.assertEquals(celery.amqp.router.route({}, task)['queue'].name, queues[kind])
+        signature = capture_signature(1, True, app.config['BASE_URL'], 'high')
+        self.assertEquals(signature.options['priority'], app.config['TASK_PRIORITIES']['high'])
+
+        response = self.test_app.post('/api/v1.0/capture', data=json.dumps({'url': 'http://example.com', 'priority': 'urgent'}),
+                                      content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_render_timeouts(self):
+        from sketchy.controllers import timeouts
+
+        self.assertEquals(timeouts.percentile([3, 1, 2, 10], 95), 10)
+        self.assertEquals(timeouts.percentile(range(1, 101), 95), 95)
+        self.assertEquals(timeouts.escalate(35, 1), 40)
+        self.assertEquals(timeouts.initial_timeout('http://example.com'), app.config['PHANTOMJS_TIMEOUT'])
+        app.config.update(ADAPTIVE_TIMEOUTS=True)
+        try:
+            self.assertEquals(timeouts.escalate(20, 1), 40)
+            self.assertEquals(timeouts.escalate(100, 2), app.config['RENDER_TIMEOUT_CEILING'])
+        finally:
+            app.config.update(ADAPTIVE_TIMEOUTS=False)
+
+    def test_settle_options(self):
+        from sketchy.controllers import images, settle
+        from sketchy.models.capture import Capture
+
+        capture_record = Capture()
+        self.assertEquals(settle.settle_options(capture_record)['settle'], app.config['SETTLE_MODE'])
+        capture_record.render_options = images.request_options({'settle': 'adaptive', 'idle_time': 100, 'format': 'jpeg'})
+        job = settle.job_options(settle.settle_options(capture_record))
+        self.assertEquals(job['settle'], 'adaptive')
+        self.assertEquals(job['idleTime'], 100)
+        self.assertEquals(job['maxTimeout'], app.config['SETTLE_MAX_TIMEOUT'])
+
+        response = self.test_app.post('/api/v1.0/capture', data=json.dumps({'url': 'http://example.com', 'max_timeout': 60000}),
+                                      content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_block_lists(self):
+        import re
+        from sketchy.controllers import blocking, images
+        from sketchy.models.capture import Capture
+
+        capture_record = Capture()
+        self.assertEquals(blocking.job_options(blocking.block_list(capture_record)), {'blockPatterns': [], 'blockTypes': []})
+        capture_record.render_options = images.request_options({'block': 'fast'})
+        job = blocking.job_options(blocking.block_list(capture_record))
+        self.assertEquals(job['blockTypes'], ['font', 'media'])
+        patterns = [re.compile(pattern, re.IGNORECASE) for pattern in job['blockPatterns']]
+        blocked = lambda url: any(pattern.search(url) for pattern in patterns)
+        self.assertTrue(blocked('https://stats.g.doubleclick.net/r/collect?v=1'))
+        self.assertTrue(blocked('http://www.Google-Analytics.com:80/analytics.js'))
+        self.assertFalse(blocked('http://doubleclick.net.example.com/'))
+        self.assertFalse(blocked('http://example.com/collections/shoes'))
+
+        response = self.test_app.post('/api/v1.0/capture', data=json.dumps({'url': 'http://example.com', 'block': 'everything'}),
+                                      content_type='application/json')
+        self.assertEquals(response.status_code, 400)
+
+    def test_shared_renderer(self):
+        import subprocess32
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from sketchy.controllers import renderer
+
+        replies = [{'status': 'fail', 'error': 'Renderer is recycling', 'retry': True},
+                   {'status': 'fail', 'error': 'Render timed out after 1000ms', 'timeout': True}]
+        jobs = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                jobs.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                body = json.dumps(replies.pop(0))
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        app.config.update(RENDERER_URL=self.serve(Handler) + '/')
+        try:
+            shared = renderer.get_pool()
+            self.assertTrue(isinstance(shared, renderer.SharedRenderer))
+            self.assertRaises(subprocess32.TimeoutExpired, shared.render, {'url': 'http://example.com'}, 1)
+            self.assertEquals([job['timeout'] for job in jobs], [1000, 1000])
+        finally:
+            app.config.update(RENDERER_URL='')
+            renderer.shutdown_pool()
+            renderer._pool = None
+
+    def test_renderer_busy(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from sketchy.controllers import renderer
+        from sketchy.models.capture import Capture
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                body = json.dumps({'status': 'fail', 'error': 'Renderer is recycling', 'retry': True})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.addCleanup(setattr, renderer, '_pool', None)
+        self.addCleanup(app.config.update, RENDERER_URL='', RENDERER_STARTUP_TIMEOUT=app.config['RENDERER_STARTUP_TIMEOUT'])
+        app.config.update(RENDERER_URL=self.serve(Handler) + '/', RENDERER_STARTUP_TIMEOUT=0.3)
+        renderer._pool = None
+
+        capture_record = Capture()
+        capture_record.url = 'http://example.com'
+        capture_record.url_response_code = 200
+        db.session.add(capture_record)
+        db.session.commit()
+        capture_id = capture_record.id
+
+        # A renderer that keeps refusing jobs is back-pressure, not a failed render
+        self.assertRaises(renderer.RendererBusy, tasks.celery_capture, 200, app.config['BASE_URL'], capture_id=capture_id)
+        capture_record = Capture.query.get(capture_id)
+        self.assertEquals((capture_record.job_status, capture_record.capture_status, capture_record.retry),
+                          ('RETRY', 'Renderer is recycling', 0))
+
+    def test_bulk_check_urls(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from celery.exceptions import Retry
+        from sketchy.controllers import bulk_status
+        from sketchy.models.capture import Capture
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_response(404 if self.path == '/missing' else 200)
+                self.end_headers()
+
+            def do_POST(self):
+                received.append((self.path, json.loads(self.rfile.read(int(self.headers['Content-Length'])))))
+                self.send_response(500 if self.path == '/broken' else 200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serve(Handler)
+        self.assertEquals([capture_id for capture_id, url in bulk_status._interleave(
+            {1: 'http://a.com/1', 2: 'http://a.com/2', 3: 'http://b.com/'})], [1, 3, 2])
+
+        capture_ids = []
+        for url, callback in ((base + '/', None), (base + '/missing', base + '/broken'),
+                              (base + '/', base + '/callback'), ('http://127.0.0.1:1/', None)):
+            capture_record = Capture()
+            capture_record.url = url
+            capture_record.status_only = True
+            capture_record.callback = callback
+            db.session.add(capture_record)
+            db.session.commit()
+            capture_ids.append(capture_record.id)
+
+        # A failed callback fails its own record only, and URLs that could
+        # not be checked are still retried
+        retried = []
+
+        def retry(**kwargs):
+            retried.append(kwargs['kwargs'])
+            return Retry()
+
+        tasks.bulk_check_urls.retry = retry
+        self.addCleanup(delattr, tasks.bulk_check_urls, 'retry')
+        self.assertRaises(Retry, tasks.bulk_check_urls, capture_ids)
+        self.assertEquals(retried, [{'capture_ids': [capture_ids[3]], 'retries': 1}])
+        records = [Capture.query.get(capture_id) for capture_id in capture_ids]
+        self.assertEquals([record.url_response_code for record in records], [200, 404, 200, 0])
+        self.assertEquals([record.job_status for record in records], ['COMPLETED', 'FAILURE', 'COMPLETED', 'RETRY'])
+        self.assertTrue('500' in records[1].capture_status)
+        self.assertEquals([(path, entry['id']) for path, entry in received],
+                          [('/broken', capture_ids[1]), ('/callback', capture_ids[2])])
+
+    def test_renderer_pool_recycling(self):
+        from sketchy.controllers import renderer
+
+        # A PhantomJS stand-in answering every job with its pid
+        fake_phantomjs = self.fake_executable(
+            'import json, os, sys',
+            'from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer',
+            'class Handler(BaseHTTPRequestHandler):',
+            '    def reply(self):',
+            '        self.rfile.read(int(self.headers.get("Content-Length", 0)))',
+            '        body = json.dumps({"status": "success", "pid": os.getpid()})',
+            '        self.send_response(200)',
+            '        self.send_header("Content-Length", str(len(body)))',
+            '        self.end_headers()',
+            '        self.wfile.write(body)',
+            '    do_GET = do_POST = reply',
+            'HTTPServer(("127.0.0.1", int(sys.argv[4])), Handler).serve_forever()')
+        self.addCleanup(app.config.update, PHANTOMJS=app.config['PHANTOMJS'])
+        app.config.update(PHANTOMJS=fake_phantomjs)
+
+        pool = renderer.RendererPool(1, 2)
+        self.addCleanup(pool.shutdown)
+        job = {'url': 'http://example.com'}
+        first = pool.render(job, 5)['pid']
+        self.assertEquals(pool.render(job, 5)['pid'], first)
+        # Recycled after max_pages renders
+        second = pool.render(job, 5)['pid']
+        self.assertNotEquals(second, first)
+
+        # A renderer that died is replaced, never reused
+        dead = pool.idle.queue[0]
+        dead.process.kill()
+        dead.process.wait()
+        self.assertNotEquals(pool.render(job, 5)['pid'], second)
+        self.assertTrue(pool.idle.queue[0] is not dead)
+
+    def test_s3_upload_all(self):
+        import shutil
+        import tempfile
+        from sketchy.controllers import s3
+
+        class FakeUpload(object):
+            def __init__(self, bucket, path):
+                self.bucket, self.path, self.parts, self.state = bucket, path, [], 'started'
+
+            def upload_part_from_file(self, upload_file, part, size):
+                if self.bucket.fail_part == part:
+                    raise IOError('part {} failed'.format(part))
+                self.parts.append(upload_file.read(size))
+
+            def complete_upload(self):
+                self.state = 'completed'
+                self.bucket.keys[self.path] = ''.join(self.parts)
+
+            def cancel_upload(self):
+                self.state = 'cancelled'
+
+        class FakeBucket(object):
+            def __init__(self):
+                self.keys, self.uploads, self.fail_part = {}, [], None
+
+            def initiate_multipart_upload(self, path, headers):
+                self.uploads.append(FakeUpload(self, path))
+                return self.uploads[-1]
+
+        class FakeKey(object):
+            def __init__(self, bucket):
+                self.bucket = bucket
+
+            def set_contents_from_filename(self, file_path, headers):
+                with open(file_path, 'rb') as upload_file:
+                    self.bucket.keys[self.key] = upload_file.read()
+
+        class FakeConnection(object):
+            def generate_url(self, expires, method, bucket, key, response_headers):
+                return 'https://{}/{}'.format(bucket, key)
+
+        bucket = FakeBucket()
+        for name, fake in (('get_bucket', lambda: (FakeConnection(), bucket)), ('Key', FakeKey)):
+            self.addCleanup(setattr, s3, name, getattr(s3, name))
+            setattr(s3, name, fake)
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.addCleanup(app.config.update, LOCAL_STORAGE_FOLDER=app.config['LOCAL_STORAGE_FOLDER'],
+                        S3_MULTIPART_THRESHOLD=app.config['S3_MULTIPART_THRESHOLD'],
+                        S3_MULTIPART_CHUNKSIZE=app.config['S3_MULTIPART_CHUNKSIZE'])
+        app.config.update(LOCAL_STORAGE_FOLDER=folder, S3_MULTIPART_THRESHOLD=1000, S3_MULTIPART_CHUNKSIZE=400)
+
+        files_to_write = {'sketch': 'example.com_1.png', 'scrape': 'example.com_1.txt', 'html': 'example.com_1.html'}
+        for name, size in (('example.com_1.png', 10), ('example.com_1.txt', 20), ('example.com_1.html', 1000)):
+            with open(storage.artifact_path(name, create=True), 'wb') as artifact:
+                artifact.write('x' * size)
+        content_types = {'sketch': 'image/png', 'scrape': 'text/plain', 'html': 'text/html'}
+
+        urls = s3.upload_all(files_to_write, content_types)
+        paths = ['sketchy/{}/{}'.format(capture_type, name) for capture_type, name in files_to_write.items()]
+        self.assertEquals(sorted(bucket.keys), sorted(paths))
+        self.assertEquals(sorted(urls.values()), sorted('https://{}/{}'.format(app.config['S3_BUCKET_PREFIX'], path)
+                                                        for path in paths))
+        # Only the html is large enough for a multipart upload, sent in 3 parts
+        self.assertEquals([(upload.path, upload.state, len(upload.parts)) for upload in bucket.uploads],
+                          [('sketchy/html/example.com_1.html', 'completed', 3)])
+        self.assertEquals(len(bucket.keys['sketchy/html/example.com_1.html']), 1000)
+
+        bucket.fail_part = 2
+        self.assertRaises(IOError, s3.upload_all, files_to_write, content_types)
+        self.assertEquals(bucket.uploads[-1].state, 'cancelled')
+
+    def test_domain_politeness(self):
+        import time
+        import uuid
+        from celery.exceptions import Retry
+        from sketchy.controllers import politeness
+        from sketchy.controllers.redis_client import get_redis
+
+        class Request(object):
+            called_directly = False
+            retries = 0
+
+        class Task(object):
+            request = Request()
+            deferred = []
+
+            def subtask_from_request(self, **options):
+                self.deferred.append(options)
+                return self
+
+            def apply_async(self):
+                pass
+
+        task = Task()
+        domain = '{}.com'.format(uuid.uuid4().hex)
+        self.addCleanup(get_redis().delete, *politeness._keys(domain))
+        self.addCleanup(app.config.update, **dict((name, app.config[name]) for name in (
+            'DOMAIN_POLITENESS', 'DOMAIN_CONCURRENCY', 'DOMAIN_MIN_INTERVAL', 'DOMAIN_LEASE_TIMEOUT')))
+        app.config.update(DOMAIN_POLITENESS=True, DOMAIN_CONCURRENCY=1, DOMAIN_MIN_INTERVAL=0, DOMAIN_LEASE_TIMEOUT=60)
+
+        # A second check of the domain is deferred while the first holds its lease
+        lease = politeness.acquire(task, 'http://www.{}/a'.format(domain))
+        self.assertEquals(lease[0], domain)
+        self.assertRaises(Retry, politeness.acquire, task, 'http://{}/b'.format(domain))
+        self.assertEquals(len(task.deferred), 1)
+        self.assertTrue(task.deferred[0]['countdown'] >= app.config['DOMAIN_DEFER_COUNTDOWN'])
+        politeness.release(lease)
+        politeness.release(politeness.acquire(task, 'http://{}/b'.format(domain)))
+
+        # Leases of crashed workers expire
+        app.config.update(DOMAIN_LEASE_TIMEOUT=0.05)
+        politeness.acquire(task, 'http://{}/c'.format(domain))
+        self.assertRaises(Retry, politeness.acquire, task, 'http://{}/d'.format(domain))
+        time.sleep(0.1)
+        self.assertNotEquals(politeness.acquire(task, 'http://{}/d'.format(domain)), None)
+        self.assertEquals(len(task.deferred), 2)
+
+    def test_bulk_check_politeness(self):
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from sketchy.controllers import politeness
+        from sketchy.controllers.redis_client import get_redis
+        from sketchy.models.capture import Capture
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serve(Handler)
+        self.addCleanup(get_redis().delete, *politeness._keys('127.0.0.1'))
+        self.addCleanup(app.config.update, **dict((name, app.config[name]) for name in (
+            'DOMAIN_POLITENESS', 'DOMAIN_CONCURRENCY', 'DOMAIN_MIN_INTERVAL', 'DOMAIN_LEASE_TIMEOUT')))
+        app.config.update(DOMAIN_POLITENESS=True, DOMAIN_CONCURRENCY=2, DOMAIN_MIN_INTERVAL=0, DOMAIN_LEASE_TIMEOUT=60)
+        deferred = []
+
+        class Signature(object):
+            def __init__(self, **options):
+                self.options = options
+
+            def apply_async(self):
+                deferred.append(self.options)
+
+        task = tasks.bulk_check_urls
+        task.subtask_from_request = Signature
+        self.addCleanup(delattr, task, 'subtask_from_request')
+
+        capture_ids = []
+        for path in ('/a', '/b', '/c'):
+            capture_record = Capture()
+            capture_record.url = base + path
+            capture_record.status_only = True
+            db.session.add(capture_record)
+            db.session.commit()
+            capture_ids.append(capture_record.id)
+
+        # Checks take the slots of their domain, the rest waits for a later run
+        held = politeness.take('127.0.0.1')[0]
+        task.push_request(called_directly=False, retries=0)
+        self.addCleanup(task.pop_request)
+        task.run(capture_ids)
+        records = [Capture.query.get(capture_id) for capture_id in capture_ids]
+        self.assertEquals([record.job_status for record in records], ['COMPLETED', 'CREATED', 'CREATED'])
+        self.assertEquals([options['kwargs'] for options in deferred],
+                          [{'capture_ids': capture_ids[1:], 'retries': 0}])
+        # and give them back once checked
+        politeness.release(held)
+        self.assertEquals(get_redis().zcard(politeness._keys('127.0.0.1')[0]), 0)
+
+    def test_fused_capture(self):
+        import shutil
+        import subprocess32
+        import tempfile
+        from BaseHTTPServer import BaseHTTPRequestHandler
+        from celery.exceptions import Retry
+        from PIL import Image
+        from sqlalchemy import event
+        from sqlalchemy.orm import Session
+        from sketchy.models.capture import Capture
+        received = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_response(200)
+                self.end_headers()
+
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        base = self.serve(Handler)
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.addCleanup(app.config.update, **dict((name, app.config[name]) for name in (
+            'LOCAL_STORAGE_FOLDER', 'PHANTOMJS', 'ASYNC_CALLBACKS')))
+        Image.new('RGB', (32, 32), 'white').save(os.path.join(folder, 'sketch.png'))
+        # A capture.js stand-in that hangs as many times as the hangs file says, then renders
+        hangs = os.path.join(folder, 'hangs')
+        fake_phantomjs = self.fake_executable(
+            'import json, os, shutil, sys, time',
+            'hangs = int(open({0!r}).read())'.format(hangs),
+            'if hangs:',
+            '    open({0!r}, "w").write(str(hangs - 1))'.format(hangs),
+            '    time.sleep(5)',
+            'shutil.copy({0!r}, sys.argv[5] + "." + sys.argv[8])'.format(os.path.join(folder, 'sketch.png')),
+            'open(sys.argv[5] + ".html", "w").write("<html><body><p>Hello fused</p></body></html>")',
+            'print json.dumps({"status": "success", "blocked": 0})')
+        app.config.update(LOCAL_STORAGE_FOLDER=folder, PHANTOMJS=fake_phantomjs, ASYNC_CALLBACKS=False)
+
+        capture_record = Capture()
+        capture_record.url = base + '/'
+        capture_record.callback = base + '/callback'
+        db.session.add(capture_record)
+        db.session.commit()
+        capture_id = capture_record.id
+
+        # A render that times out leaves the record checked and ready for a retry
+        open(hangs, 'w').write('1')
+        self.assertRaises(subprocess32.TimeoutExpired, tasks.celery_fused_capture,
+                          app.config['BASE_URL'], capture_id=capture_id, phantomjs_timeout=1)
+        capture_record = Capture.query.get(capture_id)
+        self.assertEquals((capture_record.job_status, capture_record.retry, capture_record.url_response_code),
+                          ('RETRY', 1, 200))
+        self.assertEquals(received, [])
+
+        # Under a worker the Retry passes through to celery, here the retry runs eagerly
+        open(hangs, 'w').write('1')
+        task = tasks.celery_fused_capture
+        task.push_request(called_directly=False, is_eager=True, retries=1)
+        try:
+            self.assertRaises(Retry, task.run, app.config['BASE_URL'], capture_id=capture_id,
+                              retries=1, model='capture', phantomjs_timeout=1)
+        finally:
+            task.pop_request()
+        capture_record = Capture.query.get(capture_id)
+        self.assertEquals((capture_record.job_status, capture_record.retry), ('COMPLETED', 2))
+        self.assertEquals([entry['id'] for entry in received], [capture_id])
+
+        # A capture that succeeds at once is only committed when it starts and ends
+        commits = []
+        count_commit = lambda session: commits.append(session)
+        event.listen(Session, 'after_commit', count_commit)
+        self.addCleanup(event.remove, Session, 'after_commit', count_commit)
+        tasks.celery_fused_capture(app.config['BASE_URL'], capture_id=capture_id)
+        self.assertEquals(len(commits), 2)
+        capture_record = Capture.query.get(capture_id)
+        self.assertEquals((capture_record.job_status, capture_record.retry), ('COMPLETED', 0))
+        self.assertEquals(capture_record.capture_status, 'LOCAL_CAPTURES_CREATED')
+        self.assertEquals(len(received), 2)
+
+    def test_callbacks_after_commit(self):
+        from sketchy.controllers import callbacks
+        from sketchy.models.capture import Capture
+        sent = []
+
+        class DeliverCallback(object):
+            def apply_async(self, args):
+                sent.append(args)
+
+        self.addCleanup(setattr, callbacks, 'deliver_callback', callbacks.deliver_callback)
+        callbacks.deliver_callback = DeliverCallback()
+        self.addCleanup(app.config.update, ASYNC_CALLBACKS=app.config['ASYNC_CALLBACKS'])
+        app.config.update(ASYNC_CALLBACKS=True)
+
+        capture_record = Capture()
+        capture_record.url = 'http://example.com'
+        capture_record.callback = 'http://127.0.0.1/callback'
+        db.session.add(capture_record)
+        db.session.commit()
+
+        # Callback workers only hear of a record once it is committed
+        capture_record.capture_status = 'LOCAL_CAPTURES_CREATED'
+        tasks.finisher(capture_record, commit=False)
+        self.assertEquals(sent, [])
+        db.session.commit()
+        self.assertEquals([(callback, entries[0]['payload']['capture_status']) for callback, entries in sent],
+                          [('http://127.0.0.1/callback', 'LOCAL_CAPTURES_CREATED')])
+
+        # and never of a change that was rolled back
+        tasks.finisher(capture_record, commit=False)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEquals(len(sent), 1)
+
+    def test_eager_coalescing(self):
+        import urllib
+        import uuid
+        from celery.exceptions import TimeoutError
+        from sketchy.controllers import controller
+        from sketchy.controllers.redis_client import get_redis
+        from sketchy.controllers.validators import url_hash
+        from sketchy.models.capture import Capture
+        sent = []
+
+        class PendingResult(object):
+            def get(self, timeout, interval):
+                raise TimeoutError()
+
+        class EagerCapture(object):
+            def apply_async(self, args, kwargs, task_id):
+                sent.append((kwargs, task_id))
+
+            def AsyncResult(self, task_id):
+                return PendingResult()
+
+        self.addCleanup(setattr, tasks, 'eager_capture', tasks.eager_capture)
+        tasks.eager_capture = EagerCapture()
+        url = 'http://example.com/{}'.format(uuid.uuid4().hex)
+        coalesce_key = controller.EAGER_KEY.format(url_hash(url))
+        self.addCleanup(get_redis().delete, coalesce_key)
+
+        # A request for a URL that is being rendered joins that render, and
+        # both are told where to poll once the wait times out
+        endpoint = '/eager?' + urllib.urlencode({'url': url, 'type': 'sketch'})
+        responses = [self.test_app.get(endpoint) for _ in range(2)]
+        self.assertEquals(len(sent), 1)
+        capture_id = sent[0][0]['capture_id']
+        self.assertEquals(sent[0][0]['coalesce_key'], coalesce_key)
+        self.assertEquals(json.loads(get_redis().get(coalesce_key)), {'capture_id': capture_id, 'task_id': sent[0][1]})
+        for response in responses:
+            self.assertEquals(response.status_code, 202)
+            self.assertEquals(json.loads(response.data)['id'], capture_id)
+            self.assertTrue(response.headers['Location'].endswith('/api/v1.0/capture/{}'.format(capture_id)))
+        self.assertEquals(Capture.query.filter(Capture.url == url).count(), 1)
+
+    def test_eager_capture_clears_coalesce_key(self):
+        from sketchy.controllers import controller
+        from sketchy.controllers.redis_client import get_redis
+        from sketchy.models.capture import Capture
+
+        capture_record = Capture()
+        capture_record.url = 'http://127.0.0.1:1/'
+        db.session.add(capture_record)
+        db.session.commit()
+        capture_id = capture_record.id
+        coalesce_key = controller.EAGER_KEY.format('test-{}'.format(capture_id))
+        self.addCleanup(get_redis().delete, coalesce_key)
+        get_redis().set(coalesce_key, json.dumps({'capture_id': capture_id, 'task_id': 'test'}))
+
+        # A failed capture no longer holds back new renders of its URL
+        self.assertRaises(Exception, tasks.eager_capture, app.config['BASE_URL'],
+                          capture_id=capture_id, coalesce_key=coalesce_key)
+        self.assertEquals(get_redis().get(coalesce_key), None)
+
+    def test_metrics_export(self):
+        import datetime
+        from sketchy.controllers import metrics
+        from sketchy.models.capture import Capture
+
+        self.addCleanup(app.config.update, METRICS_ENABLED=app.config['METRICS_ENABLED'])
+        app.config.update(METRICS_ENABLED=True)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        metrics.observe('sketchy_stage_seconds', 0.3, stage='render')
+        metrics.observe('sketchy_stage_seconds', 0.7, stage='render')
+        capture_record = Capture()
+        capture_record.created_at = datetime.datetime.now() - datetime.timedelta(seconds=3)
+        metrics.queue_wait('celery_capture', capture_record)
+        metrics.incr('sketchy_stage_total', stage='render', outcome='success')
+
+        response = self.test_app.get('/metrics')
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.data.splitlines()
+        self.assertTrue('# TYPE sketchy_stage_seconds histogram' in lines)
+        for line in ('sketchy_stage_seconds_bucket{stage="render",le="0.25"} 0',
+                     'sketchy_stage_seconds_bucket{stage="render",le="0.5"} 1',
+                     'sketchy_stage_seconds_bucket{stage="render",le="1.0"} 2',
+                     'sketchy_stage_seconds_bucket{stage="render",le="+Inf"} 2',
+                     'sketchy_stage_seconds_sum{stage="render"} 1.0',
+                     'sketchy_stage_seconds_count{stage="render"} 2',
+                     'sketchy_queue_wait_seconds_bucket{task="celery_capture",le="2.5"} 0',
+                     'sketchy_queue_wait_seconds_bucket{task="celery_capture",le="5.0"} 1',
+                     'sketchy_queue_wait_seconds_count{task="celery_capture"} 1',
+                     'sketchy_stage_total{outcome="success",stage="render"} 1'):
+            self.assertTrue(line in lines, line)
+
+        # Buckets are cumulative and end with the count of their series
+        for series in ('sketchy_stage_seconds_bucket{stage="render",', 'sketchy_queue_wait_seconds_bucket{task="celery_capture",'):
+            counts = [int(line.rsplit(' ', 1)[1]) for line in lines if line.startswith(series)]
+            self.assertEquals(len(counts), len(metrics.BUCKETS) + 1)
+            self.assertEquals(counts, sorted(counts))